@@ -1,15 +1,41 @@
 # ---------------------------------------------
 # Configuración e importación de dependencias
 # ---------------------------------------------
-from flask import Flask, request
+from flask import Flask, Response, request
 import requests
+from requests.adapters import HTTPAdapter
+import httpx
 import os
+import sys
 import time
+import threading
 from dotenv import load_dotenv
-from openai import OpenAI
+import openai
+from openai import AsyncOpenAI, OpenAI
 import gspread
 from google.oauth2.service_account import Credentials
 import json
+import asyncio
+import base64
+import contextlib
+import contextvars
+import email.utils
+import hashlib
+import heapq
+import io
+import itertools
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import unicodedata
+import weakref
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 # ✅ Agents SDK
 from agents import Agent, Runner, function_tool
 
@@ -18,6 +44,7 @@ load_dotenv()
 
 # Inicialización de la app Flask
 app = Flask(__name__)
+_INICIO_IMPORTACION = time.perf_counter()
 
 # ✅ Config memoria del contexto de conversación.
 # El bot recuerda a cada lead (historial + perfil) por este tiempo de INACTIVIDAD; el
@@ -25,6 +52,170 @@ app = Flask(__name__)
 TTL_SEGUNDOS = 60 * 60 * 24 * 90  # 90 días
 MAX_TURNOS = 20  # 20 turnos (user+assistant). Ajusta si quieres.
 
+# ---------------------------------------------
+# ✅ Métricas (formato Prometheus en /metrics)
+# ---------------------------------------------
+# Contadores, gauges e histogramas de latencia por etapa del pipeline. Registrar una muestra
+# es un dict update bajo un lock sin contención apreciable (micro-segundos), apto para el
+# camino crítico. Cada proceso publica periódicamente su snapshot como un campo del hash
+# `metricas:procesos` y /metrics los lee con un solo HGETALL y suma los de los procesos vivos
+# (varios workers/dynos); con memoria local hay un solo proceso y se exporta directamente.
+# Los gauges que describen a un proceso (estado de sus breakers, su arranque) no se suman:
+# salen con la etiqueta `proceso`.
+METRICAS_TOKEN = os.getenv("METRICAS_TOKEN", "")           # opcional: protege /metrics
+METRICAS_HASH = "metricas:procesos"                         # proceso → snapshot JSON (con "t")
+METRICAS_PUBLICAR_CADA = 15                                 # seg.
+METRICAS_VENCEN = METRICAS_PUBLICAR_CADA * 4                # snapshot más viejo: proceso muerto
+GAUGES_POR_PROCESO = {"breaker_estado", "arranque_segundos"}
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+
+class _RegistroMetricas:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.contadores = {}    # (nombre, etiquetas) -> valor
+        self.gauges = {}        # (nombre, etiquetas) -> valor
+        self.histogramas = {}   # (nombre, etiquetas) -> [conteos por bucket..., suma, total]
+
+    @staticmethod
+    def _clave(nombre, etiquetas):
+        return nombre, tuple(sorted((k, str(v)) for k, v in etiquetas.items()))
+
+    def contar(self, nombre, valor=1, **etiquetas):
+        clave = self._clave(nombre, etiquetas)
+        with self._lock:
+            self.contadores[clave] = self.contadores.get(clave, 0) + valor
+
+    def fijar(self, nombre, valor, **etiquetas):
+        with self._lock:
+            self.gauges[self._clave(nombre, etiquetas)] = valor
+
+    def observar(self, nombre, valor, **etiquetas):
+        clave = self._clave(nombre, etiquetas)
+        with self._lock:
+            h = self.histogramas.get(clave)
+            if h is None:
+                h = self.histogramas[clave] = [0] * len(BUCKETS_LATENCIA) + [0.0, 0]
+            for i, limite in enumerate(BUCKETS_LATENCIA):
+                if valor <= limite:
+                    h[i] += 1
+                    break
+            h[-2] += valor
+            h[-1] += 1
+
+    def valor(self, nombre, **etiquetas):
+        with self._lock:
+            return self.contadores.get(self._clave(nombre, etiquetas), 0)
+
+    def snapshot(self):
+        with self._lock:
+            return {"c": [[n, list(e), v] for (n, e), v in self.contadores.items()],
+                    "g": [[n, list(e), v] for (n, e), v in self.gauges.items()],
+                    "h": [[n, list(e), list(h)] for (n, e), h in self.histogramas.items()]}
+
+
+class medir:
+    """Context manager que observa la duración del bloque en el histograma `nombre`."""
+    __slots__ = ("nombre", "etiquetas", "inicio")
+
+    def __init__(self, nombre, **etiquetas):
+        self.nombre, self.etiquetas = nombre, etiquetas
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _metricas.observar(self.nombre, time.perf_counter() - self.inicio, **self.etiquetas)
+        return False
+
+
+def _id_proceso():
+    """<dyno u host>:<pid> — identifica las métricas publicadas y las listas de la cola."""
+    return f"{os.getenv('DYNO') or socket.gethostname()}:{os.getpid()}"
+
+
+_metricas = _RegistroMetricas()
+_metricas_id = _id_proceso()
+_publicador_metricas = []
+
+
+def _snapshot_proceso():
+    """Snapshot del registro con el id del proceso ("p") y la hora de publicación ("t")."""
+    return {"p": _metricas_id, "t": time.time(), **_metricas.snapshot()}
+
+
+def _publicar_metricas():
+    while True:
+        time.sleep(METRICAS_PUBLICAR_CADA)
+        try:
+            _actualizar_gauges_proceso()
+            _backend.hset(METRICAS_HASH, _metricas_id, json.dumps(_snapshot_proceso()))
+        except Exception as e:
+            print("[WARN] No se pudieron publicar las métricas del proceso:", e)
+
+
+def _asegurar_publicador_metricas():
+    if _publicador_metricas or isinstance(_backend.obtener(), _MemoriaLocal):
+        return
+    with _metricas._lock:
+        if not _publicador_metricas:
+            hilo = threading.Thread(target=_publicar_metricas, name="metricas", daemon=True)
+            hilo.start()
+            _publicador_metricas.append(hilo)
+
+
+def _combinar_snapshots(snapshots):
+    """Suma contadores e histogramas de varios procesos; los gauges se suman también
+    (p. ej. workers o elementos en buzones de cada proceso), salvo GAUGES_POR_PROCESO, que
+    quedan uno por proceso con la etiqueta `proceso`."""
+    total = {"c": {}, "g": {}, "h": {}}
+    for snap in snapshots:
+        for tipo in ("c", "g"):
+            for nombre, etiquetas, valor in snap.get(tipo, []):
+                etiquetas = tuple(tuple(e) for e in etiquetas)
+                if tipo == "g" and nombre in GAUGES_POR_PROCESO and snap.get("p"):
+                    etiquetas = tuple(sorted(etiquetas + (("proceso", snap["p"]),)))
+                clave = (nombre, etiquetas)
+                total[tipo][clave] = total[tipo].get(clave, 0) + valor
+        for nombre, etiquetas, h in snap.get("h", []):
+            clave = (nombre, tuple(tuple(e) for e in etiquetas))
+            previo = total["h"].get(clave)
+            total["h"][clave] = h if previo is None else [a + b for a, b in zip(previo, h)]
+    return total
+
+
+def _formato_etiquetas(etiquetas, extra=()):
+    pares = list(etiquetas) + list(extra)
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in pares) + "}"
+
+
+def exportar_metricas(snapshots):
+    """Texto de exposición Prometheus (0.0.4) a partir de snapshots de procesos."""
+    total = _combinar_snapshots(snapshots)
+    lineas, vistos = [], set()
+    for tipo, tipo_prom in (("c", "counter"), ("g", "gauge")):
+        for (nombre, etiquetas), valor in sorted(total[tipo].items()):
+            if nombre not in vistos:
+                vistos.add(nombre)
+                lineas.append(f"# TYPE kudo_{nombre} {tipo_prom}")
+            lineas.append(f"kudo_{nombre}{_formato_etiquetas(etiquetas)} {valor}")
+    for (nombre, etiquetas), h in sorted(total["h"].items()):
+        if nombre not in vistos:
+            vistos.add(nombre)
+            lineas.append(f"# TYPE kudo_{nombre} histogram")
+        acumulado = 0
+        for limite, conteo in zip(BUCKETS_LATENCIA, h):
+            acumulado += conteo
+            lineas.append(f"kudo_{nombre}_bucket{_formato_etiquetas(etiquetas, [('le', limite)])} {acumulado}")
+        lineas.append(f"kudo_{nombre}_bucket{_formato_etiquetas(etiquetas, [('le', '+Inf')])} {h[-1]}")
+        lineas.append(f"kudo_{nombre}_sum{_formato_etiquetas(etiquetas)} {h[-2]}")
+        lineas.append(f"kudo_{nombre}_count{_formato_etiquetas(etiquetas)} {h[-1]}")
+    return "\n".join(lineas) + "\n"
+
+
 # ---------------------------------------------
 # ✅ Persistencia del contexto de conversación (Redis)
 # ---------------------------------------------
@@ -38,78 +229,1612 @@ BIENVENIDO_PREFIX = "bienvenido:"    # marca de "ya saludado" (TTL largo)
 BIENVENIDO_TTL = TTL_SEGUNDOS        # mismo período que el contexto (90 días)
 
 
+# Límites del fallback en memoria: se comporta como un Redis con maxmemory-policy volatile-lru
+# (solo se desalojan claves con TTL). Además nunca se desaloja el estado que no es caché: filas
+# pendientes del outbox, la cola del webhook, locks y la marca de "ya saludado".
+MEMORIA_SIN_DESALOJO = ("outbox:sheets:", "cola:", "lock:", BIENVENIDO_PREFIX)
+MEMORIA_MAX_CLAVES = int(os.getenv("MEMORIA_MAX_CLAVES", "50000"))
+MEMORIA_MAX_BYTES = int(os.getenv("MEMORIA_MAX_MB", "64")) * 1024 * 1024
+MEMORIA_BARRIDO = 64        # vencimientos revisados por escritura (barrido incremental)
+_BYTES_POR_CLAVE = 100      # overhead aproximado por clave (dicts, entrada, heap)
+
+
+class _Entrada:
+    __slots__ = ("valor", "expira", "bytes")
+
+    def __init__(self, valor, expira, nbytes):
+        self.valor, self.expira, self.bytes = valor, expira, nbytes
+
+
+def _bytes_de(key, valor):
+    """Tamaño aproximado de una clave: strings, listas de strings o hashes str -> str."""
+    if isinstance(valor, str):
+        n = len(valor)
+    elif isinstance(valor, dict):
+        n = sum(len(c) + len(v) for c, v in valor.items())
+    elif isinstance(valor, list):
+        n = sum(len(v) for v in valor)
+    else:
+        n = len(str(valor))
+    return _BYTES_POR_CLAVE + len(key) + n
+
+
 class _MemoriaLocal:
-    """Fallback en RAM con la interfaz mínima de redis-py (solo desarrollo local)."""
-    def __init__(self):
-        self._store = {}  # key -> (expira_epoch | None, valor)
+    """Fallback en RAM con la interfaz mínima de redis-py (desarrollo local o Redis caído).
 
-    def get(self, key):
-        item = self._store.get(key)
-        if not item:
+    Es una caché acotada: como mucho `max_claves` claves y ~`max_bytes` bytes, desalojando
+    la de uso menos reciente entre las desalojables (con TTL y fuera de MEMORIA_SIN_DESALOJO);
+    si no queda ninguna, los límites se exceden antes que perder datos. Los TTL van a un min-heap que cada escritura barre de a poco,
+    así las claves vencidas se liberan aunque nadie vuelva a leerlas. Todo corre bajo un
+    único lock reentrante (`_mutex`; `_hay_datos` es su Condition para los blpop).
+    """
+    def __init__(self, max_claves=None, max_bytes=None):
+        self.max_claves = max_claves or MEMORIA_MAX_CLAVES
+        self.max_bytes = max_bytes or MEMORIA_MAX_BYTES
+        self._store = {}             # key -> _Entrada
+        self._lru = OrderedDict()    # claves desalojables -> None, de uso menos a más reciente
+        self._vencimientos = []      # min-heap (expira, key); las obsoletas se descartan al salir
+        self._bytes = 0
+        self._mutex = threading.RLock()
+        self._hay_datos = threading.Condition(self._mutex)   # despierta a los blpop en espera
+        self._locks = weakref.WeakValueDictionary()  # nombre -> _Cerrojo (ver lock())
+        self.desalojadas = 0
+        self.vencidas = 0
+        self._cursores = OrderedDict()   # cursor de SCAN -> (claves al empezar, posición)
+        self._ids_cursor = itertools.count(1)
+
+    # --- Internos: siempre con self._mutex tomado ---
+    def _entrada(self, key):
+        e = self._store.get(key)
+        if e is None:
             return None
-        expira, valor = item
-        if expira is not None and time.time() > expira:
-            self._store.pop(key, None)
+        if e.expira is not None and time.time() > e.expira:
+            self._quitar(key)
+            self.vencidas += 1
             return None
-        return valor
+        if key in self._lru:
+            self._lru.move_to_end(key)
+        return e
+
+    def _quitar(self, key):
+        e = self._store.pop(key, None)
+        if e is not None:
+            self._lru.pop(key, None)
+            self._bytes -= e.bytes
+        return e
+
+    def _clasificar(self, key, e):
+        """Anota o saca `key` de las desalojables según su TTL actual."""
+        if e.expira is not None and not key.startswith(MEMORIA_SIN_DESALOJO):
+            self._lru[key] = None
+            self._lru.move_to_end(key)
+        else:
+            self._lru.pop(key, None)
+
+    def _poner(self, key, valor, expira):
+        nbytes = _bytes_de(key, valor)
+        e = self._store.get(key)
+        if e is None:
+            e = self._store[key] = _Entrada(valor, expira, nbytes)
+            self._bytes += nbytes
+        else:
+            self._bytes += nbytes - e.bytes
+            e.valor, e.expira, e.bytes = valor, expira, nbytes
+        self._clasificar(key, e)
+        if expira is not None:
+            heapq.heappush(self._vencimientos, (expira, key))
+        self._mantener()
+        return e
+
+    def _remedir(self, key, e, delta=None):
+        """Actualiza el tamaño de una lista/hash modificada en el lugar (o lo borra si quedó vacía)."""
+        if not e.valor:
+            self._quitar(key)  # como en Redis: una lista o hash vacío deja de existir
+            return
+        nbytes = e.bytes + delta if delta is not None else _bytes_de(key, e.valor)
+        self._bytes += nbytes - e.bytes
+        e.bytes = nbytes
+        self._mantener()
+
+    def _mantener(self):
+        """Barre algunos vencimientos y desaloja por LRU hasta volver a estar dentro de los límites."""
+        heap = self._vencimientos
+        if heap and heap[0][0] <= time.time():
+            self._barrer()
+        # Cada renovación de TTL deja una tupla obsoleta; si se acumulan, se reconstruye el heap.
+        if len(heap) > 2 * len(self._store) + 1024:
+            self._vencimientos = [(e.expira, k) for k, e in self._store.items() if e.expira is not None]
+            heapq.heapify(self._vencimientos)
+        if len(self._store) > self.max_claves or self._bytes > self.max_bytes:
+            self._desalojar()
+
+    def _barrer(self):
+        ahora = time.time()
+        heap = self._vencimientos
+        for _ in range(MEMORIA_BARRIDO):
+            if not heap or heap[0][0] > ahora:
+                return
+            expira, key = heapq.heappop(heap)
+            e = self._store.get(key)
+            if e is not None and e.expira == expira:
+                self._quitar(key)
+                self.vencidas += 1
+
+    def _desalojar(self):
+        while len(self._lru) > 1 and (len(self._store) > self.max_claves or self._bytes > self.max_bytes):
+            key, _ = self._lru.popitem(last=False)
+            self._bytes -= self._store.pop(key).bytes
+            self.desalojadas += 1
+
+    def estado(self):
+        with self._mutex:
+            return {"claves": len(self._store), "bytes": self._bytes, "desalojadas": self.desalojadas,
+                    "vencidas": self.vencidas, "heap": len(self._vencimientos)}
+
+    # --- Strings ---
+    def get(self, key):
+        with self._mutex:
+            e = self._entrada(key)
+            return None if e is None else e.valor
+
+    def mget(self, keys):
+        with self._mutex:
+            return [self.get(k) for k in keys]
 
     def setex(self, key, ttl, valor):
-        self._store[key] = (time.time() + ttl, valor)
+        with self._mutex:
+            self._poner(key, valor, time.time() + ttl)
+
+    def set(self, key, valor, nx=False, ex=None):
+        with self._mutex:  # nx debe ser atómico frente a otros hilos
+            if nx and self._entrada(key) is not None:
+                return None
+            self._poner(key, valor, time.time() + ex if ex else None)
+            return True
 
     def delete(self, key):
-        self._store.pop(key, None)
+        with self._mutex:
+            self._quitar(key)
 
     def keys(self, pattern):
         prefijo = pattern[:-1] if pattern.endswith("*") else pattern
-        return [k for k in list(self._store) if k.startswith(prefijo) and self.get(k) is not None]
+        ahora = time.time()
+        with self._mutex:
+            return [k for k, e in self._store.items()
+                    if k.startswith(prefijo) and (e.expira is None or e.expira >= ahora)]
+
+    # SCAN: el cursor 0 toma una foto de las claves y cada página sigue desde la posición
+    # guardada para ese cursor (O(n) el recorrido completo, no O(n²)). Como en Redis, una clave
+    # creada durante el recorrido puede no aparecer y una borrada no se devuelve; nunca bloquea.
+    # Se recuerdan pocos cursores: uno abandonado a mitad se olvida solo.
+    def scan(self, cursor=0, match=None, count=10):
+        prefijo = match[:-1] if match and match.endswith("*") else match
+        ahora = time.time()
+        with self._mutex:
+            if not cursor:
+                cursor = next(self._ids_cursor)
+                self._cursores[cursor] = (list(self._store), 0)
+                while len(self._cursores) > 16:
+                    self._cursores.popitem(last=False)
+            claves, posicion = self._cursores.pop(cursor, ((), 0))
+            pagina = claves[posicion:posicion + count]
+            posicion += count
+            siguiente = 0
+            if posicion < len(claves):
+                self._cursores[cursor] = (claves, posicion)
+                siguiente = cursor
+            return siguiente, [k for k in pagina
+                               if (not match or k.startswith(prefijo))
+                               and (e := self._store.get(k)) is not None
+                               and (e.expira is None or e.expira >= ahora)]
+
+    def scan_iter(self, match=None, count=10):
+        cursor = 0
+        while True:
+            cursor, claves = self.scan(cursor, match=match, count=count)
+            yield from claves
+            if not cursor:
+                return
+
+    # Listas (cola de trabajo del webhook, outbox, historial).
+    def rpush(self, key, *valores):
+        with self._mutex:
+            e = self._entrada(key)
+            if e is None:
+                e = self._poner(key, [], None)
+            e.valor.extend(valores)
+            self._remedir(key, e, sum(len(v) for v in valores))
+            self._hay_datos.notify_all()
+            return len(e.valor)
+
+    def blpop(self, keys, timeout=0):
+        limite = time.time() + timeout if timeout else None
+        with self._hay_datos:
+            while True:
+                for key in keys:
+                    e = self._entrada(key)
+                    if e is not None and e.valor:
+                        valor = e.valor.pop(0)
+                        self._remedir(key, e, -len(valor))
+                        return key, valor
+                restante = None if limite is None else limite - time.time()
+                if restante is not None and restante <= 0:
+                    return None
+                self._hay_datos.wait(restante)
+
+    def lmove(self, origen, destino, src="LEFT", dest="RIGHT"):
+        with self._mutex:
+            e = self._entrada(origen)
+            if e is None or not e.valor:
+                return None
+            valor = e.valor.pop(0 if src == "LEFT" else -1)
+            self._remedir(origen, e, -len(valor))
+            d = self._entrada(destino)
+            if d is None:
+                d = self._poner(destino, [], None)
+            if dest == "LEFT":
+                d.valor.insert(0, valor)
+            else:
+                d.valor.append(valor)
+            self._remedir(destino, d, len(valor))
+            self._hay_datos.notify_all()
+            return valor
+
+    def blmove(self, origen, destino, timeout, src="LEFT", dest="RIGHT"):
+        limite = time.time() + timeout if timeout else None
+        with self._hay_datos:
+            while True:
+                valor = self.lmove(origen, destino, src, dest)
+                if valor is not None:
+                    return valor
+                restante = None if limite is None else limite - time.time()
+                if restante is not None and restante <= 0:
+                    return None
+                self._hay_datos.wait(restante)
+
+    def lrem(self, key, count, valor):
+        with self._mutex:
+            e = self._entrada(key)
+            if e is None:
+                return 0
+            quitados = 0
+            while valor in e.valor and (count == 0 or quitados < abs(count)):
+                e.valor.remove(valor)
+                quitados += 1
+            self._remedir(key, e)
+            return quitados
+
+    def llen(self, key):
+        with self._mutex:
+            e = self._entrada(key)
+            return 0 if e is None else len(e.valor)
+
+    def lrange(self, key, inicio, fin):
+        with self._mutex:
+            e = self._entrada(key)
+            return [] if e is None else list(e.valor[inicio:(fin + 1) or None])
+
+    def ltrim(self, key, inicio, fin):
+        with self._mutex:
+            e = self._entrada(key)
+            if e is not None:
+                e.valor[:] = e.valor[inicio:(fin + 1) or None]
+                self._remedir(key, e)
+
+    # Hashes (perfil del prospecto, registros): hset / hget / hgetall / hdel, y expire para
+    # cualquier clave.
+    def hset(self, key, campo=None, valor=None, mapping=None):
+        with self._mutex:
+            nuevos = dict(mapping or {})
+            if campo is not None:
+                nuevos[campo] = valor
+            e = self._entrada(key)
+            if e is None:
+                e = self._poner(key, {}, None)
+            agregados = sum(1 for c in nuevos if c not in e.valor)
+            e.valor.update({c: str(v) for c, v in nuevos.items()})
+            self._remedir(key, e)
+            return agregados
+
+    def hget(self, key, campo):
+        with self._mutex:
+            e = self._entrada(key)
+            return None if e is None else e.valor.get(campo)
+
+    def hgetall(self, key):
+        with self._mutex:
+            e = self._entrada(key)
+            return {} if e is None else dict(e.valor)
+
+    def hdel(self, key, *campos):
+        with self._mutex:
+            e = self._entrada(key)
+            if e is None:
+                return 0
+            borrados = sum(1 for c in campos if e.valor.pop(c, None) is not None)
+            self._remedir(key, e)
+            return borrados
+
+    def expire(self, key, ttl):
+        with self._mutex:
+            e = self._entrada(key)
+            if e is None:
+                return False
+            e.expira = time.time() + ttl
+            heapq.heappush(self._vencimientos, (e.expira, key))
+            self._clasificar(key, e)
+            self._mantener()
+            return True
+
+    def reclamar_bienvenida(self, keys, args):
+        """Equivalente de SCRIPT_BIENVENIDA (mismas KEYS / ARGV), atómico bajo el mutex."""
+        bienvenido, ctx, perfil, hist, outbox = keys
+        ttl_bienvenido, ttl, payload, mensaje, fila, *campos = args
+        with self._mutex:
+            if not self.set(bienvenido, "1", nx=True, ex=ttl_bienvenido):
+                return 0
+            if any(self._entrada(k) is not None for k in (ctx, perfil, hist)):
+                return 0
+            self.setex(ctx, ttl, payload)
+            self.rpush(hist, mensaje)
+            self.expire(hist, ttl)
+            if campos:
+                self.hset(perfil, mapping=dict(zip(campos[::2], campos[1::2])))
+                self.expire(perfil, ttl)
+            return self.rpush(outbox, fila)
+
+    def pipeline(self, transaction=True):
+        return _PipelineLocal(self)
+
+    # Locks: en un solo proceso basta un threading.Lock por nombre (sin lease que vencer).
+    # El registro es débil: el lock de un teléfono se libera cuando ya nadie lo usa.
+    def lock(self, name, timeout=None, blocking_timeout=None, thread_local=True):
+        with self._mutex:
+            cerrojo = self._locks.get(name)
+            if cerrojo is None:
+                cerrojo = self._locks[name] = _Cerrojo()
+        return _LockLocal(cerrojo, blocking_timeout)
+
+
+class _Cerrojo:
+    __slots__ = ("lock", "__weakref__")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+
+class _PipelineLocal:
+    """Pipeline de _MemoriaLocal: acumula comandos y los ejecuta juntos (atómicamente)."""
+    def __init__(self, memoria):
+        self._memoria = memoria
+        self._comandos = []
+
+    def __getattr__(self, nombre):
+        metodo = getattr(self._memoria, nombre)
+
+        def encolar(*args, **kwargs):
+            self._comandos.append((metodo, args, kwargs))
+            return self
+        return encolar
+
+    def execute(self):
+        with self._memoria._mutex:
+            comandos, self._comandos = self._comandos, []
+            return [metodo(*args, **kwargs) for metodo, args, kwargs in comandos]
+
+
+class _LockLocal:
+    """Equivalente en proceso de redis.lock.Lock (acquire / release / reacquire)."""
+    def __init__(self, cerrojo, blocking_timeout=None):
+        self._cerrojo = cerrojo  # mantiene vivo el registro débil mientras se use este lock
+        self._lock = cerrojo.lock
+        self._espera = -1 if blocking_timeout is None else blocking_timeout
+
+    def acquire(self):
+        return self._lock.acquire(timeout=self._espera)
+
+    def release(self):
+        self._lock.release()
+
+    def reacquire(self):
+        return True
+
+
+# ---------------------------------------------
+# ✅ Arranque perezoso (Redis, Google Sheets, OpenAI, agente)
+# ---------------------------------------------
+# Importar app.py no conecta con nada: cada dependencia externa se envuelve en un _Perezoso
+# que la inicializa la primera vez que se usa (thread-safe, una sola vez) y mide cuánto
+# tardó (gauge arranque_segundos{componente}). Al final de la importación un hilo las
+# "calienta" EN PARALELO, así el primer webhook no paga el login de Google ni el ping a
+# Redis, y si Google está lento o caído el proceso arranca igual (el outbox de Sheets guarda
+# las filas hasta que vuelva). /healthz responde apenas el proceso vive; /readyz recién
+# cuando los componentes críticos (Redis, OpenAI, agente) están listos. Con REDIS_URL un
+# Redis caído NO se reemplaza por memoria local (cada proceso tendría su propio estado): el
+# componente queda sin listo, /readyz da 503 y el próximo uso vuelve a conectar.
+CALENTAR_AL_INICIO = os.getenv("CALENTAR_AL_INICIO", "1") == "1"
+_componentes = {}   # nombre → _Perezoso
+
+
+class _Perezoso:
+    """Crea fabrica() en el primer uso y delega en el objeto creado (atributos y métodos).
+
+    Si la fábrica falla la excepción se propaga y el próximo uso vuelve a intentarlo.
+    """
+    def __init__(self, nombre, fabrica, critico=True):
+        self._nombre, self._fabrica, self._critico = nombre, fabrica, critico
+        self._valor = None
+        self._listo = False
+        self._error = None
+        self._segundos = None
+        self._lock = threading.Lock()
+        _componentes[nombre] = self
+
+    def obtener(self):
+        if self._listo:
+            return self._valor
+        with self._lock:
+            if not self._listo:
+                inicio = time.perf_counter()
+                try:
+                    self._valor = self._fabrica()
+                except Exception as e:
+                    self._error = str(e)
+                    print(f"[ERROR] Arranque: {self._nombre} falló tras "
+                          f"{time.perf_counter() - inicio:.2f}s: {e}")
+                    _metricas.contar("arranque_errores_total", componente=self._nombre)
+                    raise
+                self._segundos = time.perf_counter() - inicio
+                self._error, self._listo = None, True
+                print(f"[INFO] Arranque: {self._nombre} listo en {self._segundos:.2f}s")
+                _metricas.fijar("arranque_segundos", self._segundos, componente=self._nombre)
+        return self._valor
+
+    def intentar(self):
+        """obtener() sin propagar errores (para el calentamiento): True si quedó listo."""
+        try:
+            self.obtener()
+            return True
+        except Exception:
+            return False
+
+    def estado(self):
+        if self._listo:
+            return {"listo": True, "critico": self._critico, "segundos": round(self._segundos, 3)}
+        return {"listo": False, "critico": self._critico, "error": self._error}
+
+    def __getattr__(self, atributo):
+        if atributo.startswith("__"):
+            raise AttributeError(atributo)
+        return getattr(self.obtener(), atributo)
+
+
+_calentamiento = []
+_calentamiento_lock = threading.Lock()
+
+
+def _calentar():
+    inicio = time.perf_counter()
+    pendientes = [c for c in _componentes.values() if not c._listo]
+    with ThreadPoolExecutor(max_workers=max(1, len(pendientes)), thread_name_prefix="arranque") as pool:
+        listos = sum(pool.map(lambda c: c.intentar(), pendientes))
+    print(f"[INFO] Calentamiento: {listos}/{len(pendientes)} componentes listos en "
+          f"{time.perf_counter() - inicio:.2f}s.")
+    # Con el backend listo: publicar las métricas del proceso desde ya, no desde el primer webhook.
+    try:
+        _asegurar_publicador_metricas()
+    except Exception as e:
+        print("[WARN] Calentamiento: no se pudo iniciar el publicador de métricas:", e)
+
+
+def iniciar_calentamiento():
+    """Inicializa en segundo plano los componentes que aún no están listos (idempotente)."""
+    with _calentamiento_lock:
+        if _calentamiento and _calentamiento[-1].is_alive():
+            return
+        hilo = threading.Thread(target=_calentar, name="calentamiento", daemon=True)
+        hilo.start()
+        _calentamiento[:] = [hilo]
+    # Filas que quedaron en el outbox de un proceso anterior: se suben sin esperar a una nueva.
+    _asegurar_flusher()
+
+
+def componentes_listos():
+    """(todos los críticos listos, estado por componente)."""
+    estado = {nombre: c.estado() for nombre, c in _componentes.items()}
+    return all(e["listo"] for e in estado.values() if e["critico"]), estado
+
+
+def _opciones_redis():
+    kwargs = {"decode_responses": True}
+    if REDIS_URL.startswith("rediss://"):
+        kwargs["ssl_cert_reqs"] = None  # Heroku Redis: TLS con cert autofirmado
+    return kwargs
 
 
 def _conectar_backend():
-    """Conecta a Redis si hay REDIS_URL; si falla o no está, cae a memoria local."""
+    """Conecta a Redis si hay REDIS_URL (si falla, la excepción se propaga y _Perezoso lo
+    reintenta en el próximo uso); sin REDIS_URL usa memoria local."""
     if REDIS_URL:
-        try:
-            import redis
-            kwargs = {"decode_responses": True}
-            if REDIS_URL.startswith("rediss://"):
-                kwargs["ssl_cert_reqs"] = None  # Heroku Redis: TLS con cert autofirmado
-            cliente = redis.from_url(REDIS_URL, **kwargs)
-            cliente.ping()
-            print("[INFO] Persistencia: Redis conectado.")
-            return cliente
-        except Exception as e:
-            print("[ERROR] No se pudo conectar a Redis; usando memoria local:", e)
-            return _MemoriaLocal()
+        import redis
+        cliente = redis.from_url(REDIS_URL, **_opciones_redis())
+        cliente.ping()
+        print("[INFO] Persistencia: Redis conectado.")
+        return cliente
     print("[WARN] REDIS_URL no definido — usando memoria local (NO persiste reinicios).")
     return _MemoriaLocal()
 
 
-_backend = _conectar_backend()
+_backend = _Perezoso("redis", _conectar_backend)
 
 
-def cargar_contexto(phone):
-    """Devuelve el contexto del usuario desde el backend (o None si no existe/expiró)."""
-    raw = _backend.get(CTX_PREFIX + phone)
-    if not raw:
-        return None
+# Cliente para el pipeline asíncrono (ver procesar_mensaje_async): redis.asyncio contra el
+# mismo Redis, o una fachada async de la misma _MemoriaLocal si no hay Redis.
+class _MemoriaAsync:
+    """Fachada async de _MemoriaLocal: sus operaciones son en memoria (micro-segundos) y se
+    ejecutan directo en el loop; solo la espera de un lock va a un hilo."""
+    def __init__(self, memoria):
+        self._memoria = memoria
+
+    def pipeline(self, transaction=True):
+        return _PipelineMemoriaAsync(self._memoria.pipeline(transaction))
+
+    def lock(self, nombre, **kwargs):
+        return _LockMemoriaAsync(self._memoria.lock(nombre, **kwargs))
+
+    def __getattr__(self, nombre):
+        metodo = getattr(self._memoria, nombre)
+
+        async def llamar(*args, **kwargs):
+            return metodo(*args, **kwargs)
+        return llamar
+
+
+class _PipelineMemoriaAsync:
+    """Como en redis.asyncio: los comandos se encolan sin await y execute() es awaitable."""
+    def __init__(self, pipe):
+        self._pipe = pipe
+
+    def __getattr__(self, nombre):
+        return getattr(self._pipe, nombre)
+
+    async def execute(self):
+        return self._pipe.execute()
+
+
+class _LockMemoriaAsync:
+    def __init__(self, lock):
+        self._lock = lock
+
+    async def acquire(self):
+        return await asyncio.to_thread(self._lock.acquire)
+
+    async def release(self):
+        self._lock.release()
+
+    async def reacquire(self):
+        return self._lock.reacquire()
+
+
+def _conectar_backend_async():
+    backend = _backend.obtener()
+    if isinstance(backend, _MemoriaLocal):
+        return _MemoriaAsync(backend)
+    import redis.asyncio
+    return redis.asyncio.from_url(REDIS_URL, **_opciones_redis())
+
+
+_backend_async = _Perezoso("redis_async", _conectar_backend_async, critico=False)
+
+
+# Los campos de perfil / embudo viven en un HASH aparte (`perfil:<phone>`) y se actualizan
+# campo a campo con HSET: fijar el nombre o el día ya no obliga a leer, parsear y reescribir
+# todo el historial. El resto del contexto (historial, timestamps…) sigue en `ctx:<phone>`.
+# Los contextos antiguos (todo en un único JSON) se migran al hash la primera vez que se leen.
+PERFIL_PREFIX = "perfil:"
+CAMPOS_PERFIL = ("nombre", "disciplina_raw", "turno_raw", "dia_raw", "tema", "last_seen")
+# El historial es una LISTA Redis acotada (`hist:<phone>`): cada turno hace RPUSH + LTRIM a
+# MAX_TURNOS * 2 (+ EXPIRE) en el mismo pipeline, es decir O(1) bytes escritos por turno en vez
+# de reescribir todo el historial; para armar el prompt se lee con un único LRANGE.
+HIST_PREFIX = "hist:"
+
+
+def _perfil_desde_hash(crudo):
+    perfil = dict(crudo or {})
+    if "last_seen" in perfil:
+        try:
+            perfil["last_seen"] = float(perfil["last_seen"])
+        except (TypeError, ValueError):
+            perfil.pop("last_seen")
+    return perfil
+
+
+def _perfil_para_hash(datos):
+    return {k: str(datos[k]) for k in CAMPOS_PERFIL if datos.get(k) not in (None, "")}
+
+
+# ---------------------------------------------
+# ✅ Codec de los valores guardados (payload del contexto e items del historial)
+# ---------------------------------------------
+# El historial repite una y otra vez los mismos textos largos del bot (bienvenida, respuestas
+# directas, menú) y se guarda 90 días. Cada valor se serializa (JSON compacto, o msgpack) y se
+# comprime con zlib (o zstd) usando un DICCIONARIO COMPARTIDO armado con esos textos: hasta un
+# mensaje corto se comprime bien porque sus frases ya están en él (ver bench_codec.py: ~3x
+# menos bytes por contexto; zlib gana a zstd en valores tan cortos). msgpack y zstd son
+# opcionales y solo se usan si se piden: todos los procesos deben poder leer lo que se escribe.
+# Formato: "~1" + serializador (j|m) + compresor (z|s) + id del diccionario (8 hex) + datos en
+# base85 (el cliente Redis trabaja con str: decode_responses=True). Lo que no empieza con "~"
+# es JSON plano: los valores antiguos y los que comprimidos no quedan más cortos. Cada
+# diccionario se publica en el backend (`codec:dic:<id>`) para poder seguir leyendo valores
+# escritos antes de editar los textos.
+CODEC_COMPRESOR = os.getenv("CODEC_COMPRESOR", "zlib")          # zlib | zstd | ninguno
+CODEC_SERIALIZADOR = os.getenv("CODEC_SERIALIZADOR", "json")    # json | msgpack
+CODEC_MIN_BYTES = 48        # por debajo, el JSON plano siempre gana
+CODEC_DIC_PREFIX = "codec:dic:"
+CODEC_NIVEL_ZLIB = 9
+CODEC_NIVEL_ZSTD = 12
+
+_codec = {}                      # "ser", "comp", "id": configuración resuelta en el primer uso
+_diccionarios = {}               # id -> bytes del diccionario
+_codec_lock = threading.Lock()
+_codec_hilo = threading.local()  # compresores zstd por hilo (no son thread-safe)
+
+
+def _textos_diccionario():
+    """Textos que más se repiten en los valores guardados; zlib prioriza los del final."""
+    textos = [MENU_BODY, SYSTEM_PROMPT[:2000]]
+    textos += [chunk for chunks in respuestas_directas.values() for chunk in chunks]
+    textos += [construir_bienvenida(), '{"role":"user","content":"', '{"role":"assistant","content":"']
+    return textos
+
+
+def _resolver_codec():
+    with _codec_lock:
+        if _codec:
+            return _codec
+        ser, comp = CODEC_SERIALIZADOR, CODEC_COMPRESOR
+        if ser == "msgpack":
+            try:
+                import msgpack  # noqa: F401
+            except ImportError:
+                print("[WARN] Codec: msgpack no está instalado; se usa JSON.")
+                ser = "json"
+        if comp == "zstd":
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                print("[WARN] Codec: zstandard no está instalado; se usa zlib.")
+                comp = "zlib"
+        dic = "\n".join(_textos_diccionario()).encode("utf-8")[-32768:]  # ventana máx. de zlib
+        dic_id = f"{zlib.adler32(dic):08x}"
+        _diccionarios[dic_id] = dic
+        try:
+            _backend.set(CODEC_DIC_PREFIX + dic_id, base64.b85encode(dic).decode("ascii"), nx=True)
+        except Exception as e:
+            print("[WARN] Codec: no se pudo publicar el diccionario:", e)
+        _codec.update(ser=ser[0], comp={"zstd": "s", "zlib": "z"}.get(comp, "n"), id=dic_id)
+        print(f"[INFO] Codec de contexto: {ser} + {comp} (diccionario {dic_id}, {len(dic)} bytes).")
+        return _codec
+
+
+def _diccionario(dic_id):
+    dic = _diccionarios.get(dic_id)
+    if dic is None:
+        crudo = _backend.get(CODEC_DIC_PREFIX + dic_id)
+        if not crudo:
+            raise ValueError(f"diccionario de codec desconocido: {dic_id}")
+        dic = _diccionarios[dic_id] = base64.b85decode(crudo)
+    return dic
+
+
+def _ids_diccionario(valores):
+    """Ids de diccionario que usan los valores codificados de `valores`."""
+    return {v[4:12] for v in valores if v and v.startswith("~1") and len(v) >= 12}
+
+
+def _preparar_codec(valores=()):
+    """Resuelve el codec y carga los diccionarios que usan `valores` (lo que falte, del backend)."""
+    _codec or _resolver_codec()
+    for dic_id in _ids_diccionario(valores):
+        try:
+            _diccionario(dic_id)
+        except ValueError:
+            pass  # decodificar() lo informa al leer el valor
+
+
+async def _preparar_codec_async(valores=()):
+    """_preparar_codec para el pipeline asíncrono: si codificar o decodificar `valores` iría al
+    backend (codec sin resolver, diccionario antiguo sin cargar), eso corre en un hilo."""
+    if not _codec or not _ids_diccionario(valores) <= _diccionarios.keys():
+        await asyncio.to_thread(_preparar_codec, valores)
+
+
+def _zstd(tipo, dic_id):
+    """ZstdCompressor / ZstdDecompressor con el diccionario, uno por hilo y diccionario."""
+    import zstandard
+    clave = (tipo, dic_id)
+    cache = getattr(_codec_hilo, "zstd", None)
+    if cache is None:
+        cache = _codec_hilo.zstd = {}
+    if clave not in cache:
+        dic = zstandard.ZstdCompressionDict(_diccionario(dic_id), dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+        cache[clave] = (zstandard.ZstdCompressor(level=CODEC_NIVEL_ZSTD, dict_data=dic,
+                                                 write_checksum=False, write_content_size=True)
+                        if tipo == "c" else zstandard.ZstdDecompressor(dict_data=dic))
+    return cache[clave]
+
+
+def codificar(obj):
+    """Valor (dict/list) → str para Redis: comprimido con encabezado, o JSON compacto."""
+    texto = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    tam = len(texto.encode("utf-8"))
+    if tam < CODEC_MIN_BYTES:
+        return texto
+    codec = _codec or _resolver_codec()
+    if codec["comp"] == "n":
+        return texto
+    if codec["ser"] == "m":
+        import msgpack
+        crudo = msgpack.packb(obj, use_bin_type=True)
+    else:
+        crudo = texto.encode("utf-8")
+    if codec["comp"] == "s":
+        datos = _zstd("c", codec["id"]).compress(crudo)
+    else:
+        c = zlib.compressobj(CODEC_NIVEL_ZLIB, zlib.DEFLATED, -15, 9, zdict=_diccionarios[codec["id"]])
+        datos = c.compress(crudo) + c.flush()
+    valor = f"~1{codec['ser']}{codec['comp']}{codec['id']}" + base64.b85encode(datos).decode("ascii")
+    return valor if len(valor) < tam else texto
+
+
+def decodificar(valor):
+    """Inversa de codificar(); también lee el JSON plano de siempre. ValueError si no puede."""
+    if not valor.startswith("~"):
+        return json.loads(valor)
+    if valor[1] != "1" or len(valor) < 12:
+        raise ValueError(f"encabezado de codec desconocido: {valor[:12]!r}")
+    ser, comp, dic_id = valor[2], valor[3], valor[4:12]
     try:
-        return json.loads(raw)
-    except (ValueError, TypeError):
+        datos = base64.b85decode(valor[12:])
+        if comp == "s":
+            crudo = _zstd("d", dic_id).decompress(datos)
+        elif comp == "z":
+            d = zlib.decompressobj(-15, zdict=_diccionario(dic_id))
+            crudo = d.decompress(datos) + d.flush()
+        else:
+            raise ValueError(f"compresor desconocido: {comp!r}")
+        if ser == "m":
+            import msgpack
+            return msgpack.unpackb(crudo, raw=False)
+        return json.loads(crudo)
+    except ValueError:
+        raise
+    except Exception as e:  # zlib.error, zstd.ZstdError, ImportError, msgpack…
+        raise ValueError(f"valor ilegible ({e})") from e
+
+
+def _decodificar_historial(crudos):
+    """Items de la lista `hist:` decodificados; los ilegibles se descartan con un aviso."""
+    historial = []
+    for it in crudos:
+        try:
+            historial.append(decodificar(it))
+        except ValueError as e:
+            print("[WARN] Mensaje del historial descartado:", e)
+    return historial
+
+
+def _armar_contexto(phone, raw, perfil, historial):
+    """Combina payload, hash de perfil y lista de historial leídos en un ctx (None si no hay
+    nada). Los contextos antiguos (todo en un único JSON) se migran aparte: ver
+    _pedir_migracion."""
+    ctx = None
+    if raw:
+        try:
+            ctx = decodificar(raw)
+        except (ValueError, TypeError) as e:
+            print(f"[WARN] Contexto de {phone} ilegible; se descarta:", e)
+            ctx = None
+    if not (ctx or perfil or historial):
         return None
+    ctx = ctx or {}
+    if historial:
+        ctx["history"] = _decodificar_historial(historial)
+    if perfil:
+        ctx.update(_perfil_desde_hash(perfil))
+    return ctx
+
+
+def _pedir_migracion(pipe, phone, ctx, perfil, historial):
+    """Encola en `pipe` la migración de un contexto antiguo (todo en un único JSON): historial
+    a la lista y perfil al hash. Devuelve False si no hay nada que migrar."""
+    if ctx is None:
+        return False
+    pedido = False
+    if not historial and ctx.get("history"):
+        _agregar_historial(pipe, phone, ctx["history"], ejecutar=False)
+        pedido = True
+    legado = {} if perfil else _perfil_para_hash(ctx)
+    if legado:
+        pipe.hset(PERFIL_PREFIX + phone, mapping=legado)
+        pipe.expire(PERFIL_PREFIX + phone, TTL_SEGUNDOS)
+        pedido = True
+    return pedido
+
+
+def _migrar_contexto(phone, ctx, perfil, historial):
+    pipe = _backend.pipeline()
+    if _pedir_migracion(pipe, phone, ctx, perfil, historial):
+        pipe.execute()
+        _contar_viaje_redis()
+
+
+async def _migrar_contexto_async(phone, ctx, perfil, historial):
+    pipe = _backend_async.pipeline()
+    if _pedir_migracion(pipe, phone, ctx, perfil, historial):
+        await pipe.execute()
+        _contar_viaje_redis()
+
+
+def cargar_contexto(phone):
+    """Devuelve el contexto del usuario (payload + perfil + historial) o None si no existe/expiró.
+
+    Payload, hash de perfil y lista de historial se leen en un único viaje (pipeline); dentro
+    de un mensaje en curso se sirve desde su _ContextoPeticion, sin ir a Redis.
+    """
+    peticion = _peticion_para(phone)
+    if peticion is not None:
+        return peticion.contexto()
+    with medir("redis_segundos", op="carga_contexto"):
+        pipe = _backend.pipeline()
+        pipe.get(CTX_PREFIX + phone)
+        pipe.hgetall(PERFIL_PREFIX + phone)
+        pipe.lrange(HIST_PREFIX + phone, 0, -1)
+        raw, perfil, historial = pipe.execute()
+    _contar_viaje_redis()
+    ctx = _armar_contexto(phone, raw, perfil, historial)
+    _migrar_contexto(phone, ctx, perfil, historial)
+    return ctx
 
 
-def guardar_contexto(phone, ctx):
-    """Persiste el contexto con TTL largo (renueva la expiración en cada escritura)."""
-    _backend.setex(CTX_PREFIX + phone, TTL_SEGUNDOS, json.dumps(ctx, ensure_ascii=False))
+def _agregar_historial(destino, phone, mensajes, ejecutar=True):
+    """RPUSH + LTRIM + EXPIRE de mensajes nuevos del historial sobre un pipeline (o lo crea)."""
+    pipe = destino if not ejecutar else destino.pipeline()
+    clave = HIST_PREFIX + phone
+    pipe.rpush(clave, *(codificar(m) for m in mensajes))
+    pipe.ltrim(clave, -(MAX_TURNOS * 2), -1)
+    pipe.expire(clave, TTL_SEGUNDOS)
+    if ejecutar:
+        pipe.execute()
 
 
-def marcar_bienvenido(phone):
-    """Marca (con TTL largo) que el usuario ya recibió la bienvenida, para no repetirla."""
-    _backend.setex(BIENVENIDO_PREFIX + phone, BIENVENIDO_TTL, "1")
+def _escribir_contexto(pipe, phone, ctx, nuevos, perfil):
+    """Encola en `pipe` el payload (SETEX), los campos `perfil` (HSET), los mensajes `nuevos`
+    del historial y la renovación de TTL de las tres claves."""
+    payload = {k: v for k, v in ctx.items() if k not in CAMPOS_PERFIL and k != "history"}
+    pipe.setex(CTX_PREFIX + phone, TTL_SEGUNDOS, codificar(payload))
+    if perfil:
+        pipe.hset(PERFIL_PREFIX + phone, mapping=perfil)
+    pipe.expire(PERFIL_PREFIX + phone, TTL_SEGUNDOS)
+    if nuevos:
+        _agregar_historial(pipe, phone, nuevos, ejecutar=False)
+    else:
+        pipe.expire(HIST_PREFIX + phone, TTL_SEGUNDOS)
+
+
+def guardar_contexto(phone, ctx, nuevos=()):
+    """Persiste el contexto con TTL largo (renueva la expiración en cada escritura).
+
+    El payload va a `ctx:`, los campos de perfil al hash y `nuevos` (mensajes a agregar al
+    historial) a la lista, todo en una sola transacción. ctx["history"] NO se reescribe.
+    Dentro de un mensaje en curso solo se anota en su _ContextoPeticion (se escribe al final).
+    """
+    peticion = _peticion_para(phone)
+    if peticion is not None:
+        peticion.guardar(ctx, nuevos)
+        return
+    with medir("redis_segundos", op="guardado_contexto"):
+        pipe = _backend.pipeline()
+        _escribir_contexto(pipe, phone, ctx, nuevos, _perfil_para_hash(ctx))
+        pipe.execute()
+    _contar_viaje_redis()
+
+
+def actualizar_perfil(phone, **campos):
+    """HSET atómico de campos de perfil + renovación de TTL, en un solo viaje a Redis.
+
+    Devuelve el perfil completo tras la actualización (útil para registrar en Sheets).
+    """
+    peticion = _peticion_para(phone)
+    if peticion is not None:
+        return peticion.actualizar_perfil(**campos)
+    perfil = _perfil_para_hash(campos)
+    with medir("redis_segundos", op="actualizar_perfil"):
+        pipe = _backend.pipeline()
+        if perfil:
+            pipe.hset(PERFIL_PREFIX + phone, mapping=perfil)
+        pipe.expire(PERFIL_PREFIX + phone, TTL_SEGUNDOS)
+        pipe.expire(CTX_PREFIX + phone, TTL_SEGUNDOS)
+        pipe.expire(HIST_PREFIX + phone, TTL_SEGUNDOS)
+        pipe.hgetall(PERFIL_PREFIX + phone)
+        resultado = pipe.execute()
+    _contar_viaje_redis()
+    return _perfil_desde_hash(resultado[-1])
+
+
+def leer_campo_perfil(phone, campo):
+    peticion = _peticion_para(phone)
+    if peticion is not None:
+        return _perfil_para_hash(peticion.ctx or {}).get(campo)
+    _contar_viaje_redis()
+    with medir("redis_segundos", op="leer_perfil"):
+        return _backend.hget(PERFIL_PREFIX + phone, campo)
 
 
 def ya_bienvenido(phone):
+    peticion = _peticion_para(phone)
+    if peticion is not None:
+        return peticion.bienvenido
+    _contar_viaje_redis()
     return bool(_backend.get(BIENVENIDO_PREFIX + phone))
 
+
+# Bienvenida atómica: decidir "¿es nuevo?" leyendo y luego marcar es un check-then-set; dos
+# primeros mensajes casi simultáneos ("Hola" y enseguida la pregunta), o en dos dynos, lo
+# pasaban ambos y el usuario recibía dos bienvenidas y dos filas "[NUEVO USUARIO]". La
+# decisión la toma ahora UN script: SET NX de la marca y, solo si gana y el teléfono no tiene
+# contexto, siembra payload, perfil e historial y encola la fila del outbox — un viaje a
+# Redis. La carga de la petición ya filtra a los usuarios conocidos: solo quien parece nuevo
+# paga el script. Devuelve 0 si no corresponde bienvenida o el largo del outbox si ganó.
+SCRIPT_BIENVENIDA = """
+if not redis.call("SET", KEYS[1], "1", "NX", "EX", ARGV[1]) then return 0 end
+if redis.call("EXISTS", KEYS[2], KEYS[3], KEYS[4]) > 0 then return 0 end
+redis.call("SET", KEYS[2], ARGV[3], "EX", ARGV[2])
+redis.call("RPUSH", KEYS[4], ARGV[4])
+redis.call("EXPIRE", KEYS[4], ARGV[2])
+if #ARGV > 5 then
+    redis.call("HSET", KEYS[3], unpack(ARGV, 6))
+    redis.call("EXPIRE", KEYS[3], ARGV[2])
+end
+return redis.call("RPUSH", KEYS[5], ARGV[5])
+"""
+
+
+def _pedir_bienvenida(phone, user_msg, ahora):
+    """(keys, args, ctx sembrado, perfil, fila) para SCRIPT_BIENVENIDA."""
+    bienvenida = construir_bienvenida()
+    ctx = {"last_seen": ahora, "timestamp": ahora, "tema": "nuevo",
+           "history": [{"role": "assistant", "content": bienvenida}]}
+    perfil = _perfil_para_hash(ctx)
+    payload = {k: v for k, v in ctx.items() if k not in CAMPOS_PERFIL and k != "history"}
+    fila = [phone, f"[NUEVO USUARIO] {user_msg}", time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())]
+    keys = [BIENVENIDO_PREFIX + phone, CTX_PREFIX + phone, PERFIL_PREFIX + phone,
+            HIST_PREFIX + phone, OUTBOX_PREFIX + "Interesados"]
+    args = [BIENVENIDO_TTL, TTL_SEGUNDOS, codificar(payload), codificar(ctx["history"][0]),
+            json.dumps(fila, ensure_ascii=False)]
+    for campo, valor in perfil.items():
+        args += [campo, valor]
+    return keys, args, ctx, perfil, fila
+
+
+def _bienvenida_reclamada(phone, resultado, ctx, perfil, fila):
+    """Refleja en la petición lo que sembró el script; devuelve el texto de bienvenida o None."""
+    _contar_viaje_redis()
+    if not resultado:
+        return None
+    peticion = _peticion_para(phone)
+    if peticion is not None:
+        peticion.bienvenido = True
+        peticion.ctx = dict(ctx)
+        peticion._perfil_guardado = dict(perfil)
+    _filas_encoladas([("Interesados", fila)], [resultado])
+    return ctx["history"][0]["content"]
+
+
+def reclamar_bienvenida(phone, user_msg, ahora):
+    """Decide y registra atómicamente la bienvenida de `phone`: el texto a enviar si esta
+    llamada la ganó, o None (ya saludado, contexto existente u otro mensaje se adelantó)."""
+    keys, args, ctx, perfil, fila = _pedir_bienvenida(phone, user_msg, ahora)
+    backend = _backend.obtener()
+    with medir("redis_segundos", op="reclamar_bienvenida"):
+        if isinstance(backend, _MemoriaLocal):
+            resultado = backend.reclamar_bienvenida(keys, args)
+        else:
+            resultado = backend.register_script(SCRIPT_BIENVENIDA)(keys=keys, args=args)
+    return _bienvenida_reclamada(phone, resultado, ctx, perfil, fila)
+
+
+async def reclamar_bienvenida_async(phone, user_msg, ahora):
+    await _preparar_codec_async()
+    keys, args, ctx, perfil, fila = _pedir_bienvenida(phone, user_msg, ahora)
+    with medir("redis_segundos", op="reclamar_bienvenida"):
+        if isinstance(_backend_async.obtener(), _MemoriaAsync):
+            resultado = await _backend_async.reclamar_bienvenida(keys, args)
+        else:
+            resultado = await _backend_async.register_script(SCRIPT_BIENVENIDA)(keys=keys, args=args)
+    return _bienvenida_reclamada(phone, resultado, ctx, perfil, fila)
+
+
+def _parece_nuevo(phone):
+    """Sin marca de bienvenida ni contexto según la petición ya cargada (sin viajes a Redis)."""
+    return not ya_bienvenido(phone) and cargar_contexto(phone) is None
+
+
+# ---------------------------------------------
+# ✅ Unidad de trabajo por mensaje (contexto en memoria durante la petición)
+# ---------------------------------------------
+# Un mismo mensaje consultaba varias veces las mismas claves: bienvenida + contexto para
+# detectar usuarios nuevos, el saludo, cada tool del agente y la recarga tras el agente.
+# _ContextoPeticion las lee UNA vez al empezar (bandera de bienvenida y payload con un MGET,
+# más perfil e historial, en un único pipeline), sirve todas las lecturas posteriores desde
+# memoria y al terminar escribe solo lo modificado, en un único pipeline. Vive en un
+# contextvar: las tools del agente (que corren en el loop de asyncio o en to_thread) heredan
+# la petición del mensaje que las disparó.
+_peticion_actual = contextvars.ContextVar("peticion_actual", default=None)
+
+
+def _peticion_para(phone):
+    """La petición en curso si ya cargó el contexto de `phone`; si no, None (ir a Redis)."""
+    peticion = _peticion_actual.get()
+    if peticion is not None and peticion.cargada and peticion.phone == phone:
+        return peticion
+    return None
+
+
+def _contar_viaje_redis():
+    """Suma un viaje a Redis a la petición en curso (métrica redis_viajes_por_mensaje)."""
+    peticion = _peticion_actual.get()
+    if peticion is not None:
+        peticion.viajes += 1
+
+
+class _ContextoPeticion:
+    """Context manager: carga el contexto de `phone` al entrar y escribe los cambios al salir.
+
+    Además cuenta los viajes a Redis de todo el mensaje (dedup, lock, outbox…) mientras
+    esté activo en `_peticion_actual`, aunque todavía no haya cargado.
+    """
+    def __init__(self, phone):
+        self.phone = phone
+        self.viajes = 0
+        self.cargada = False
+        self.bienvenido = False
+        self.ctx = None
+        self._perfil_guardado = {}   # campos tal como están en el hash (para escribir solo cambios)
+        self._historial_nuevo = []
+        self._sucio = False
+        self.filas = []              # (hoja, fila) para el outbox de Sheets, van en el mismo pipeline
+        self.wamid = None            # reclamado "en proceso"; el guardado de un mensaje exitoso lo confirma
+        self.anulada = False         # el lock del teléfono se perdió: no se escribe el contexto
+        self._exito = False
+        self.etapas = _GrafoEtapas(phone)
+
+    def _pedir_carga(self, pipe):
+        pipe.mget([BIENVENIDO_PREFIX + self.phone, CTX_PREFIX + self.phone])
+        pipe.hgetall(PERFIL_PREFIX + self.phone)
+        pipe.lrange(HIST_PREFIX + self.phone, 0, -1)
+
+    def _cargar(self, resultados):
+        (bienvenido, raw), perfil, historial = resultados
+        self.viajes += 1
+        self.bienvenido = bool(bienvenido)
+        self.ctx = _armar_contexto(self.phone, raw, perfil, historial)
+        self._perfil_guardado = dict(perfil) or _perfil_para_hash(self.ctx or {})
+        self.cargada = True
+        return self
+
+    def __enter__(self):
+        with self.etapas.etapa("carga"), medir("redis_segundos", op="carga_peticion"):
+            pipe = _backend.pipeline(transaction=False)
+            self._pedir_carga(pipe)
+            resultados = pipe.execute()
+            self._cargar(resultados)
+            _migrar_contexto(self.phone, self.ctx, *resultados[1:])
+        return self
+
+    def __exit__(self, *exc):
+        # También si el mensaje falló a mitad: lo ya hecho (p. ej. el mensaje del usuario en el
+        # historial) se persiste igual que cuando cada paso escribía directo en Redis.
+        self._exito = exc[0] is None
+        try:
+            with self.etapas.etapa("guardado"):
+                self.guardar_cambios()
+        finally:
+            self.cargada = False
+        return False
+
+    async def __aenter__(self):
+        with self.etapas.etapa("carga"), medir("redis_segundos", op="carga_peticion"):
+            pipe = _backend_async.pipeline(transaction=False)
+            self._pedir_carga(pipe)
+            resultados = await pipe.execute()
+            (_, raw), _, historial = resultados
+            await _preparar_codec_async([raw, *historial])
+            self._cargar(resultados)
+            await _migrar_contexto_async(self.phone, self.ctx, *resultados[1:])
+        return self
+
+    async def __aexit__(self, *exc):
+        self._exito = exc[0] is None
+        try:
+            with self.etapas.etapa("guardado"):
+                await self.guardar_cambios_async()
+        finally:
+            self.cargada = False
+        return False
+
+    def contexto(self):
+        """Copia del contexto (None si no existe): el llamador la modifica y la guarda."""
+        if self.ctx is None:
+            return None
+        ctx = dict(self.ctx)
+        ctx["history"] = list(self.ctx.get("history", []))
+        return ctx
+
+    def guardar(self, ctx, nuevos=()):
+        historial = (self.ctx or {}).get("history", []) + list(nuevos)
+        self.ctx = {k: v for k, v in ctx.items() if k != "history"}
+        self.ctx["history"] = historial[-(MAX_TURNOS * 2):]
+        self._historial_nuevo.extend(nuevos)
+        self._sucio = True
+
+    def actualizar_perfil(self, **campos):
+        if self.ctx is None:
+            self.ctx = {"history": []}
+        self.ctx.update(_perfil_desde_hash(_perfil_para_hash(campos)))
+        self._sucio = True
+        return _perfil_desde_hash(_perfil_para_hash(self.ctx))
+
+    def anular(self):
+        """El lease del lock venció a mitad del mensaje: otro proceso pudo leer el contexto, así
+        que escribir el nuestro pisaría el suyo. Las filas del outbox sí salen (solo agregan)."""
+        self.anulada = True
+
+    def _pedir_guardado(self, pipe):
+        """Encola en `pipe` lo modificado; devuelve los campos de perfil que se escriben."""
+        perfil = {}
+        if self.anulada and self._sucio:
+            print(f"[WARN] Petición de {self.phone} anulada (lock perdido): no se guarda el contexto.")
+            _metricas.contar("peticiones_anuladas_total")
+            self._sucio = False
+        if self._sucio and self.ctx is not None:
+            perfil = {k: v for k, v in _perfil_para_hash(self.ctx).items()
+                      if self._perfil_guardado.get(k) != v}
+            _escribir_contexto(pipe, self.phone, self.ctx, self._historial_nuevo, perfil)
+        if self._confirma_wamid():
+            pipe.set(WAMID_PREFIX + self.wamid, "1", ex=WAMID_TTL)
+        for hoja, fila in self.filas:
+            pipe.rpush(OUTBOX_PREFIX + hoja, json.dumps(fila, ensure_ascii=False))
+        return perfil
+
+    def _guardado(self, perfil, resultados):
+        self.viajes += 1
+        self._perfil_guardado.update(perfil)
+        self._historial_nuevo = []
+        self._sucio = False
+        if self._confirma_wamid():
+            self.wamid = None
+        filas, self.filas = self.filas, []
+        if filas:
+            _filas_encoladas(filas, resultados[-len(filas):])
+
+    def _sacar_filas(self):
+        """Si el pipeline falló, las filas van directo a Sheets (como en _encolar_fila)."""
+        filas, self.filas = self.filas, []
+        for hoja, fila in filas:
+            _escribir_fila_directo(hoja, fila)
+
+    def _confirma_wamid(self):
+        return self.wamid is not None and self._exito
+
+    def guardar_cambios(self):
+        """Un único pipeline con lo modificado durante el mensaje (nada si no hubo cambios)."""
+        if not (self._sucio or self.filas or self._confirma_wamid()):
+            return
+        with medir("redis_segundos", op="guardado_peticion"):
+            pipe = _backend.pipeline()
+            perfil = self._pedir_guardado(pipe)
+            try:
+                resultados = pipe.execute()
+            except Exception:
+                self._sacar_filas()
+                raise
+        self._guardado(perfil, resultados)
+
+    async def guardar_cambios_async(self):
+        if not (self._sucio or self.filas or self._confirma_wamid()):
+            return
+        await _preparar_codec_async()
+        with medir("redis_segundos", op="guardado_peticion"):
+            pipe = _backend_async.pipeline()
+            perfil = self._pedir_guardado(pipe)
+            try:
+                resultados = await pipe.execute()
+            except Exception:
+                await asyncio.to_thread(self._sacar_filas)
+                raise
+        self._guardado(perfil, resultados)
+
+
+# ---------------------------------------------
+# ✅ Grafo de etapas por mensaje (qué corre en paralelo y cuánto tarda cada paso)
+# ---------------------------------------------
+# Cada mensaje registra sus etapas en peticion.etapas: las del camino crítico corren en línea
+# (dedup, bloqueo, carga, agente, guardado); las demás se lanzan en paralelo apenas
+# terminan sus dependencias (transcripción junto al bloqueo y la carga; compactación después
+# del guardado) o son Futures que ya corren solos (indicador de escritura, envíos al usuario
+# y avisos al staff por el planificador). Que una dependencia falle no frena a las que
+# dependen de ella: son efectos secundarios, no datos. Al cerrar el mensaje se registra la
+# línea de tiempo (log, histograma etapa_segundos{etapa} y /debug/etapas): cada etapa con su
+# inicio y fin relativos al mensaje y las etapas con las que se solapó.
+ETAPAS_HILOS = int(os.getenv("ETAPAS_HILOS", "8"))
+ETAPAS_HISTORIAL = int(os.getenv("ETAPAS_HISTORIAL", "50"))   # líneas de tiempo en /debug/etapas
+_pool_etapas = ThreadPoolExecutor(max_workers=ETAPAS_HILOS, thread_name_prefix="etapa")
+_lineas_de_tiempo = deque(maxlen=ETAPAS_HISTORIAL)
+
+
+class _GrafoEtapas:
+    def __init__(self, phone):
+        self.phone = phone
+        self.inicio = time.perf_counter()
+        self.fecha = time.time()
+        self.cerrado = False
+        self._tiempos = {}      # etapa → [inicio, fin, en curso, veces]
+        self._terminadas = set()
+        self._esperando = []    # (dependencias que faltan, etapa, fn, args, pool, futuro, diferida)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def etapa(self, nombre):
+        """Etapa en línea (camino crítico)."""
+        self._empezar(nombre)
+        try:
+            yield
+        finally:
+            self._terminar(nombre)
+
+    def seguir(self, nombre, futuro):
+        """Registra un Future que ya corre por su cuenta (envío, indicador, tarea asyncio)."""
+        if futuro is not None:
+            self._empezar(nombre)
+            futuro.add_done_callback(lambda f: self._terminar(nombre))
+        return futuro
+
+    def lanzar(self, nombre, fn, *args, depende=(), pool=None):
+        """Corre fn(*args) en un pool (por defecto _pool_etapas) cuando terminen las etapas
+        `depende`; devuelve un Future con su resultado.
+
+        Una etapa con `depende` puede arrancar cuando el mensaje ya terminó: corre como
+        trabajo aparte, sin petición en curso (_peticion_actual = None), para no leer ni
+        escribir en una petición cerrada (ni que un _BloqueoTelefono la anule).
+        """
+        futuro = Future()
+        diferida = bool(depende)
+        with self._lock:
+            faltan = set(depende) - self._terminadas
+            if faltan and not self.cerrado:
+                self._esperando.append((faltan, nombre, fn, args, pool, futuro, diferida))
+                return futuro
+        self._arrancar(nombre, fn, args, pool, futuro, diferida)
+        return futuro
+
+    def _arrancar(self, nombre, fn, args, pool, futuro, diferida=False):
+        self._empezar(nombre)
+        contexto = contextvars.copy_context()
+        if diferida:
+            contexto.run(_peticion_actual.set, None)
+
+        def correr():
+            try:
+                resultado, error = contexto.run(fn, *args), None
+            except Exception as e:
+                resultado, error = None, e
+            self._terminar(nombre)
+            if error is not None:
+                futuro.set_exception(error)
+            else:
+                futuro.set_result(resultado)
+        (pool or _pool_etapas).submit(correr)
+
+    def _empezar(self, nombre):
+        with self._lock:
+            tiempos = self._tiempos.get(nombre)
+            if tiempos is None:
+                self._tiempos[nombre] = [time.perf_counter(), None, 1, 1]
+            else:
+                tiempos[2] += 1
+                tiempos[3] += 1
+
+    def _terminar(self, nombre):
+        listas = []
+        with self._lock:
+            tiempos = self._tiempos[nombre]
+            tiempos[1] = time.perf_counter()
+            tiempos[2] -= 1
+            if tiempos[2] > 0:
+                return
+            self._terminadas.add(nombre)
+            for pendiente in list(self._esperando):
+                pendiente[0].discard(nombre)
+                if not pendiente[0]:
+                    self._esperando.remove(pendiente)
+                    listas.append(pendiente)
+            if self.cerrado:
+                _metricas.observar("etapa_segundos", tiempos[1] - tiempos[0], etapa=nombre)
+        for _, etapa, fn, args, pool, futuro, diferida in listas:
+            self._arrancar(etapa, fn, args, pool, futuro, diferida)
+
+    def cerrar(self):
+        """Fin del mensaje: lanza lo que quedó esperando (dependencias que no llegaron a
+        correr), observa las etapas terminadas y deja la línea de tiempo en el log."""
+        with self._lock:
+            self.cerrado = True
+            listas, self._esperando = self._esperando, []
+            for nombre, (inicio, fin, en_curso, _) in self._tiempos.items():
+                if not en_curso:
+                    _metricas.observar("etapa_segundos", fin - inicio, etapa=nombre)
+        for _, etapa, fn, args, pool, futuro, diferida in listas:
+            self._arrancar(etapa, fn, args, pool, futuro, diferida)
+        _lineas_de_tiempo.append(self)
+        if self._tiempos:
+            partes = []
+            for e in self.linea_de_tiempo()["etapas"]:
+                fin = "…" if e["fin_ms"] is None else f"{e['fin_ms']:.0f}"
+                veces = f"×{e['veces']}" if e["veces"] > 1 else ""
+                partes.append(f"{e['etapa']}{veces} {e['inicio_ms']:.0f}–{fin}"
+                              + (" ‖" if e["en_paralelo_con"] else ""))
+            print(f"[INFO] Etapas de {self.phone} (ms; ‖ = en paralelo): {', '.join(partes)}")
+
+    def linea_de_tiempo(self):
+        """{"phone", "fecha", "etapas": [{etapa, inicio_ms, fin_ms (None = en curso), veces,
+        en_paralelo_con}]} ordenadas por inicio."""
+        with self._lock:
+            tiempos = {n: list(t) for n, t in self._tiempos.items()}
+        intervalos = {n: (ini, fin if not en_curso else float("inf"))
+                      for n, (ini, fin, en_curso, _) in tiempos.items()}
+        etapas = []
+        for nombre, (inicio, fin, en_curso, veces) in sorted(tiempos.items(), key=lambda it: it[1][0]):
+            desde, hasta = intervalos[nombre]
+            etapas.append({
+                "etapa": nombre,
+                "inicio_ms": round((inicio - self.inicio) * 1000, 1),
+                "fin_ms": None if en_curso else round((fin - self.inicio) * 1000, 1),
+                "veces": veces,
+                "en_paralelo_con": [otra for otra, (ini, f) in intervalos.items()
+                                    if otra != nombre and ini < hasta and desde < f],
+            })
+        return {"phone": self.phone, "fecha": self.fecha, "etapas": etapas}
+
+
+def _etapa(nombre):
+    """Etapa en línea del mensaje en curso (nada si no hay uno)."""
+    peticion = _peticion_actual.get()
+    return peticion.etapas.etapa(nombre) if peticion is not None else contextlib.nullcontext()
+
+
+def _seguir_etapa(nombre, futuro):
+    peticion = _peticion_actual.get()
+    if peticion is not None:
+        peticion.etapas.seguir(nombre, futuro)
+    return futuro
+
+
+# ---------------------------------------------
+# ✅ Idempotencia: cada mensaje (wamid) se procesa una sola vez
+# ---------------------------------------------
+# Meta reentrega el mismo mensaje si no respondimos a tiempo (o por sus propios reintentos).
+# Antes de cualquier trabajo caro (agente, Sheets, envíos) reclamamos el wamid con un
+# SET NX + TTL atómico en el backend; si ya estaba, es una reentrega y se descarta. Un LRU
+# acotado en proceso evita incluso ese viaje a Redis para las reentregas más recientes.
+# El reclamo nace "en proceso" con un TTL corto y se confirma con el TTL largo recién cuando el
+# mensaje terminó bien (en el mismo pipeline del guardado); si el pipeline falla se borra, y si el
+# proceso muere a mitad expira solo: en ambos casos la reentrega de Meta se vuelve a atender.
+WAMID_PREFIX = "wamid:"
+WAMID_TTL = 60 * 60 * 24 * 3        # Meta reintenta durante hasta ~7 días, pero casi todo llega en horas
+WAMID_PROCESANDO_TTL = 300          # más que el peor caso de un mensaje (bloqueo + agente + envíos)
+WAMID_LRU_MAX = 5000
+
+_wamids_vistos = OrderedDict()      # wamid -> None (solo importa el orden de uso)
+_wamids_lock = threading.Lock()
+
+
+def es_mensaje_repetido(message_id):
+    """True si el wamid ya fue reclamado antes (reentrega de Meta); si no, lo reclama.
+
+    Sin wamid, o si el backend falla, se procesa igual: preferimos responder dos veces
+    a no responder nunca.
+    """
+    if not message_id:
+        return False
+    if _visto_en_lru(message_id):
+        return True
+    try:
+        nuevo = _backend.set(WAMID_PREFIX + message_id, "procesando", nx=True, ex=WAMID_PROCESANDO_TTL)
+        _contar_viaje_redis()
+    except Exception as e:
+        print("[WARN] Dedup: no se pudo consultar el backend:", e)
+        nuevo = True
+    return _recordar_wamid(message_id, nuevo)
+
+
+async def es_mensaje_repetido_async(message_id):
+    """Versión asyncio de es_mensaje_repetido."""
+    if not message_id:
+        return False
+    if _visto_en_lru(message_id):
+        return True
+    try:
+        nuevo = await _backend_async.set(WAMID_PREFIX + message_id, "procesando", nx=True, ex=WAMID_PROCESANDO_TTL)
+        _contar_viaje_redis()
+    except Exception as e:
+        print("[WARN] Dedup: no se pudo consultar el backend:", e)
+        nuevo = True
+    return _recordar_wamid(message_id, nuevo)
+
+
+def cerrar_wamid(message_id, ok):
+    """Confirma (TTL largo) o libera (DEL) un wamid reclamado que no se confirmó en el guardado."""
+    if not ok:
+        _olvidar_wamid(message_id)
+    try:
+        if ok:
+            _backend.set(WAMID_PREFIX + message_id, "1", ex=WAMID_TTL)
+        else:
+            _backend.delete(WAMID_PREFIX + message_id)
+        _contar_viaje_redis()
+    except Exception as e:
+        print("[WARN] Dedup: no se pudo cerrar el wamid:", e)
+
+
+async def cerrar_wamid_async(message_id, ok):
+    """Versión asyncio de cerrar_wamid."""
+    if not ok:
+        _olvidar_wamid(message_id)
+    try:
+        if ok:
+            await _backend_async.set(WAMID_PREFIX + message_id, "1", ex=WAMID_TTL)
+        else:
+            await _backend_async.delete(WAMID_PREFIX + message_id)
+        _contar_viaje_redis()
+    except Exception as e:
+        print("[WARN] Dedup: no se pudo cerrar el wamid:", e)
+
+
+def _olvidar_wamid(message_id):
+    with _wamids_lock:
+        _wamids_vistos.pop(message_id, None)
+
+
+def _visto_en_lru(message_id):
+    with _wamids_lock:
+        if message_id in _wamids_vistos:
+            _wamids_vistos.move_to_end(message_id)
+            _metricas.contar("dedup_total", resultado="hit", nivel="lru")
+            return True
+    return False
+
+
+def _recordar_wamid(message_id, nuevo):
+    with _wamids_lock:
+        _wamids_vistos[message_id] = None
+        _wamids_vistos.move_to_end(message_id)
+        while len(_wamids_vistos) > WAMID_LRU_MAX:
+            _wamids_vistos.popitem(last=False)
+    _metricas.contar("dedup_total", resultado="miss" if nuevo else "hit", nivel="backend")
+    return not nuevo
+
+
+def estado_dedup():
+    hits = sum(_metricas.valor("dedup_total", resultado="hit", nivel=n) for n in ("lru", "backend"))
+    return {"lru": len(_wamids_vistos), "hits": hits,
+            "misses": _metricas.valor("dedup_total", resultado="miss", nivel="backend")}
+
+
+# ---------------------------------------------
+# ✅ Bloqueo por teléfono entre procesos (lease con renovación)
+# ---------------------------------------------
+# El buzón por teléfono ordena los mensajes dentro de UN proceso; con varios workers o dynos
+# hace falta además un lock en Redis para que dos mensajes del mismo usuario no hagan
+# leer-modificar-escribir del contexto a la vez (se pisarían historial y perfil). El lock
+# tiene un lease corto que un hilo renueva mientras el mensaje se procesa: si el proceso
+# muere, el lease expira solo y el usuario no queda bloqueado.
+# Sin lock NUNCA se procesa: si no se obtiene (espera agotada o backend caído) se lanza
+# BloqueoNoObtenido y el mensaje se reencola para más tarde (ver _reencolar_sin_bloqueo). Si
+# una renovación falla, el lease pudo pasar a otro proceso: la petición en curso queda anulada
+# y su guardado no escribe el contexto (ver _ContextoPeticion.anular).
+LOCK_TEL_PREFIX = "lock:tel:"
+LOCK_TEL_LEASE = 30           # seg. de vida del lock sin renovar
+LOCK_TEL_ESPERA_MAX = 120     # seg. máx. esperando a otro proceso (luego se reencola el mensaje)
+LOCK_TEL_REENCOLAR = 3        # veces que un mensaje sin lock se reencola antes de descartarlo
+LOCK_TEL_REENCOLAR_ESPERA = 15
+
+
+class BloqueoNoObtenido(Exception):
+    pass
+
+
+class _BloqueoTelefono:
+    """Context manager: serializa el procesamiento de un teléfono entre procesos."""
+    def __init__(self, phone):
+        self.phone = phone
+        self.perdido = False
+        self._lock = None
+        self._parar = threading.Event()
+        self._peticion = _peticion_actual.get()   # la renovación corre fuera de su contexto
+
+    def __enter__(self):
+        try:
+            lock = _backend.lock(LOCK_TEL_PREFIX + self.phone, timeout=LOCK_TEL_LEASE,
+                                 blocking_timeout=LOCK_TEL_ESPERA_MAX, thread_local=False)
+            adquirido = lock.acquire()
+            _contar_viaje_redis()
+        except Exception as e:
+            raise BloqueoNoObtenido(f"lock de {self.phone} no disponible: {e}") from e
+        if not adquirido:
+            raise BloqueoNoObtenido(f"lock de {self.phone} no obtenido en {LOCK_TEL_ESPERA_MAX}s")
+        self._lock = lock
+        threading.Thread(target=self._renovar, daemon=True).start()
+        return self
+
+    def _renovar(self):
+        while not self._parar.wait(LOCK_TEL_LEASE / 3):
+            try:
+                self._lock.reacquire()
+            except Exception as e:
+                self._perder(e)
+                return
+
+    def _perder(self, error):
+        print(f"[ERROR] No se pudo renovar el lock de {self.phone}; el mensaje no guardará cambios:", error)
+        _metricas.contar("errores_total", etapa="renovar_lock")
+        self.perdido = True
+        if self._peticion is not None:
+            self._peticion.anular()
+
+    def __exit__(self, *exc):
+        self._parar.set()
+        if self._lock is not None:
+            try:
+                _contar_viaje_redis()
+                self._lock.release()
+            except Exception as e:  # lease vencido: otro proceso ya pudo tomarlo
+                print(f"[WARN] Lock de {self.phone} ya no era nuestro al liberar:", e)
+        return False
+
+    # Versión asyncio: la espera del lock y la renovación no ocupan hilos.
+    async def __aenter__(self):
+        try:
+            lock = _backend_async.lock(LOCK_TEL_PREFIX + self.phone, timeout=LOCK_TEL_LEASE,
+                                       blocking_timeout=LOCK_TEL_ESPERA_MAX, thread_local=False)
+            adquirido = await lock.acquire()
+            _contar_viaje_redis()
+        except Exception as e:
+            raise BloqueoNoObtenido(f"lock de {self.phone} no disponible: {e}") from e
+        if not adquirido:
+            raise BloqueoNoObtenido(f"lock de {self.phone} no obtenido en {LOCK_TEL_ESPERA_MAX}s")
+        self._lock = lock
+        self._renovacion = asyncio.ensure_future(self._renovar_async())
+        return self
+
+    async def _renovar_async(self):
+        while True:
+            await asyncio.sleep(LOCK_TEL_LEASE / 3)
+            try:
+                await self._lock.reacquire()
+            except Exception as e:
+                self._perder(e)
+                return
+
+    async def __aexit__(self, *exc):
+        if self._lock is not None:
+            self._renovacion.cancel()
+            try:
+                _contar_viaje_redis()
+                await self._lock.release()
+            except Exception as e:
+                print(f"[WARN] Lock de {self.phone} ya no era nuestro al liberar:", e)
+        return False
+
 # ---------------------------------------------
 # 📅 Feriados / días SIN clases de prueba
 # ---------------------------------------------
@@ -144,14 +1869,23 @@ WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
 PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 GOOGLE_SHEET_KEY = os.getenv("GOOGLE_SHEET_KEY")
-credentials_dict = json.loads(os.getenv("GOOGLE_CREDENTIALS_JSON"))
 
-# Cliente de Google Sheets
-scope = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-creds = Credentials.from_service_account_info(credentials_dict, scopes=scope)
-gs_client = gspread.authorize(creds)
-solicitudes_sheet = gs_client.open_by_key(GOOGLE_SHEET_KEY).worksheet("SolicitudesHumano")
-interesados_sheet = gs_client.open_by_key(GOOGLE_SHEET_KEY).worksheet("Interesados")
+# Cliente de Google Sheets (perezoso: ver _Perezoso)
+GOOGLE_SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+HOJAS_SHEETS = ("Interesados", "SolicitudesHumano")
+
+
+def _abrir_hojas():
+    """Login + un único open_by_key; las dos hojas salen de la misma lectura de metadata."""
+    creds = Credentials.from_service_account_info(json.loads(os.getenv("GOOGLE_CREDENTIALS_JSON")),
+                                                  scopes=GOOGLE_SCOPES)
+    planilla = gspread.authorize(creds).open_by_key(GOOGLE_SHEET_KEY)
+    hojas = {hoja.title: hoja for hoja in planilla.worksheets()}
+    return {nombre: hojas[nombre] for nombre in HOJAS_SHEETS}
+
+
+# No crítico para /readyz: sin Sheets las filas esperan en el outbox.
+_hojas = _Perezoso("sheets", _abrir_hojas, critico=False)
 
 # ---------------------------------------------
 # Respuestas directas del menú numérico (1–7)
@@ -259,6 +1993,190 @@ MENU_ROWS = [
 ]
 MENU_BODY = "📋 ¿Sobre qué te gustaría saber? Toca una opción 👇"
 
+# ---------------------------------------------
+# ✅ Router de intenciones local (antes del agente IA)
+# ---------------------------------------------
+# Solo los textos exactos "1"–"7" evitaban el agente; "cuánto cuesta", "dónde están" u
+# "horarios de bjj" pagaban varios segundos de LLM por una respuesta que ya tenemos enlatada.
+# Este clasificador mapea texto libre a las claves de `respuestas_directas` con un índice de
+# palabras clave / frases normalizado (sin tildes, minúsculas, letras repetidas colapsadas),
+# tolerante a errores de tipeo vía trigramas. Las tablas se arman UNA vez al arrancar a partir
+# de MENU_ROWS y de las palabras clave de abajo. Ante la menor duda devuelve None y el mensaje
+# sigue al agente: es preferible una respuesta lenta a una equivocada. En particular van al
+# agente los mensajes con alguna palabra que el índice no explica y los que traen un dato del
+# embudo (nombre, día, turno, disciplina: el agente lo registra en el perfil), y ningún texto
+# libre se enruta mientras el agente espera la respuesta a una pregunta del embudo.
+ROUTER_INTENCIONES = os.getenv("ROUTER_INTENCIONES", "1") == "1"
+ROUTER_UMBRAL = 1.0          # puntaje mínimo de la intención ganadora
+ROUTER_CONFIANZA_MIN = 0.6   # confianza mínima (una palabra clave sola de peso 1.0 da 0.667)
+ROUTER_MARGEN = 0.6          # la 2.ª intención debe quedar por debajo de este % de la 1.ª
+ROUTER_MAX_PALABRAS = 10     # mensajes más largos suelen traer matices: van al agente
+ROUTER_SIMILITUD = 0.5       # Jaccard de trigramas mínimo para aceptar una palabra mal escrita
+
+# Palabras clave / frases por opción del menú (ya normalizadas). Peso 1.0 = basta sola.
+PALABRAS_CLAVE_MENU = {
+    "1": {"horario": 1.0, "horarios": 1.0, "hora": 1.0, "horas": 1.0, "que dias": 1.0,
+          "a que hora": 1.0, "cuando son clases": 1.0, "cuando hay clases": 1.0, "turnos": 0.5},
+    "2": {"precio": 1.0, "precios": 1.0, "cuesta": 1.0, "cuestan": 1.0, "costo": 1.0,
+          "costos": 1.0, "cuanto": 0.6, "mensualidad": 1.0, "cobran": 1.0, "tarifa": 1.0,
+          "pagar": 0.6, "pago": 0.6, "mensual": 0.6, "cuanto sale": 1.0, "vale": 0.5},
+    "3": {"disciplinas": 1.0, "disciplina": 0.6, "que ensenan": 1.0, "que clases": 1.0,
+          "que ofrecen": 1.0, "ofrecen": 0.6, "artes marciales": 0.6, "que practican": 1.0},
+    "4": {"inscribirme": 1.0, "inscribir": 1.0, "inscripcion": 1.0, "inscripciones": 1.0,
+          "matricula": 1.0, "anotarme": 1.0, "registrarme": 1.0, "como empiezo": 1.0,
+          "como empezar": 1.0, "quiero entrar": 1.0},
+    "5": {"donde": 1.0, "ubicacion": 1.0, "ubicados": 1.0, "ubicado": 1.0, "direccion": 1.0,
+          "mapa": 1.0, "como llego": 1.0, "quedan": 0.6, "queda": 0.6, "lugar": 0.6},
+    "6": {"que es kudo": 1.5, "kudo que es": 1.5, "filosofia": 1.0, "filosofia kudo": 1.0,
+          "azuma": 1.0, "historia kudo": 1.0},
+    "7": {"guantes": 1.0, "guante": 1.0, "guantillas": 1.0, "guantilla": 1.0, "comprar": 0.6,
+          "venden": 0.6, "venta": 0.6},
+}
+# Palabras que el router "entiende" pero que no apuntan a ninguna opción (saludos, nombres
+# de disciplinas, muletillas): cuentan para la cobertura sin sumar puntaje.
+PALABRAS_NEUTRAS = {
+    "hola", "buenas", "buenos", "buen", "dia", "dias", "tardes", "noches", "gracias", "info",
+    "informacion", "quisiera", "quiero", "saber", "consulta", "pregunta", "que", "es", "como",
+    "cual", "cuales", "son", "hay", "tienen", "tiene", "las", "clases", "clase", "ustedes",
+    "kudo", "bjj", "jiu", "jitsu", "brazilian", "kick", "boxing", "kickboxing", "ninos",
+    "adultos", "kids", "jovenes", "dojo", "porfavor", "ok", "y", "me", "podrian", "pueden",
+    "estan", "esta", "ahi", "exactamente", "mma", "mandame", "pasame", "enviame",
+}
+# Datos del embudo de calificación: un mensaje que los trae (fuera de una frase clave como
+# "que es kudo") es para el agente, que los guarda con guardar_datos_prospecto.
+DATOS_EMBUDO = {
+    "lunes", "martes", "miercoles", "jueves", "viernes", "sabado", "domingo", "hoy", "manana",
+    "tarde", "noche", "mediodia", "kudo", "bjj", "jiu", "jitsu", "brazilian", "kick", "boxing",
+    "kickboxing", "defensa", "personal", "llamo", "nombre", "soy",
+}
+_STOPWORDS = {"de", "del", "la", "el", "los", "un", "una", "en", "o", "a", "al", "para",
+              "por", "mi", "te", "se", "lo", "su", "sus", "tu", "con", "sobre", "favor", "porfa"}
+
+
+def _normalizar(texto):
+    """Minúsculas, sin tildes ni signos, letras repetidas colapsadas ('holaaa' → 'hola')."""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    texto = re.sub(r"(\w)\1{2,}", r"\1", texto)
+    return [t for t in re.findall(r"[a-z0-9]+", texto) if t not in _STOPWORDS]
+
+
+def _trigramas(palabra):
+    p = f"  {palabra} "
+    return {p[i:i + 3] for i in range(len(p) - 2)}
+
+
+class _IndiceIntenciones:
+    """Tablas precalculadas del router: frases → pesos por intención, y trigramas → palabras
+    del vocabulario para corregir errores de tipeo sin recorrer todo el vocabulario."""
+    def __init__(self, palabras_clave, menu_rows, neutras, datos):
+        self.frases = {}            # tupla de tokens -> {clave: peso}
+        for clave, entradas in palabras_clave.items():
+            for frase, peso in entradas.items():
+                self._agregar(tuple(_normalizar(frase)), clave, peso)
+        # El propio menú aporta vocabulario: el título de cada fila pesa como palabra clave.
+        for fila in menu_rows:
+            for token in _normalizar(fila["title"]):
+                if token not in neutras:
+                    self._agregar((token,), fila["id"], 1.0)
+        self.max_frase = max(len(f) for f in self.frases)
+        self.neutras = set(neutras)
+        self.datos = set(datos)
+        self.vocabulario = {t for f in self.frases for t in f} | self.neutras | self.datos
+        self.tri_de = {p: _trigramas(p) for p in self.vocabulario if len(p) >= 4}
+        self.por_trigrama = {}
+        for palabra, tris in self.tri_de.items():
+            for tri in tris:
+                self.por_trigrama.setdefault(tri, set()).add(palabra)
+        self._correcciones = {}     # caché token desconocido -> palabra del vocabulario | None
+
+    def _agregar(self, frase, clave, peso):
+        if frase:
+            pesos = self.frases.setdefault(frase, {})
+            pesos[clave] = max(peso, pesos.get(clave, 0.0))
+
+    def corregir(self, token):
+        """Palabra del vocabulario más parecida a `token` (por trigramas) o None."""
+        if token in self.vocabulario or len(token) < 4:
+            return token if token in self.vocabulario else None
+        if token not in self._correcciones:
+            tris = _trigramas(token)
+            candidatas = set().union(*(self.por_trigrama.get(t, ()) for t in tris))
+            mejor, sim_mejor = None, ROUTER_SIMILITUD
+            for palabra in candidatas:
+                otros = self.tri_de[palabra]
+                sim = len(tris & otros) / len(tris | otros)
+                if sim >= sim_mejor:
+                    mejor, sim_mejor = palabra, sim
+            if len(self._correcciones) < 10000:
+                self._correcciones[token] = mejor
+            return mejor
+        return self._correcciones[token]
+
+    def clasificar(self, texto):
+        """Devuelve (clave | None, confianza, detalle) para un mensaje de texto libre."""
+        tokens = [self.corregir(t) or t for t in _normalizar(texto)]
+        if not tokens or len(tokens) > ROUTER_MAX_PALABRAS:
+            return None, 0.0, "longitud"
+        puntajes, cubiertos = {}, set()
+        for n in range(self.max_frase, 0, -1):      # frases largas primero
+            for i in range(len(tokens) - n + 1):
+                pesos = self.frases.get(tuple(tokens[i:i + n]))
+                if pesos and not cubiertos.issuperset(range(i, i + n)):
+                    cubiertos.update(range(i, i + n))
+                    for clave, peso in pesos.items():
+                        puntajes[clave] = puntajes.get(clave, 0.0) + peso
+        if any(t in self.datos for i, t in enumerate(tokens) if i not in cubiertos):
+            return None, 0.0, "dato_embudo"
+        cubiertos.update(i for i, t in enumerate(tokens) if t in self.neutras)
+        if not puntajes:
+            return None, 0.0, "sin_intencion"
+        orden = sorted(puntajes.items(), key=lambda kv: kv[1], reverse=True)
+        clave, puntaje = orden[0]
+        segundo = orden[1][1] if len(orden) > 1 else 0.0
+        cobertura = len(cubiertos) / len(tokens)
+        confianza = round(min(1.0, puntaje / 1.5) * cobertura * (1 - segundo / puntaje), 3)
+        if puntaje < ROUTER_UMBRAL:
+            return None, confianza, "puntaje_bajo"
+        if cobertura < 1:
+            return None, confianza, "palabra_desconocida"
+        if segundo >= puntaje * ROUTER_MARGEN:
+            return None, confianza, "ambiguo"
+        if confianza < ROUTER_CONFIANZA_MIN:
+            return None, confianza, "confianza_baja"
+        return clave, confianza, "ok"
+
+
+_indice_intenciones = _IndiceIntenciones(PALABRAS_CLAVE_MENU, MENU_ROWS, PALABRAS_NEUTRAS, DATOS_EMBUDO)
+
+# Preguntas del embudo por campo del perfil (ya normalizadas, sin stopwords): si la última
+# respuesta del bot pregunta por un dato que el perfil aún no tiene, lo que escriba el usuario
+# es su respuesta.
+PREGUNTAS_EMBUDO = {
+    "nombre": ("llamas", "nombre"),
+    "disciplina_raw": ("disciplina", "kudo bjj"),
+    "turno_raw": ("turno", "manana tarde noche"),
+    "dia_raw": ("que dia", "dia podrias", "dia puedes"),
+}
+
+
+def embudo_en_curso(ctx):
+    """True si el último mensaje del bot es una pregunta del embudo que sigue sin respuesta."""
+    historial = (ctx or {}).get("history") or []
+    if not historial or historial[-1].get("role") != "assistant":
+        return False
+    preguntas = " | ".join(" ".join(_normalizar(p))
+                           for p in re.findall(r"¿[^?]*\?", historial[-1].get("content", "")))
+    return any(not ctx.get(campo) and any(clave in preguntas for clave in claves)
+               for campo, claves in PREGUNTAS_EMBUDO.items())
+
+
+def clasificar_intencion(texto):
+    """Clave de `respuestas_directas` para el texto libre, o None si hay que ir al agente."""
+    if not ROUTER_INTENCIONES:
+        return None
+    return _indice_intenciones.clasificar(texto)[0]
+
 # Mensajes de conversión para leads de publicidad
 def construir_bienvenida():
     """Mensaje de bienvenida para usuarios nuevos.
@@ -530,77 +2448,675 @@ SYSTEM_PROMPT = (
 
 
 # ---------------------------------------------
-# Funciones auxiliares
+# Funciones auxiliares
+# ---------------------------------------------
+
+# Reintentos: la red y las APIs externas (WhatsApp, Google Sheets, OpenAI) fallan de forma
+# transitoria. En vez de perder el mensaje, reintentamos — pero sin dormir en el hilo que
+# atiende: cada reintento se PROGRAMA en una cola de temporizadores (un hilo que despierta en
+# el próximo vencimiento y despacha a un pool) y el llamador recibe un Future. La espera usa
+# jitter decorrelacionado (evita que todos los reintentos caigan juntos) y respeta Retry-After.
+# Cada reintento es una llamada bloqueante (hasta HTTP_TIMEOUT s), así que no corre en el
+# hilo temporizador: va al pool del llamador si lo da (p. ej. el de envíos) o a un pool propio
+# de reintentos (REINTENTOS_HILOS). Quien necesita el resultado para seguir
+# (_http_con_reintentos, _con_reintentos) espera ese Future: no duerme el backoff en su hilo.
+# Cada endpoint tiene un circuit breaker: tras BREAKER_UMBRAL fallos seguidos deja de llamar
+# durante BREAKER_ENFRIAMIENTO s y luego deja pasar UNA llamada de prueba (semiabierto); si
+# sale bien se cierra, si falla vuelve a abrirse. Así no martillamos un servicio caído. Solo
+# cuentan como fallo los errores del servicio (red, timeouts, 429, 5xx): un bug nuestro o el
+# error de una tool no abren el circuito de OpenAI.
+HTTP_TIMEOUT = 20                       # segundos máx. por llamada HTTP (evita cuelgues)
+REINTENTOS = 3                          # nº total de intentos
+ESPERA_BASE = 1.0                       # jitter decorrelacionado: U(base, 3 × espera anterior)…
+ESPERA_MAX = 20.0                       # …con este tope
+RETRY_AFTER_MAX = 60.0                  # si el servidor pide esperar más, no se reintenta
+STATUS_REINTENTABLES = {429, 500, 502, 503, 504}  # respuestas que vale la pena reintentar
+BREAKER_UMBRAL = int(os.getenv("BREAKER_UMBRAL", "5"))            # fallos seguidos que abren
+BREAKER_ENFRIAMIENTO = float(os.getenv("BREAKER_ENFRIAMIENTO", "30"))  # seg. abierto
+REINTENTOS_HILOS = int(os.getenv("REINTENTOS_HILOS", "16"))       # pool propio de reintentos
+
+
+class _PlanificadorReintentos:
+    """Cola de temporizadores: ejecuta fn(*args) en un pool pasados `retraso` segundos."""
+    def __init__(self, hilos=REINTENTOS_HILOS):
+        self._heap = []   # (vence_monotonic, secuencia, fn, args, pool)
+        self._cond = threading.Condition()
+        self._secuencia = itertools.count()
+        self._pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="reintento")
+        self._hilo = None
+
+    def programar(self, retraso, fn, *args, pool=None):
+        """`pool`: executor donde correr fn (por defecto, el de reintentos)."""
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + retraso, next(self._secuencia), fn, args, pool))
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._bucle, name="temporizador", daemon=True)
+                self._hilo.start()
+            self._cond.notify()
+
+    def _bucle(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, fn, args, pool = heapq.heappop(self._heap)
+            (pool or self._pool).submit(fn, *args)
+
+    def pendientes(self):
+        with self._cond:
+            return len(self._heap)
+
+
+_reintentos = _PlanificadorReintentos()
+
+
+class CircuitoAbierto(Exception):
+    pass
+
+
+class _Breaker:
+    """Circuit breaker por endpoint: cerrado → abierto → semiabierto (una prueba) → cerrado."""
+    CERRADO, SEMIABIERTO, ABIERTO = 0, 1, 2
+    NOMBRES = ("cerrado", "semiabierto", "abierto")
+
+    def __init__(self, nombre, errores=(Exception,)):
+        self.nombre = nombre
+        self.errores = errores    # excepciones que son fallo del servicio (las demás, no)
+        self.estado = self.CERRADO
+        self.fallos = 0
+        self.desde = 0.0          # monotonic del último cambio a abierto / semiabierto
+        self._lock = threading.Lock()
+        _metricas.fijar("breaker_estado", self.CERRADO, endpoint=nombre)
+
+    def _cambiar(self, estado):
+        if estado != self.estado:
+            print(f"[{'WARN' if estado else 'INFO'}] Circuito {self.nombre}: "
+                  f"{self.NOMBRES[self.estado]} → {self.NOMBRES[estado]}")
+        self.estado, self.desde = estado, time.monotonic()
+        _metricas.fijar("breaker_estado", estado, endpoint=self.nombre)
+
+    def permitir(self):
+        with self._lock:
+            if self.estado == self.CERRADO:
+                return True
+            # Abierto y enfriado (o prueba colgada): dejar pasar UNA llamada de prueba.
+            if time.monotonic() - self.desde >= BREAKER_ENFRIAMIENTO:
+                self._cambiar(self.SEMIABIERTO)
+                return True
+        _metricas.contar("breaker_rechazos_total", endpoint=self.nombre)
+        return False
+
+    def exito(self):
+        with self._lock:
+            self.fallos = 0
+            if self.estado != self.CERRADO:
+                self._cambiar(self.CERRADO)
+
+    def fallo(self):
+        with self._lock:
+            self.fallos += 1
+            if self.estado == self.SEMIABIERTO or (self.estado == self.CERRADO and self.fallos >= BREAKER_UMBRAL):
+                self._cambiar(self.ABIERTO)
+                _metricas.contar("breaker_aperturas_total", endpoint=self.nombre)
+
+    def proteger(self):
+        """Context manager para llamadas que no pasan por los reintentos (p. ej. el agente):
+        lanza CircuitoAbierto si no se permite, y registra éxito o fallo al salir."""
+        return _LlamadaProtegida(self)
+
+    def es_fallo(self, error):
+        """True si `error` (o la excepción que lo causó) es un fallo del servicio."""
+        while error is not None:
+            if isinstance(error, self.errores):
+                return True
+            error = error.__cause__
+        return False
+
+
+class _LlamadaProtegida:
+    __slots__ = ("breaker",)
+
+    def __init__(self, breaker):
+        self.breaker = breaker
+
+    def __enter__(self):
+        if not self.breaker.permitir():
+            raise CircuitoAbierto(f"circuito {self.breaker.nombre} abierto")
+        return self
+
+    def __exit__(self, tipo, error, traza):
+        if tipo is None or (isinstance(error, Exception) and not self.breaker.es_fallo(error)):
+            self.breaker.exito()  # el servicio respondió; lo que falló fue otra cosa
+        elif isinstance(error, Exception):
+            self.breaker.fallo()
+        return False
+
+
+# De OpenAI solo cuentan red/timeouts, rate limits y 5xx (no un 400 ni un error de una tool).
+ERRORES_OPENAI = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+
+def _crear_breakers():
+    breakers = {nombre: _Breaker(nombre) for nombre in ("graph_mensajes", "graph_media", "sheets")}
+    breakers["openai"] = _Breaker("openai", ERRORES_OPENAI)
+    return breakers
+
+
+_breakers = _crear_breakers()
+
+# ---------------------------------------------
+# ✅ Cliente compartido de la Graph API (conexiones keep-alive reutilizadas)
 # ---------------------------------------------
+# Antes cada envío usaba requests.request/post sueltos: un handshake TCP+TLS nuevo con
+# graph.facebook.com por llamada, y una respuesta del menú manda 3–4 mensajes seguidos.
+# Una única Session con pool de conexiones reutiliza los sockets abiertos; los headers de
+# auth y las URLs se arman una sola vez. Todo el tráfico a Graph pasa por `request()`, de
+# modo que el cliente se puede reemplazar por uno async (httpx/aiohttp) con la misma firma.
+GRAPH_VERSION = "v18.0"
+GRAPH_POOL = int(os.getenv("GRAPH_POOL", "20"))   # conexiones keep-alive máx. por host
 
-# Reintentos: la red y las APIs externas (WhatsApp, Google Sheets) fallan de forma
-# transitoria. En vez de perder el mensaje, reintentamos con backoff exponencial.
-HTTP_TIMEOUT = 20                       # segundos máx. por llamada HTTP (evita cuelgues)
-REINTENTOS = 3                          # nº total de intentos
-ESPERA_BASE = 1.0                       # backoff: 1s, 2s, 4s…
-STATUS_REINTENTABLES = {429, 500, 502, 503, 504}  # respuestas que vale la pena reintentar
+
+class _ClienteGraph:
+    """Session pooled + headers y endpoints precalculados para la API de WhatsApp."""
+    def __init__(self, token, phone_number_id, pool=GRAPH_POOL):
+        self.base = f"https://graph.facebook.com/{GRAPH_VERSION}"
+        self.phone_number_id = phone_number_id
+        self.url_mensajes = f"{self.base}/{phone_number_id}/messages"
+        self.headers_auth = {"Authorization": f"Bearer {token}"}
+        self.headers_json = {**self.headers_auth, "Content-Type": "application/json"}
+        self.pool = pool
+        self.reiniciar()
+
+    def reiniciar(self):
+        """Session nueva (sin sockets heredados: se llama también tras un fork)."""
+        self.sesion = requests.Session()
+        # Sin reintentos en urllib3: de eso se encarga _http_con_reintentos.
+        adaptador = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool, max_retries=0)
+        self.sesion.mount("https://", adaptador)
+
+    def url_media(self, media_id):
+        return f"{self.base}/{media_id}"
+
+    def request(self, metodo, url, **kwargs):
+        kwargs.setdefault("timeout", HTTP_TIMEOUT)
+        return self.sesion.request(metodo, url, **kwargs)
+
+
+_graph = _ClienteGraph(WHATSAPP_TOKEN, PHONE_NUMBER_ID)
+
+
+def _crear_graph_async():
+    return httpx.AsyncClient(timeout=HTTP_TIMEOUT, limits=httpx.Limits(max_connections=GRAPH_POOL))
+
+
+# Cliente HTTP del pipeline asíncrono (mismas URLs y headers que _graph).
+_graph_async = _Perezoso("graph_async", _crear_graph_async, critico=False)
+
+
+class _RespuestaReintentable(Exception):
+    def __init__(self, resp):
+        super().__init__(f"HTTP {resp.status_code}")
+        self.resp = resp
+
+
+def _retry_after(resp):
+    """Segundos pedidos en el header Retry-After (número o fecha HTTP), o None."""
+    valor = (getattr(resp, "headers", None) or {}).get("Retry-After")
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(valor).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def _ejecutar_con_reintentos(descripcion, endpoint, fn, reintentos=REINTENTOS, pool=None):
+    """Ejecuta fn() con el breaker de `endpoint` y devuelve un Future con su resultado.
+
+    Cualquier excepción se reintenta; los reintentos se programan en la cola de
+    temporizadores (nadie duerme esperando) y corren en `pool` (o el pool de reintentos).
+    Si se agotan los intentos o el circuito está abierto, el resultado es None (o la última
+    respuesta HTTP reintentable). Nunca falla.
+    """
+    futuro = Future()
+    breaker = _breakers[endpoint]
+    estado = {"intento": 0, "espera": ESPERA_BASE}
+
+    def intentar():
+        estado["intento"] += 1
+        intento = estado["intento"]
+        if not breaker.permitir():
+            print(f"[WARN] {descripcion}: circuito {endpoint} abierto; no se intenta.")
+            _metricas.contar("errores_total", etapa=descripcion)
+            futuro.set_result(None)
+            return
+        try:
+            resultado = fn()
+        except Exception as e:
+            breaker.fallo()
+            resp = e.resp if isinstance(e, _RespuestaReintentable) else None
+            espera = min(ESPERA_MAX, random.uniform(ESPERA_BASE, estado["espera"] * 3))
+            estado["espera"] = espera
+            pedido = _retry_after(resp)
+            if pedido is not None:
+                espera = max(espera, pedido)
+            if intento >= reintentos or espera > RETRY_AFTER_MAX:
+                print(f"[ERROR] {descripcion}: agotados {intento} intentos: {e}")
+                _metricas.contar("errores_total", etapa=descripcion)
+                futuro.set_result(resp)
+                return
+            if resp is not None:
+                resp.close()  # libera la conexión al pool (importa con stream=True)
+            print(f"[WARN] {descripcion}: intento {intento} falló ({e}); reintento en {espera:.1f}s")
+            _metricas.contar("reintentos_total", operacion=descripcion, endpoint=endpoint)
+            _reintentos.programar(espera, intentar, pool=pool)
+            return
+        breaker.exito()
+        futuro.set_result(resultado)
+
+    intentar()
+    return futuro
 
 
-def _http_con_reintentos(descripcion, metodo, url, **kwargs):
-    """HTTP con reintentos y backoff ante fallos de red o respuestas 5xx/429.
+def _http_async(descripcion, metodo, url, cliente=None, endpoint="graph_mensajes",
+                reintentos=REINTENTOS, **kwargs):
+    """HTTP con breaker y reintentos ante fallos de red o respuestas 5xx/429 → Future.
 
-    Devuelve la respuesta (incluso si es un error no reintentable, p. ej. 4xx) o
-    None si tras agotar los intentos no se obtuvo respuesta. Nunca lanza excepción:
-    el llamador decide qué hacer, pero el flujo del webhook nunca se rompe por esto.
+    El resultado es la respuesta (incluso si es un error no reintentable, p. ej. 4xx) o
+    None si no se obtuvo respuesta. Por defecto usa el cliente compartido de Graph.
     """
+    cliente = cliente or _graph
     kwargs.setdefault("timeout", HTTP_TIMEOUT)
-    for intento in range(1, REINTENTOS + 1):
+
+    def llamar():
+        resp = cliente.request(metodo, url, **kwargs)
+        if resp.status_code in STATUS_REINTENTABLES:
+            raise _RespuestaReintentable(resp)
+        return resp
+    return _ejecutar_con_reintentos(descripcion, endpoint, llamar, reintentos)
+
+
+def _http_con_reintentos(descripcion, metodo, url, cliente=None, endpoint="graph_mensajes", **kwargs):
+    """Versión bloqueante de _http_async para quien necesita la respuesta para seguir."""
+    return _http_async(descripcion, metodo, url, cliente=cliente, endpoint=endpoint, **kwargs).result()
+
+
+def _con_reintentos(descripcion, fn, endpoint="sheets"):
+    """Ejecuta fn() reintentando ante cualquier excepción transitoria (p. ej. errores de red
+    de Google Sheets). Devuelve el resultado o None si falla."""
+    return _ejecutar_con_reintentos(descripcion, endpoint, fn).result()
+
+
+async def _ejecutar_con_reintentos_async(descripcion, endpoint, fn, reintentos=REINTENTOS):
+    """_ejecutar_con_reintentos para el loop de asyncio: misma política (breaker, jitter,
+    Retry-After), pero `fn` es una corutina y la espera entre intentos un asyncio.sleep."""
+    breaker = _breakers[endpoint]
+    espera_previa = ESPERA_BASE
+    for intento in range(1, reintentos + 1):
+        if not breaker.permitir():
+            print(f"[WARN] {descripcion}: circuito {endpoint} abierto; no se intenta.")
+            _metricas.contar("errores_total", etapa=descripcion)
+            return None
         try:
-            resp = requests.request(metodo, url, **kwargs)
-        except requests.RequestException as e:
-            if intento == REINTENTOS:
-                print(f"[ERROR] {descripcion}: agotados {REINTENTOS} intentos (red): {e}")
-                return None
-            espera = ESPERA_BASE * (2 ** (intento - 1))
-            print(f"[WARN] {descripcion}: intento {intento} falló (red: {e}); reintento en {espera:.1f}s")
-            time.sleep(espera)
-            continue
-        if resp.status_code in STATUS_REINTENTABLES and intento < REINTENTOS:
-            espera = ESPERA_BASE * (2 ** (intento - 1))
-            print(f"[WARN] {descripcion}: intento {intento} devolvió {resp.status_code}; reintento en {espera:.1f}s")
-            time.sleep(espera)
+            resultado = await fn()
+        except Exception as e:
+            breaker.fallo()
+            resp = e.resp if isinstance(e, _RespuestaReintentable) else None
+            espera = espera_previa = min(ESPERA_MAX, random.uniform(ESPERA_BASE, espera_previa * 3))
+            pedido = _retry_after(resp)
+            if pedido is not None:
+                espera = max(espera, pedido)
+            if intento >= reintentos or espera > RETRY_AFTER_MAX:
+                print(f"[ERROR] {descripcion}: agotados {intento} intentos: {e}")
+                _metricas.contar("errores_total", etapa=descripcion)
+                return resp
+            if resp is not None:
+                await resp.aclose()
+            print(f"[WARN] {descripcion}: intento {intento} falló ({e}); reintento en {espera:.1f}s")
+            _metricas.contar("reintentos_total", operacion=descripcion, endpoint=endpoint)
+            await asyncio.sleep(espera)
             continue
+        breaker.exito()
+        return resultado
+
+
+async def _http_aio(descripcion, metodo, url, endpoint="graph_mensajes", reintentos=REINTENTOS,
+                    stream=False, **kwargs):
+    """_http_async con httpx en el loop: la respuesta (con stream=True, sin leer el cuerpo;
+    el llamador hace aclose()) o None."""
+    async def llamar():
+        cliente = _graph_async.obtener()
+        resp = await cliente.send(cliente.build_request(metodo, url, **kwargs), stream=stream)
+        if resp.status_code in STATUS_REINTENTABLES:
+            raise _RespuestaReintentable(resp)
         return resp
-    return None
+    return await _ejecutar_con_reintentos_async(descripcion, endpoint, llamar, reintentos)
 
 
-def _con_reintentos(descripcion, fn):
-    """Ejecuta fn() reintentando con backoff ante cualquier excepción transitoria
-    (p. ej. errores de red de Google Sheets). Devuelve el resultado o None si falla."""
-    for intento in range(1, REINTENTOS + 1):
+# ---------------------------------------------
+# ✅ Planificador de envíos salientes (rate limit + carriles por destinatario)
+# ---------------------------------------------
+# Todo mensaje saliente (respuestas, chunks del menú, avisos al staff) se ENCOLA aquí en vez
+# de llamar a Graph directamente:
+#   - una cubeta de tokens por PHONE_NUMBER_ID limita el ritmo (Meta: ~80 msg/s por número
+#     en Cloud API); sin tokens, el despachador espera — nunca el hilo que atiende. Con Redis
+#     la cubeta vive en Redis (SCRIPT_CUBETA) y la comparten todos los procesos y dynos que
+#     envían con ese número; con memoria local hay un solo proceso y basta una en memoria;
+#   - un carril FIFO por destinatario y prioridad: a un mismo número sale un mensaje a la vez
+#     y en orden, y entre carriles listos gana la prioridad más alta (respuestas al usuario
+#     antes que avisos al staff);
+#   - si Meta limita (HTTP 429 o códigos 130429 / 131056 / 80007) el mensaje vuelve a la
+#     cabeza de SU carril tras Retry-After o un backoff; con 130429 (límite del número) además
+#     se pausa la cubeta entera (en Redis: para todos los procesos);
+#   - contrapresión: con ENVIOS_MAX_COLA mensajes pendientes, encolar bloquea hasta
+#     ENVIOS_ESPERA_MAX s y luego descarta (con log y métrica). En el hilo del loop de
+#     asyncio no se bloquea: la espera pasa a un hilo aparte (en orden) y encolar vuelve ya.
+# La espera en cola se mide en el histograma envio_espera_segundos{prioridad}.
+ENVIOS_POR_SEGUNDO = float(os.getenv("ENVIOS_POR_SEGUNDO", "80"))
+ENVIOS_RAFAGA = int(os.getenv("ENVIOS_RAFAGA", "80"))
+ENVIOS_HILOS = int(os.getenv("ENVIOS_HILOS", "8"))
+ENVIOS_MAX_COLA = int(os.getenv("ENVIOS_MAX_COLA", "2000"))
+ENVIOS_ESPERA_MAX = float(os.getenv("ENVIOS_ESPERA_MAX", "10"))
+ENVIOS_LIMITES_MAX = 5                      # veces que un mensaje puede volver por rate limit
+PRIORIDAD_RESPUESTA = 0                     # menor = más urgente
+PRIORIDAD_AVISO = 1
+_NOMBRES_PRIORIDAD = {PRIORIDAD_RESPUESTA: "respuesta", PRIORIDAD_AVISO: "aviso"}
+CODIGO_LIMITE_NUMERO = 130429               # throughput del número agotado
+CODIGOS_LIMITE_GRAPH = {CODIGO_LIMITE_NUMERO, 131056, 80007}  # 131056: par emisor-destinatario
+CUBETA_PREFIX = "envios:cubeta:"            # + phone_number_id (hash tokens/ultimo/pausa)
+CUBETA_TTL = 3600
+
+
+class _CubetaTokens:
+    """Token bucket en memoria: `tasa` tokens/s con capacidad `rafaga`."""
+    def __init__(self, tasa, rafaga):
+        self.tasa, self.rafaga = tasa, rafaga
+        self.tokens = float(rafaga)
+        self.ultimo = time.monotonic()
+        self.pausa_hasta = 0.0
+        self._lock = threading.Lock()
+
+    def tomar(self):
+        """Toma un token y devuelve 0, o devuelve los segundos a esperar sin tomar nada."""
+        with self._lock:
+            ahora = time.monotonic()
+            if ahora < self.pausa_hasta:
+                return self.pausa_hasta - ahora
+            self.tokens = min(self.rafaga, self.tokens + max(0.0, ahora - self.ultimo) * self.tasa)
+            self.ultimo = ahora
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.tasa
+
+    def pausar(self, segundos):
+        with self._lock:
+            self.pausa_hasta = max(self.pausa_hasta, time.monotonic() + segundos)
+            self.tokens = 0.0
+            self.ultimo = self.pausa_hasta  # la cubeta empieza a rellenarse al terminar la pausa
+
+
+# La misma cubeta como hash en Redis, con el reloj de Redis (TIME) para que todos los
+# procesos midan igual. ARGV: tasa, ráfaga, TTL y, para pausar, los segundos de pausa.
+# Devuelve (como texto: Redis trunca los números de Lua) los segundos a esperar, 0 = token.
+SCRIPT_CUBETA = """
+local t = redis.call("TIME")
+local ahora = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local tasa, rafaga = tonumber(ARGV[1]), tonumber(ARGV[2])
+local c = redis.call("HMGET", KEYS[1], "tokens", "ultimo", "pausa")
+local tokens, ultimo, pausa = tonumber(c[1]) or rafaga, tonumber(c[2]) or ahora, tonumber(c[3]) or 0
+local espera = 0
+if ARGV[4] then
+    pausa = math.max(pausa, ahora + tonumber(ARGV[4]))
+    tokens, ultimo = 0, pausa
+elseif ahora < pausa then
+    return tostring(pausa - ahora)
+else
+    tokens = math.min(rafaga, tokens + math.max(0, ahora - ultimo) * tasa)
+    ultimo = ahora
+    if tokens >= 1 then tokens = tokens - 1 else espera = (1 - tokens) / tasa end
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "ultimo", tostring(ultimo), "pausa", tostring(pausa))
+redis.call("EXPIRE", KEYS[1], ARGV[3])
+return tostring(espera)
+"""
+
+
+class _CubetaRedis:
+    """_CubetaTokens compartida vía SCRIPT_CUBETA. Si Redis falla, usa `respaldo` (la cubeta
+    local del proceso) para no dejar de enviar."""
+    def __init__(self, backend, clave, tasa, rafaga, respaldo):
+        self._script = backend.register_script(SCRIPT_CUBETA)
+        self.clave, self.tasa, self.rafaga = clave, tasa, rafaga
+        self.respaldo = respaldo
+
+    def _llamar(self, *extra):
+        with medir("redis_segundos", op="cubeta_envios"):
+            return float(self._script(keys=[self.clave], args=[self.tasa, self.rafaga, CUBETA_TTL, *extra]))
+
+    def tomar(self):
         try:
-            return fn()
+            return self._llamar()
         except Exception as e:
-            if intento == REINTENTOS:
-                print(f"[ERROR] {descripcion}: agotados {REINTENTOS} intentos: {e}")
-                return None
-            espera = ESPERA_BASE * (2 ** (intento - 1))
-            print(f"[WARN] {descripcion}: intento {intento} falló ({e}); reintento en {espera:.1f}s")
-            time.sleep(espera)
+            print(f"[WARN] Cubeta de envíos en Redis no disponible ({e}); se usa la local.")
+            return self.respaldo.tomar()
+
+    def pausar(self, segundos):
+        self.respaldo.pausar(segundos)
+        try:
+            self._llamar(segundos)
+        except Exception as e:
+            print(f"[WARN] No se pudo pausar la cubeta de envíos en Redis: {e}")
 
 
-def send_message(text, phone):
-    """Envía un mensaje de texto por la API de WhatsApp (con reintentos ante fallos)."""
-    url = f"https://graph.facebook.com/v18.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}",
-               "Content-Type": "application/json"
-               }
+class _Envio:
+    __slots__ = ("descripcion", "destino", "payload", "tipo", "prioridad", "encolado",
+                 "despachado", "limites", "futuro")
+
+    def __init__(self, descripcion, destino, payload, tipo, prioridad):
+        self.descripcion, self.destino, self.payload = descripcion, destino, payload
+        self.tipo, self.prioridad = tipo, prioridad
+        self.encolado = time.monotonic()
+        self.despachado = False
+        self.limites = 0
+        self.futuro = Future()
+
+
+def _limite_graph(resp):
+    """Código de rate limit de Meta en la respuesta (o 429), o None si no es un límite."""
+    if resp is None or resp.status_code < 400:
+        return None
+    try:
+        codigo = (resp.json().get("error") or {}).get("code")
+    except Exception:
+        codigo = None
+    if codigo in CODIGOS_LIMITE_GRAPH:
+        return codigo
+    return 429 if resp.status_code == 429 else None
+
+
+class _PlanificadorEnvios:
+    def __init__(self, cliente, hilos=ENVIOS_HILOS):
+        self.cliente = cliente
+        self._cubetas = {}       # phone_number_id → _CubetaTokens / _CubetaRedis
+        self._carriles = {}      # (prioridad, destino) → deque de _Envio
+        self._ocupados = set()   # carriles con un envío en vuelo o esperando reintento
+        self._listos = []        # heap (prioridad, secuencia, carril) de carriles despachables
+        self._secuencia = itertools.count()
+        self._pendientes = 0
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="envio")
+        # Productores del loop de asyncio que esperan lugar: un solo hilo, así salen en orden.
+        self._sala = ThreadPoolExecutor(max_workers=1, thread_name_prefix="envio-espera")
+        self._en_sala = 0
+        self._hilo = None
+
+    def _cubeta(self):
+        numero = self.cliente.phone_number_id
+        cubeta = self._cubetas.get(numero)
+        if cubeta is None:
+            cubeta = _CubetaTokens(ENVIOS_POR_SEGUNDO, ENVIOS_RAFAGA)
+            try:
+                backend = _backend.obtener()
+                if not isinstance(backend, _MemoriaLocal):
+                    cubeta = _CubetaRedis(backend, CUBETA_PREFIX + numero, ENVIOS_POR_SEGUNDO,
+                                          ENVIOS_RAFAGA, cubeta)
+            except Exception as e:
+                # Sin backend todavía: cubeta local por ahora, se reintenta la próxima vez.
+                print(f"[WARN] Cubeta de envíos local para {numero}: {e}")
+                return cubeta
+            self._cubetas[numero] = cubeta
+        return cubeta
+
+    def encolar(self, descripcion, destino, payload, tipo, prioridad=PRIORIDAD_RESPUESTA):
+        """Encola un mensaje y devuelve un Future con la respuesta de Graph (o None)."""
+        envio = _Envio(descripcion, destino, payload, tipo, prioridad)
+        limite = time.monotonic() + ENVIOS_ESPERA_MAX
+        with self._cond:
+            if (self._pendientes >= ENVIOS_MAX_COLA or self._en_sala) and _en_loop_asyncio():
+                # Cola llena en el hilo del loop: la espera la hace la sala, no el loop.
+                self._en_sala += 1
+                self._sala.submit(self._admitir_desde_sala, envio, limite)
+                return envio.futuro
+            self._admitir(envio, limite)
+        return envio.futuro
+
+    def _admitir_desde_sala(self, envio, limite):
+        with self._cond:
+            self._en_sala -= 1
+            self._admitir(envio, limite)
+
+    def _admitir(self, envio, limite):
+        """Pone `envio` en su carril esperando lugar hasta `limite` (o lo descarta). Con el lock."""
+        while self._pendientes >= ENVIOS_MAX_COLA:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                print(f"[ERROR] {envio.descripcion}: cola de envíos llena ({self._pendientes}); "
+                      f"se descarta el mensaje a {envio.destino}.")
+                _metricas.contar("envios_descartados_total", prioridad=_NOMBRES_PRIORIDAD[envio.prioridad])
+                envio.futuro.set_result(None)
+                return
+            self._cond.wait(restante)
+        self._pendientes += 1
+        carril = (envio.prioridad, envio.destino)
+        self._carriles.setdefault(carril, deque()).append(envio)
+        if carril not in self._ocupados and len(self._carriles[carril]) == 1:
+            self._marcar_listo(carril)
+        if self._hilo is None or not self._hilo.is_alive():
+            self._hilo = threading.Thread(target=self._despachar, name="despachador-envios", daemon=True)
+            self._hilo.start()
+
+    def _marcar_listo(self, carril):
+        heapq.heappush(self._listos, (carril[0], next(self._secuencia), carril))
+        self._cond.notify_all()
+
+    def _despachar(self):
+        while True:
+            with self._cond:
+                while not self._listos:
+                    self._cond.wait()
+            # Solo este hilo saca de _listos: el token se toma fuera del lock (puede ir a Redis).
+            espera = self._cubeta().tomar()
+            if espera > 0:
+                time.sleep(espera)
+                continue
+            with self._cond:
+                _, _, carril = heapq.heappop(self._listos)
+                self._ocupados.add(carril)
+                envio = self._carriles[carril][0]
+            if not envio.despachado:
+                envio.despachado = True
+                _metricas.observar("envio_espera_segundos", time.monotonic() - envio.encolado,
+                                   prioridad=_NOMBRES_PRIORIDAD[envio.prioridad])
+            self._pool.submit(self._enviar, carril, envio)
+
+    def _enviar(self, carril, envio):
+        def llamar():
+            with medir("graph_segundos", tipo=envio.tipo):
+                resp = self.cliente.request("POST", self.cliente.url_mensajes,
+                                            headers=self.cliente.headers_json, json=envio.payload)
+            # Los rate limits los maneja el carril (no cuentan como fallo del circuito).
+            if resp.status_code in STATUS_REINTENTABLES and _limite_graph(resp) is None:
+                raise _RespuestaReintentable(resp)
+            return resp
+        futuro = _ejecutar_con_reintentos(envio.descripcion, "graph_mensajes", llamar, pool=self._pool)
+        futuro.add_done_callback(lambda f: self._terminado(carril, envio, f.result()))
+
+    def _terminado(self, carril, envio, resp):
+        codigo = _limite_graph(resp)
+        if codigo is not None and envio.limites < ENVIOS_LIMITES_MAX:
+            envio.limites += 1
+            espera = min(RETRY_AFTER_MAX, _retry_after(resp) or ESPERA_BASE * 2 ** envio.limites)
+            print(f"[WARN] {envio.descripcion} a {envio.destino}: límite de Meta ({codigo}); "
+                  f"reintento en {espera:.1f}s")
+            _metricas.contar("envios_limitados_total", codigo=str(codigo))
+            if codigo in (429, CODIGO_LIMITE_NUMERO):
+                self._cubeta().pausar(espera)
+            # El envío sigue en la cabeza de su carril: nada del mismo destino se adelanta.
+            _reintentos.programar(espera, self._reactivar, carril)
+            return
+        with self._cond:
+            self._carriles[carril].popleft()
+            if not self._carriles[carril]:
+                del self._carriles[carril]
+            self._pendientes -= 1
+            self._ocupados.discard(carril)
+            if carril in self._carriles:
+                self._marcar_listo(carril)
+            self._cond.notify_all()  # despierta a productores bloqueados por contrapresión
+        envio.futuro.set_result(resp)
+
+    def _reactivar(self, carril):
+        with self._cond:
+            self._ocupados.discard(carril)
+            self._marcar_listo(carril)
+
+    def pendientes(self):
+        with self._cond:
+            return self._pendientes + self._en_sala
+
+    def estado(self):
+        with self._cond:
+            return {"pendientes": self._pendientes, "en_sala": self._en_sala, "carriles": len(self._carriles),
+                    "en_vuelo": len(self._ocupados), "listos": len(self._listos)}
+
+
+_envios = _PlanificadorEnvios(_graph)
+
+
+def _en_loop_asyncio():
+    """True si se llama desde el hilo de un loop de asyncio corriendo (pipeline ASGI)."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def _registrar_envio(futuro, descripcion, phone, etapa="envio_respuesta"):
+    def al_terminar(f):
+        response = f.result()
+        if response is None:
+            print(f"[ERROR] {descripcion}: no se pudo enviar a {phone}.")
+            return
+        print("[INFO] WhatsApp API response:", response.status_code, response.text)
+    futuro.add_done_callback(al_terminar)
+    return _seguir_etapa(etapa, futuro)
+
+
+def send_message(text, phone, prioridad=PRIORIDAD_RESPUESTA):
+    """Encola un mensaje de texto para WhatsApp (ver _PlanificadorEnvios) y devuelve su Future."""
     payload = {"messaging_product": "whatsapp",
                "to": phone,
                "type": "text",
                "text": {"body": text}
                }
     print(f"[INFO] Respuesta del bot a {phone}: {text}")
-    response = _http_con_reintentos("Envío WhatsApp", "POST", url, headers=headers, json=payload)
-    if response is None:
-        print(f"[ERROR] No se pudo enviar el mensaje a {phone} tras {REINTENTOS} intentos.")
-        return
-    print("[INFO] WhatsApp API response:", response.status_code, response.text)
+    return _registrar_envio(_envios.encolar("Envío WhatsApp", phone, payload, "texto", prioridad),
+                            "Envío WhatsApp", phone, etapa=f"envio_{_NOMBRES_PRIORIDAD[prioridad]}")
 
 
 def send_typing_indicator(message_id):
@@ -612,20 +3128,25 @@ def send_typing_indicator(message_id):
     no bloquear nunca la respuesta real al usuario.
     """
     if not message_id:
-        return
-    url = f"https://graph.facebook.com/v18.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}",
-               "Content-Type": "application/json"}
-    payload = {
+        return None
+    # Sin reintentos y sin esperar la respuesta: el indicador es cosmético.
+    return _http_async("Indicador de escritura", "POST", _graph.url_mensajes, reintentos=1,
+                headers=_graph.headers_json, json=_payload_indicador(message_id))
+
+
+async def send_typing_indicator_async(message_id):
+    if message_id:
+        await _http_aio("Indicador de escritura", "POST", _graph.url_mensajes, reintentos=1,
+                        headers=_graph.headers_json, json=_payload_indicador(message_id))
+
+
+def _payload_indicador(message_id):
+    return {
         "messaging_product": "whatsapp",
         "status": "read",
         "message_id": message_id,
         "typing_indicator": {"type": "text"},
     }
-    try:
-        requests.post(url, headers=headers, json=payload)
-    except Exception as e:
-        print("[WARN] No se pudo enviar el indicador de escritura:", e)
 
 
 def send_list_menu(phone, body_text=MENU_BODY):
@@ -635,9 +3156,6 @@ def send_list_menu(phone, body_text=MENU_BODY):
     'Ver opciones' que despliega las 7 opciones; al tocar una, Meta nos reenvía el
     `id` de la fila, que el webhook trata igual que si el usuario hubiera escrito el número.
     """
-    url = f"https://graph.facebook.com/v18.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}",
-               "Content-Type": "application/json"}
     payload = {
         "messaging_product": "whatsapp",
         "to": phone,
@@ -654,85 +3172,572 @@ def send_list_menu(phone, body_text=MENU_BODY):
         },
     }
     print(f"[INFO] Menú interactivo enviado a {phone}")
-    response = _http_con_reintentos("Menú WhatsApp", "POST", url, headers=headers, json=payload)
-    if response is None:
-        print(f"[ERROR] No se pudo enviar el menú a {phone} tras {REINTENTOS} intentos.")
-        return
-    print("[INFO] WhatsApp API response:", response.status_code, response.text)
+    return _registrar_envio(_envios.encolar("Menú WhatsApp", phone, payload, "menu"),
+                            "Menú WhatsApp", phone)
 
 
 # Cliente OpenAI para transcripción de notas de voz (el agente usa su propio SDK aparte).
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+openai_client = _Perezoso("openai", lambda: OpenAI(api_key=OPENAI_API_KEY))
+openai_async = _Perezoso("openai_async", lambda: AsyncOpenAI(api_key=OPENAI_API_KEY), critico=False)
+
+
+# Las notas de voz se descargan EN STREAMING (bloques de MEDIA_BLOQUE) a un archivo temporal
+# que vive en RAM hasta MEDIA_SPOOL_RAM y luego pasa a disco, con un tope de tamaño que corta
+# la descarga apenas se supera. Las transcripciones se cachean en el backend por media-id
+# (reentregas) y por sha256 del contenido (audios reenviados: mismo archivo, otro media-id),
+# así un mismo audio nunca pasa dos veces por Whisper. Meta informa el sha256 en la metadata:
+# un audio reenviado se resuelve desde la caché sin descargarlo siquiera.
+MEDIA_MAX_BYTES = int(float(os.getenv("MEDIA_MAX_MB", "16")) * 1024 * 1024)  # tope de WhatsApp para audio
+MEDIA_BLOQUE = 64 * 1024
+MEDIA_SPOOL_RAM = 1024 * 1024
+TRANSCRIPCION_PREFIX = "transcripcion:"
+TRANSCRIPCION_TTL = 60 * 60 * 24 * 30
+
+
+def metadata_media(media_id):
+    """Metadata de un media de WhatsApp (url, mime_type, sha256, file_size) o None."""
+    meta = _http_con_reintentos("Metadata de media", "GET", _graph.url_media(media_id),
+                                endpoint="graph_media", headers=_graph.headers_auth)
+    if meta is None or meta.status_code != 200:
+        print("[WARN] Metadata de media falló:", getattr(meta, "status_code", "sin respuesta"))
+        return None
+    return meta.json()
+
+
+async def metadata_media_async(media_id):
+    meta = await _http_aio("Metadata de media", "GET", _graph.url_media(media_id),
+                           endpoint="graph_media", headers=_graph.headers_auth)
+    if meta is None or meta.status_code != 200:
+        print("[WARN] Metadata de media falló:", getattr(meta, "status_code", "sin respuesta"))
+        return None
+    return meta.json()
 
 
-def descargar_media_whatsapp(media_id):
+def _url_descargable(media_id, meta):
+    """URL temporal del media según su metadata, o None si falta o supera el tope de tamaño."""
+    url = (meta or {}).get("url")
+    if url and int(meta.get("file_size") or 0) > MEDIA_MAX_BYTES:
+        print(f"[WARN] Media {media_id} de {meta['file_size']} bytes supera el tope; no se descarga.")
+        _metricas.contar("media_rechazada_total", motivo="tamano")
+        return None
+    return url
+
+
+class _ArchivoMedia:
+    """Destino de una descarga en streaming: archivo temporal (RAM y luego disco), sha256 y
+    tope de tamaño. agregar() devuelve False (y descarta el archivo) si se supera el tope."""
+    def __init__(self, media_id):
+        self.media_id = media_id
+        self.archivo = tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_RAM)
+        self.resumen = hashlib.sha256()
+        self.total = 0
+
+    def agregar(self, bloque):
+        self.total += len(bloque)
+        if self.total > MEDIA_MAX_BYTES:
+            self.archivo.close()
+            print(f"[WARN] Media {self.media_id} supera {MEDIA_MAX_BYTES} bytes; descarga cortada.")
+            _metricas.contar("media_rechazada_total", motivo="tamano")
+            return False
+        self.resumen.update(bloque)
+        self.archivo.write(bloque)
+        return True
+
+    def terminar(self, meta):
+        _metricas.contar("media_bytes_descargados_total", self.total)
+        self.archivo.seek(0)
+        return self.archivo, meta.get("mime_type", ""), self.resumen.hexdigest()
+
+
+def descargar_media_whatsapp(media_id, meta=None):
     """Descarga el binario de un media (audio/imagen) de WhatsApp.
 
     WhatsApp entrega media en 2 pasos: el endpoint del media_id devuelve una URL temporal,
-    y esa URL se descarga con el mismo bearer token. Devuelve (bytes, mime) o (None, None).
+    y esa URL se descarga con el mismo bearer token. Devuelve (archivo, mime, sha256) con
+    el archivo ya rebobinado (el llamador lo cierra) o (None, None, None).
     """
     if not media_id:
-        return None, None
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
+        return None, None, None
+    try:
+        meta = meta or metadata_media(media_id)
+        url = _url_descargable(media_id, meta)
+        if not url:
+            return None, None, None
+        binario = _http_con_reintentos("Descarga de media", "GET", url, endpoint="graph_media",
+                                       headers=_graph.headers_auth, stream=True)
+        if binario is None or binario.status_code != 200:
+            print("[WARN] Descarga de media falló:", getattr(binario, "status_code", "sin respuesta"))
+            return None, None, None
+        with binario:
+            destino = _ArchivoMedia(media_id)
+            for bloque in binario.iter_content(MEDIA_BLOQUE):
+                if not destino.agregar(bloque):
+                    return None, None, None
+        return destino.terminar(meta)
+    except Exception as e:
+        print("[ERROR] Error descargando media:", e)
+        return None, None, None
+
+
+async def descargar_media_async(media_id, meta):
+    """Versión asyncio de descargar_media_whatsapp (httpx en streaming)."""
     try:
-        meta = _http_con_reintentos(
-            "Metadata de media", "GET", f"https://graph.facebook.com/v18.0/{media_id}", headers=headers)
-        if meta is None or meta.status_code != 200:
-            print("[WARN] Metadata de media falló:", getattr(meta, "status_code", "sin respuesta"))
-            return None, None
-        url = meta.json().get("url")
+        url = _url_descargable(media_id, meta)
         if not url:
-            return None, None
-        binario = _http_con_reintentos("Descarga de media", "GET", url, headers=headers)
+            return None, None, None
+        binario = await _http_aio("Descarga de media", "GET", url, endpoint="graph_media",
+                                  headers=_graph.headers_auth, stream=True)
         if binario is None or binario.status_code != 200:
             print("[WARN] Descarga de media falló:", getattr(binario, "status_code", "sin respuesta"))
-            return None, None
-        return binario.content, meta.json().get("mime_type", "")
+            if binario is not None:
+                await binario.aclose()
+            return None, None, None
+        try:
+            destino = _ArchivoMedia(media_id)
+            async for bloque in binario.aiter_bytes(MEDIA_BLOQUE):
+                if not destino.agregar(bloque):
+                    return None, None, None
+        finally:
+            await binario.aclose()
+        return destino.terminar(meta)
     except Exception as e:
         print("[ERROR] Error descargando media:", e)
-        return None, None
+        return None, None, None
+
+
+# Preprocesamiento local OPCIONAL antes de Whisper (requiere el binario ffmpeg): decodifica,
+# pasa a mono 16 kHz (lo que Whisper usa internamente), recorta el silencio del principio y
+# del final y re-codifica a opus de voz de baja tasa. Una nota de voz con aire muerto sube
+# bastante menos y Whisper procesa menos segundos. ffmpeg ya corre como proceso aparte: un
+# pool de hilos limita cuántos corren a la vez y cada uno tiene timeout; si ffmpeg no está,
+# falla, tarda demasiado o el resultado no es más chico, se envía el audio original.
+# Desactivado por defecto: reduce ~50% los bytes, pero con buena subida el ahorro de red no
+# paga el CPU de ffmpeg en un dyno chico; medir con `bench_audio.py --whisper` antes de activar.
+PREPROCESAR_AUDIO = os.getenv("PREPROCESAR_AUDIO", "0") == "1"
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+AUDIO_PREPROCESO_TIMEOUT = float(os.getenv("AUDIO_PREPROCESO_TIMEOUT", "8"))   # seg.
+AUDIO_PREPROCESO_HILOS = int(os.getenv("AUDIO_PREPROCESO_HILOS", "2"))
+AUDIO_SILENCIO_DB = -45
+AUDIO_FILTRO_SILENCIO = (
+    "silenceremove=start_periods=1:start_threshold={db}dB:start_silence=0.3,areverse,"
+    "silenceremove=start_periods=1:start_threshold={db}dB:start_silence=0.3,areverse"
+)
+_pool_audio = ThreadPoolExecutor(max_workers=AUDIO_PREPROCESO_HILOS, thread_name_prefix="audio")
+_ffmpeg = []   # [ruta | None], resuelto en el primer uso
+
+
+def _ruta_ffmpeg():
+    if not _ffmpeg:
+        ruta = shutil.which(FFMPEG_BIN)
+        if ruta is None:
+            print("[INFO] ffmpeg no disponible: las notas de voz van a Whisper sin preprocesar.")
+        _ffmpeg.append(ruta)
+    return _ffmpeg[0]
+
+
+def _correr_ffmpeg(ruta, origen):
+    """Audio de `origen` → ogg/opus mono 16 kHz sin silencios en los extremos (bytes)."""
+    proceso = subprocess.run(
+        [ruta, "-hide_banner", "-loglevel", "error", "-nostdin", "-i", origen, "-vn",
+         "-ac", "1", "-ar", "16000", "-af", AUDIO_FILTRO_SILENCIO.format(db=AUDIO_SILENCIO_DB),
+         "-c:a", "libopus", "-b:a", "16k", "-application", "voip",
+         "-compression_level", "0",  # ~3x más rápido que el default (10) y casi el mismo tamaño
+         "-f", "ogg", "pipe:1"],
+        capture_output=True, timeout=AUDIO_PREPROCESO_TIMEOUT, check=True,
+    )
+    return proceso.stdout
+
+
+def preprocesar_audio(archivo, ext):
+    """Devuelve (archivo, ext) a enviar a Whisper: el audio reducido o, si no conviene o no
+    se pudo, el original rebobinado."""
+    ruta = _ruta_ffmpeg() if PREPROCESAR_AUDIO else None
+    if ruta is None:
+        return archivo, ext
+    archivo.seek(0)
+    with tempfile.NamedTemporaryFile(suffix="." + ext) as origen:
+        shutil.copyfileobj(archivo, origen)
+        origen.flush()
+        tam = origen.tell()
+        archivo.seek(0)
+        try:
+            with medir("audio_preproceso_segundos"):
+                futuro = _pool_audio.submit(_correr_ffmpeg, ruta, origen.name)
+                salida = futuro.result(timeout=AUDIO_PREPROCESO_TIMEOUT + 2)
+        except Exception as e:
+            timeout = isinstance(e, (subprocess.TimeoutExpired, TimeoutError))
+            detalle = f"más de {AUDIO_PREPROCESO_TIMEOUT}s" if timeout else e
+            if isinstance(e, subprocess.CalledProcessError):
+                detalle = (e.stderr or b"").decode("utf-8", "replace").strip()[-300:]
+            print(f"[WARN] Preprocesamiento de audio {'agotó el tiempo' if timeout else 'falló'}; "
+                  f"se envía el original: {detalle}")
+            _metricas.contar("audio_preproceso_total", resultado="timeout" if timeout else "error")
+            return archivo, ext
+    if not salida or len(salida) >= tam:
+        _metricas.contar("audio_preproceso_total", resultado="sin_ganancia")
+        return archivo, ext
+    _metricas.contar("audio_preproceso_total", resultado="ok")
+    _metricas.contar("audio_bytes_total", tam, etapa="original")
+    _metricas.contar("audio_bytes_total", len(salida), etapa="preprocesado")
+    return io.BytesIO(salida), "ogg"
+
+
+def _transcripcion_cacheada(tipo, clave):
+    if not clave:
+        return None
+    try:
+        texto = _backend.get(f"{TRANSCRIPCION_PREFIX}{tipo}:{clave}")
+        _contar_viaje_redis()
+    except Exception as e:
+        print("[WARN] Caché de transcripciones no disponible:", e)
+        return None
+    _metricas.contar("transcripcion_cache_total", resultado="hit" if texto else "miss", clave=tipo)
+    return texto
+
+
+def _cachear_transcripcion(texto, media_id, sha256):
+    try:
+        pipe = _backend.pipeline()
+        for tipo, clave in (("media", media_id), ("sha256", sha256)):
+            if clave:
+                pipe.setex(f"{TRANSCRIPCION_PREFIX}{tipo}:{clave}", TRANSCRIPCION_TTL, texto)
+        pipe.execute()
+        _contar_viaje_redis()
+    except Exception as e:
+        print("[WARN] No se pudo cachear la transcripción:", e)
 
 
 def transcribir_audio_whatsapp(audio_id):
-    """Descarga y transcribe una nota de voz de WhatsApp con Whisper. Devuelve texto o ""."""
-    audio_bytes, mime = descargar_media_whatsapp(audio_id)
-    if not audio_bytes:
+    """Descarga y transcribe una nota de voz de WhatsApp con Whisper. Devuelve texto o "".
+
+    Antes de descargar busca el audio en la caché por media-id y por el sha256 que informa
+    la metadata; después de descargar, por el sha256 calculado del contenido.
+    """
+    if not audio_id:
         return ""
-    ext = "ogg"  # WhatsApp envía las notas de voz como audio/ogg (opus)
+    texto = _transcripcion_cacheada("media", audio_id)
+    if texto:
+        return texto
+    meta = metadata_media(audio_id)
+    if meta is None:
+        return ""
+    texto = _transcripcion_cacheada("sha256", meta.get("sha256"))
+    if texto:
+        _cachear_transcripcion(texto, audio_id, None)
+        return texto
+    with medir("descarga_media_segundos"):
+        archivo, mime, sha256 = descargar_media_whatsapp(audio_id, meta)
+    if archivo is None:
+        return ""
+    with archivo:
+        if sha256 != meta.get("sha256"):
+            texto = _transcripcion_cacheada("sha256", sha256)
+            if texto:
+                _cachear_transcripcion(texto, audio_id, None)
+                return texto
+        audio, ext = preprocesar_audio(archivo, _extension_audio(mime))
+        try:
+            with medir("transcripcion_segundos"), _breakers["openai"].proteger():
+                resultado = openai_client.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=(f"audio.{ext}", audio),
+                )
+            texto = (getattr(resultado, "text", "") or "").strip()
+        except Exception as e:
+            print("[ERROR] Falló la transcripción de audio:", e)
+            _metricas.contar("errores_total", etapa="transcripcion")
+            return ""
+    if texto:
+        _cachear_transcripcion(texto, audio_id, sha256)
+    return texto
+
+
+def _extension_audio(mime):
     if "mp4" in mime or "m4a" in mime:
-        ext = "m4a"
-    elif "mpeg" in mime or "mp3" in mime:
-        ext = "mp3"
+        return "m4a"
+    if "mpeg" in mime or "mp3" in mime:
+        return "mp3"
+    return "ogg"  # WhatsApp envía las notas de voz como audio/ogg (opus)
+
+
+async def _transcripcion_cacheada_async(tipo, clave):
+    if not clave:
+        return None
     try:
-        resultado = openai_client.audio.transcriptions.create(
-            model="whisper-1",
-            file=(f"audio.{ext}", audio_bytes),
-        )
-        return (getattr(resultado, "text", "") or "").strip()
+        texto = await _backend_async.get(f"{TRANSCRIPCION_PREFIX}{tipo}:{clave}")
+        _contar_viaje_redis()
+    except Exception as e:
+        print("[WARN] Caché de transcripciones no disponible:", e)
+        return None
+    _metricas.contar("transcripcion_cache_total", resultado="hit" if texto else "miss", clave=tipo)
+    return texto
+
+
+async def _cachear_transcripcion_async(texto, media_id, sha256):
+    try:
+        pipe = _backend_async.pipeline()
+        for tipo, clave in (("media", media_id), ("sha256", sha256)):
+            if clave:
+                pipe.setex(f"{TRANSCRIPCION_PREFIX}{tipo}:{clave}", TRANSCRIPCION_TTL, texto)
+        await pipe.execute()
+        _contar_viaje_redis()
+    except Exception as e:
+        print("[WARN] No se pudo cachear la transcripción:", e)
+
+
+async def transcribir_audio_async(audio_id):
+    """Versión asyncio de transcribir_audio_whatsapp (httpx + AsyncOpenAI). Devuelve texto o ""
+    y nunca lanza: corre en paralelo con la toma del lock (ver procesar_mensaje_async).
+
+    La consulta a la caché por media-id y la metadata del media van en paralelo: en un
+    miss (lo normal: cada nota de voz es nueva) se ahorra un viaje completo.
+    """
+    if not audio_id:
+        return ""
+    try:
+        return await _transcribir_audio_async(audio_id)
     except Exception as e:
         print("[ERROR] Falló la transcripción de audio:", e)
+        _metricas.contar("errores_total", etapa="transcripcion")
+        return ""
+
+
+async def _transcribir_audio_async(audio_id):
+    texto, meta = await asyncio.gather(_transcripcion_cacheada_async("media", audio_id),
+                                       metadata_media_async(audio_id))
+    if texto:
+        return texto
+    if meta is None:
         return ""
+    texto = await _transcripcion_cacheada_async("sha256", meta.get("sha256"))
+    if texto:
+        await _cachear_transcripcion_async(texto, audio_id, None)
+        return texto
+    with medir("descarga_media_segundos"):
+        archivo, mime, sha256 = await descargar_media_async(audio_id, meta)
+    if archivo is None:
+        return ""
+    with archivo:
+        if sha256 != meta.get("sha256"):
+            texto = await _transcripcion_cacheada_async("sha256", sha256)
+            if texto:
+                await _cachear_transcripcion_async(texto, audio_id, None)
+                return texto
+        audio, ext = await asyncio.to_thread(preprocesar_audio, archivo, _extension_audio(mime))
+        try:
+            with medir("transcripcion_segundos"), _breakers["openai"].proteger():
+                resultado = await openai_async.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=(f"audio.{ext}", audio),
+                )
+            texto = (getattr(resultado, "text", "") or "").strip()
+        except Exception as e:
+            print("[ERROR] Falló la transcripción de audio:", e)
+            _metricas.contar("errores_total", etapa="transcripcion")
+            return ""
+    if texto:
+        await _cachear_transcripcion_async(texto, audio_id, sha256)
+    return texto
+
+
+# ---------------------------------------------
+# ✅ Outbox de Google Sheets (write-behind por lotes)
+# ---------------------------------------------
+# Cada fila para Sheets (Interesados / SolicitudesHumano) se deja en una lista del backend
+# (RPUSH, un viaje a Redis) y el webhook sigue sin esperar a Google. Un hilo "flusher" drena
+# cada lista con append_rows en lotes, por tamaño (OUTBOX_LOTE) o por tiempo (OUTBOX_INTERVALO),
+# y recién BORRA las filas de la lista cuando Google confirmó la escritura: un reinicio o una
+# caída de Sheets no pierde nada (a lo sumo, una fila se escribe dos veces). Entre procesos,
+# un lock por hoja evita que dos flushers suban el mismo lote; se renueva mientras dura la subida
+# (con reintentos puede pasar del lease) y si se pierde, el lote no se borra.
+# Un lote que Google RECHAZA (4xx que no es 429: datos inválidos, hoja borrada…) no se arregla
+# reintentando: tras OUTBOX_MAX_RECHAZOS rechazos seguidos pasa a la lista de filas muertas
+# (`outbox:sheets:muertas:<hoja>`) para revisarlo a mano, y la cola sigue. Las caídas de Sheets
+# (red, 5xx, circuito abierto) no cuentan: esas filas esperan. Una fila que ni siquiera es JSON
+# válido va directo a las muertas.
+OUTBOX_PREFIX = "outbox:sheets:"
+OUTBOX_MUERTAS_PREFIX = OUTBOX_PREFIX + "muertas:"
+OUTBOX_LOTE = int(os.getenv("OUTBOX_LOTE", "50"))                  # filas máx. por append_rows
+OUTBOX_INTERVALO = float(os.getenv("OUTBOX_INTERVALO", "10"))      # seg. entre vaciados
+OUTBOX_LOCK_LEASE = 60                                             # seg.; se renueva cada tercio
+OUTBOX_MAX_RECHAZOS = int(os.getenv("OUTBOX_MAX_RECHAZOS", "3"))
+
+_outbox_lock = threading.Lock()
+_outbox_despertar = threading.Event()
+_outbox_hilo = []
+_outbox_rechazos = {}   # hoja → (primera fila del lote rechazado, rechazos seguidos)
+
+
+def _hoja_sheets(nombre):
+    return _hojas.obtener()[nombre]
+
+
+def _encolar_fila(hoja, fila):
+    """Deja la fila en el outbox de la hoja; si el backend falla, la escribe directo.
+
+    Dentro de un mensaje en curso la fila viaja en el pipeline final de su _ContextoPeticion.
+    """
+    peticion = _peticion_actual.get()
+    if peticion is not None and peticion.cargada:
+        peticion.filas.append((hoja, fila))
+        return
+    try:
+        pendientes = _backend.rpush(OUTBOX_PREFIX + hoja, json.dumps(fila, ensure_ascii=False))
+        _contar_viaje_redis()
+    except Exception as e:
+        print(f"[WARN] Outbox {hoja} no disponible ({e}); escritura directa en Sheets.")
+        _escribir_fila_directo(hoja, fila)
+        return
+    _filas_encoladas([(hoja, fila)], [pendientes])
+
+
+def _escribir_fila_directo(hoja, fila):
+    with medir("sheets_append_segundos", hoja=hoja):
+        _con_reintentos(f"Registro en hoja {hoja}", lambda: _hoja_sheets(hoja).append_row(fila))
+
+
+def _filas_encoladas(filas, pendientes):
+    """Métricas + flusher tras el RPUSH de `filas` (`pendientes`: largo de la lista tras cada uno)."""
+    for hoja, _ in filas:
+        _metricas.contar("outbox_encoladas_total", hoja=hoja)
+    _asegurar_flusher()
+    if max(pendientes) >= OUTBOX_LOTE:
+        _outbox_despertar.set()
+
+
+def vaciar_outbox(hoja):
+    """Sube a Sheets un lote pendiente de la hoja. Devuelve cuántas filas sacó de la lista."""
+    clave = OUTBOX_PREFIX + hoja
+    lock = _backend.lock("lock:" + clave, timeout=OUTBOX_LOCK_LEASE, blocking_timeout=0, thread_local=False)
+    if not lock.acquire():
+        return 0  # otro proceso está vaciando esta hoja
+    try:
+        crudas = _backend.lrange(clave, 0, OUTBOX_LOTE - 1)
+        if not crudas:
+            return 0
+        filas, invalidas = [], []
+        for cruda in crudas:
+            try:
+                filas.append(json.loads(cruda))
+            except ValueError:
+                invalidas.append(cruda)
+
+        def subir():
+            try:
+                _hoja_sheets(hoja).append_rows(filas)
+            except gspread.exceptions.APIError as e:
+                if 400 <= e.response.status_code < 500 and e.response.status_code != 429:
+                    return e  # rechazo del lote: reintentar no lo arregla
+                raise
+            return True
+
+        resultado = True
+        if filas:
+            with medir("sheets_append_segundos", hoja=hoja):
+                futuro = _ejecutar_con_reintentos(f"Registro en hoja {hoja}", "sheets", subir)
+                resultado = _esperar_renovando(futuro, lock, f"outbox {hoja}")
+        if resultado is None:  # caída de Sheets, lock perdido o circuito abierto: el lote espera
+            _metricas.contar("errores_total", etapa="sheets")
+            return 0
+        if resultado is not True:
+            _metricas.contar("errores_total", etapa="sheets")
+            if not _rechazo_definitivo(hoja, crudas[0], resultado):
+                return 0
+            invalidas, filas = crudas, []
+        _outbox_rechazos.pop(hoja, None)
+        pipe = _backend.pipeline()
+        if invalidas:
+            pipe.rpush(OUTBOX_MUERTAS_PREFIX + hoja, *invalidas)
+        pipe.ltrim(clave, len(crudas), -1)
+        pipe.execute()
+        _metricas.contar("outbox_escritas_total", len(filas), hoja=hoja)
+        if invalidas:
+            print(f"[ERROR] Outbox {hoja}: {len(invalidas)} filas pasan a {OUTBOX_MUERTAS_PREFIX + hoja}.")
+            _metricas.contar("outbox_muertas_total", len(invalidas), hoja=hoja)
+        return len(crudas)
+    finally:
+        try:
+            lock.release()
+        except Exception:
+            pass
+
+
+def _esperar_renovando(futuro, lock, descripcion):
+    """Resultado de `futuro` renovando `lock` mientras tanto; None si el lock se perdió (otro
+    flusher pudo tomar el mismo lote, así que este no debe borrarlo)."""
+    perdido = False
+    while True:
+        try:
+            resultado = futuro.result(timeout=OUTBOX_LOCK_LEASE / 3)
+            return None if perdido else resultado
+        except TimeoutError:
+            if perdido:
+                continue
+            try:
+                lock.reacquire()
+            except Exception as e:
+                print(f"[WARN] No se pudo renovar el lock de {descripcion}; el lote no se borrará:", e)
+                perdido = True
+
+
+def _rechazo_definitivo(hoja, primera, error):
+    """Cuenta un rechazo del lote que empieza en `primera`; True si ya hay que descartarlo."""
+    previa, rechazos = _outbox_rechazos.get(hoja, (None, 0))
+    rechazos = rechazos + 1 if previa == primera else 1
+    _outbox_rechazos[hoja] = (primera, rechazos)
+    print(f"[WARN] Outbox {hoja}: Sheets rechazó el lote ({rechazos}/{OUTBOX_MAX_RECHAZOS}): {error}")
+    return rechazos >= OUTBOX_MAX_RECHAZOS
+
+
+def _flusher_outbox():
+    while True:
+        _outbox_despertar.wait(OUTBOX_INTERVALO)
+        _outbox_despertar.clear()
+        for hoja in ("Interesados", "SolicitudesHumano"):
+            try:
+                # Mientras salgan lotes llenos hay más pendiente: seguir vaciando.
+                while vaciar_outbox(hoja) >= OUTBOX_LOTE:
+                    pass
+            except Exception as e:
+                print(f"[ERROR] Flusher del outbox ({hoja}):", e)
+
+
+def _asegurar_flusher():
+    with _outbox_lock:
+        if _outbox_hilo:
+            return
+        hilo = threading.Thread(target=_flusher_outbox, name="outbox-sheets", daemon=True)
+        hilo.start()
+        _outbox_hilo.append(hilo)
+
+
+def estado_outbox():
+    profundidad, muertas = {}, {}
+    for hoja in ("Interesados", "SolicitudesHumano"):
+        try:
+            profundidad[hoja] = _backend.llen(OUTBOX_PREFIX + hoja)
+            muertas[hoja] = _backend.llen(OUTBOX_MUERTAS_PREFIX + hoja)
+        except Exception:
+            profundidad[hoja] = muertas[hoja] = None
+    return {"profundidad": profundidad, "muertas": muertas,
+            "encoladas": sum(_metricas.valor("outbox_encoladas_total", hoja=h) for h in profundidad),
+            "escritas": sum(_metricas.valor("outbox_escritas_total", hoja=h) for h in profundidad),
+            "errores": _metricas.valor("errores_total", etapa="sheets")}
 
 
 def registrar_interesado(phone, message, nombre="", disciplina="", turno="", dia=""):
     fecha = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-    _con_reintentos(
-        "Registro en hoja Interesados",
-        lambda: interesados_sheet.append_row([phone, message, fecha, nombre, disciplina, turno, dia]),
-    )
+    _encolar_fila("Interesados", [phone, message, fecha, nombre, disciplina, turno, dia])
 
 
 def registrar_solicitud_humana(phone, message):
     fecha = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-    _con_reintentos(
-        "Registro en hoja SolicitudesHumano",
-        lambda: solicitudes_sheet.append_row([phone, message, fecha]),
-    )
+    _encolar_fila("SolicitudesHumano", [phone, message, fecha])
 
 
 def agregar_saludo(texto, phone):
     """Antepone el nombre del usuario si está disponible en el contexto."""
-    nombre = (cargar_contexto(phone) or {}).get("nombre")
+    nombre = leer_campo_perfil(phone, "nombre")
     return f"¡Hola, {nombre}! 😊\n\n{texto}" if nombre else texto
 
 
@@ -775,7 +3780,7 @@ def solicitar_asistencia_humana(user_phone: str, user_message: str) -> str:
         f"🧵 Conversación reciente:\n{historial_txt}"
     )
     for admin_phone in notificar_humanos:
-        send_message(aviso, admin_phone)
+        send_message(aviso, admin_phone, prioridad=PRIORIDAD_AVISO)
     return "Notificación enviada al equipo humano y solicitud registrada."
 
 
@@ -792,36 +3797,185 @@ def guardar_datos_prospecto(user_phone: str, nombre: str = "", disciplina: str =
     Puedes llamarla varias veces a medida que obtienes más datos; envía siempre todos los
     que tengas hasta el momento (los que aún no conozcas déjalos vacíos).
     """
-    ctx = cargar_contexto(user_phone) or {}
-    if nombre:
-        ctx["nombre"] = nombre
-    if disciplina:
-        ctx["disciplina_raw"] = disciplina
-    if turno:
-        ctx["turno_raw"] = turno
-    if dia:
-        ctx["dia_raw"] = dia
-    ctx.setdefault("history", [])
-    ctx["last_seen"] = time.time()
-    guardar_contexto(user_phone, ctx)
+    # Solo se tocan los campos del hash de perfil (HSET): el historial ni se lee.
+    perfil = actualizar_perfil(user_phone, nombre=nombre, disciplina_raw=disciplina,
+                               turno_raw=turno, dia_raw=dia, last_seen=time.time())
     registrar_interesado(
         user_phone,
         "[DATOS PROSPECTO]",
-        nombre=ctx.get("nombre", ""),
-        disciplina=ctx.get("disciplina_raw", ""),
-        turno=ctx.get("turno_raw", ""),
-        dia=ctx.get("dia_raw", ""),
+        nombre=perfil.get("nombre", ""),
+        disciplina=perfil.get("disciplina_raw", ""),
+        turno=perfil.get("turno_raw", ""),
+        dia=perfil.get("dia_raw", ""),
     )
     return "Datos del prospecto guardados."
 
 
-# Agente instanciado una sola vez al arrancar (no en cada request)
-kudo_agent = Agent(
+# Agente instanciado una sola vez (en el calentamiento o el primer uso, no en cada request)
+kudo_agent = _Perezoso("agente", lambda: Agent(
     name="KUDO Bolivia Assistant",
     model="gpt-4.1",
     instructions=SYSTEM_PROMPT,
     tools=[solicitar_asistencia_humana, guardar_datos_prospecto],
-)
+))
+
+
+# ---------------------------------------------
+# ✅ Respuesta del agente en streaming (fragmento a fragmento)
+# ---------------------------------------------
+# Con Runner.run_sync el primer mensaje al usuario sale recién cuando el agente terminó de
+# generar TODO el texto. En modo streaming (STREAMING_RESPUESTAS=1) se usa Runner.run_streamed
+# y los tokens se acumulan en fragmentos del tamaño de un mensaje de WhatsApp, cortados en
+# fin de párrafo o de oración, y cada fragmento sale apenas está listo. El texto de un turno
+# que empieza llamando a una herramienta (un "déjame anotar tus datos…") no es la respuesta:
+# los fragmentos de cada turno esperan solo hasta su primer item de salida — si es un
+# `message` salen (y los siguientes en cuanto se forman), si es un `function_call` el turno se
+# descarta. Si la corrida falla con fragmentos ya enviados, ese texto parcial queda en el
+# historial antes de la disculpa (ver AgenteInterrumpido).
+STREAMING_RESPUESTAS = os.getenv("STREAMING_RESPUESTAS", "0") == "1"
+STREAM_MIN_PARRAFO = 160      # un párrafo más corto espera al siguiente (no spamear mensajitos)
+STREAM_MIN_ORACION = 350      # a partir de aquí se corta también en fin de oración
+STREAM_MAX_CHARS = 3500       # tope duro (WhatsApp admite 4096 caracteres por mensaje)
+MARCA_MENU = "[[MENU]]"
+# Si OpenAI no responde (o su circuito está abierto) el usuario recibe esto + el menú.
+RESPUESTA_AGENTE_CAIDO = ("Uy, en este momento no puedo responderte bien 🙏. Mientras tanto, "
+                          "aquí tienes el menú con la info del dojo; en un ratito vuelvo a estar al 100% 🥋")
+_FIN_ORACION = re.compile(r"[.!?…](?=\s)|\n")
+
+
+class _FragmentadorWhatsApp:
+    """Acumula deltas de texto y devuelve los fragmentos listos para enviar.
+
+    Quita la marca [[MENU]] aunque llegue partida entre deltas: el final del buffer que
+    todavía podría ser el comienzo de la marca no se emite hasta saber qué es.
+    """
+    def __init__(self):
+        self.buffer = ""
+        self.mostrar_menu = False
+
+    def agregar(self, delta):
+        self.buffer += delta
+        if MARCA_MENU in self.buffer:
+            self.mostrar_menu = True
+            self.buffer = self.buffer.replace(MARCA_MENU, "")
+        listos = []
+        while True:
+            corte = self._corte(self._seguro())
+            if corte is None:
+                return listos
+            fragmento, self.buffer = self.buffer[:corte].strip(), self.buffer[corte:]
+            if fragmento:
+                listos.append(fragmento)
+
+    def cerrar(self):
+        resto = self.buffer.replace(MARCA_MENU, "").strip()
+        self.buffer = ""
+        return [resto] if resto else []
+
+    def _seguro(self):
+        """Longitud del prefijo del buffer que no puede ser parte de una marca [[MENU]]."""
+        for n in range(min(len(MARCA_MENU) - 1, len(self.buffer)), 0, -1):
+            if MARCA_MENU.startswith(self.buffer[-n:]):
+                return len(self.buffer) - n
+        return len(self.buffer)
+
+    def _corte(self, limite):
+        texto = self.buffer[:limite]
+        parrafo = texto.rfind("\n\n")
+        if parrafo >= STREAM_MIN_PARRAFO:
+            return parrafo + 2
+        if len(texto) >= STREAM_MIN_ORACION:
+            fines = [m.end() for m in _FIN_ORACION.finditer(texto)]
+            if fines and fines[-1] >= STREAM_MIN_PARRAFO:
+                return fines[-1]
+        if len(texto) >= STREAM_MAX_CHARS:
+            espacio = texto.rfind(" ", 0, STREAM_MAX_CHARS)
+            return espacio if espacio > 0 else STREAM_MAX_CHARS
+        return None
+
+
+def contar_tokens_agente(resultado):
+    """Suma a las métricas los tokens LLM consumidos en una corrida del agente."""
+    uso = getattr(getattr(resultado, "context_wrapper", None), "usage", None)
+    if uso is not None:
+        _metricas.contar("llm_tokens_total", getattr(uso, "input_tokens", 0) or 0, uso="agente", tipo="entrada")
+        _metricas.contar("llm_tokens_total", getattr(uso, "output_tokens", 0) or 0, uso="agente", tipo="salida")
+
+
+def correr_agente_en_streaming(agent_input, user_phone):
+    """Corre el agente en streaming enviando cada fragmento apenas está listo.
+
+    Devuelve (texto completo sin la marca, mostrar_menu) para guardar en el historial;
+    el menú interactivo lo sigue enviando el llamador al final.
+    """
+    return asyncio.run(agente_en_streaming(agent_input, user_phone))
+
+
+class AgenteInterrumpido(Exception):
+    """La corrida en streaming falló después de enviar `parcial` al usuario."""
+    def __init__(self, parcial, error):
+        super().__init__(str(error))
+        self.parcial = parcial
+
+
+async def agente_en_streaming(agent_input, user_phone):
+    """correr_agente_en_streaming dentro de un loop ya corriendo (pipeline asíncrono)."""
+    enviados = []
+    try:
+        mostrar_menu = await _enviar_turno_final(agent_input, user_phone, enviados)
+    except Exception as e:
+        if enviados:
+            raise AgenteInterrumpido("\n\n".join(enviados), e) from e
+        raise
+    return "\n\n".join(enviados), mostrar_menu
+
+
+async def _enviar_turno_final(agent_input, user_phone, enviados):
+    """Corre el agente y envía (agregando a `enviados`) el texto de sus turnos de respuesta;
+    devuelve mostrar_menu."""
+    def enviar(fragmentos):
+        for fragmento in fragmentos:
+            send_message(fragmento, user_phone)
+            enviados.append(fragmento)
+
+    # Por turno: `turno` retiene fragmentos mientras `clase` (el tipo de su primer item de
+    # salida: "message" o "function_call") no se conoce.
+    fragmentador, turno, clase = _FragmentadorWhatsApp(), [], None
+    resultado = Runner.run_streamed(kudo_agent.obtener(), agent_input)
+    async for evento in resultado.stream_events():
+        if evento.type != "raw_response_event":
+            continue
+        tipo = getattr(evento.data, "type", "")
+        if tipo == "response.created":           # nuevo turno del modelo
+            fragmentador, turno, clase = _FragmentadorWhatsApp(), [], None
+        elif tipo == "response.output_text.delta":
+            listos = fragmentador.agregar(evento.data.delta)
+            if clase == "message":
+                enviar(listos)
+            else:
+                turno.extend(listos)
+        elif tipo == "response.output_item.added" and clase is None and \
+                getattr(evento.data.item, "type", "") in ("message", "function_call"):
+            clase = evento.data.item.type
+            if clase == "message":
+                enviar(turno)
+                turno = []
+        elif tipo == "response.completed" and clase != "function_call":
+            enviar(turno + fragmentador.cerrar())
+            turno = []
+        elif tipo == "response.completed" and (turno or fragmentador.buffer.strip()):
+            print(f"[INFO] Streaming: se descarta el texto previo a una herramienta para {user_phone}.")
+            _metricas.contar("stream_preambulos_descartados_total")
+    contar_tokens_agente(resultado)
+    if not enviados:
+        # Sin deltas de texto (raro): usar la salida final como en modo no-streaming.
+        final = str(getattr(resultado, "final_output", "") or "")
+        fragmentador.mostrar_menu = fragmentador.mostrar_menu or MARCA_MENU in final
+        final = final.replace(MARCA_MENU, "").strip()
+        if final:
+            send_message(final, user_phone)
+            enviados.append(final)
+    return fragmentador.mostrar_menu
 
 
 # ---------------------------------------------
@@ -840,9 +3994,141 @@ def get_or_init_user_context(user_phone: str, ahora: float):
 
 
 def append_to_history(ctx: dict, role: str, content: str):
-    ctx["history"].append({"role": role, "content": content})
+    """Agrega el mensaje al historial EN MEMORIA y lo devuelve; para persistirlo, pasarlo
+    en `nuevos` a guardar_contexto (RPUSH a la lista, sin reescribir el historial)."""
+    mensaje = {"role": role, "content": content}
+    ctx["history"].append(mensaje)
     if len(ctx["history"]) > (MAX_TURNOS * 2):
         ctx["history"] = ctx["history"][-(MAX_TURNOS * 2):]
+    return mensaje
+
+
+# ---------------------------------------------
+# ✅ Compactación del historial por presupuesto de tokens
+# ---------------------------------------------
+# El historial completo (hasta MAX_TURNOS * 2 mensajes) se re-serializa en CADA prompt junto
+# al SYSTEM_PROMPT, así que tokens y latencia crecen con la conversación. Cuando el historial
+# supera HISTORIAL_PRESUPUESTO_TOKENS, los mensajes más antiguos se condensan en un resumen
+# acumulado (ctx["resumen"]) y solo los HISTORIAL_RECIENTES últimos quedan textuales. El
+# resumen se genera FUERA del camino crítico, en un hilo aparte, después de responder.
+HISTORIAL_PRESUPUESTO_TOKENS = int(os.getenv("HISTORIAL_PRESUPUESTO_TOKENS", "1200"))
+HISTORIAL_RECIENTES = int(os.getenv("HISTORIAL_RECIENTES", "8"))   # mensajes que no se resumen
+MODELO_RESUMEN = os.getenv("MODELO_RESUMEN", "gpt-4.1-mini")
+
+_pool_resumenes = ThreadPoolExecutor(max_workers=2, thread_name_prefix="resumen")
+_resumiendo = set()               # teléfonos con una compactación en curso
+_resumiendo_lock = threading.Lock()
+_tokens_fijos = {}
+
+
+def _cargar_tokenizador():
+    import tiktoken
+    return tiktoken.get_encoding("o200k_base")  # familia gpt-4o / 4.1
+
+
+# Cargar el BPE de tiktoken tarda (y la primera vez lo descarga): se hace en el calentamiento,
+# nunca dentro de un mensaje. No crítico: mientras no esté (o si tiktoken no está instalado)
+# se estima con ~4 caracteres por token.
+_tokenizador = _Perezoso("tiktoken", _cargar_tokenizador, critico=False)
+
+
+def estimar_tokens(texto):
+    """Tokens de `texto` con el tokenizador del modelo (tiktoken) si ya está cargado o, si no,
+    una aproximación de ~4 caracteres por token."""
+    if not _tokenizador._listo:
+        return len(texto) // 4 + 1
+    return len(_tokenizador.encode(texto, disallowed_special=()))
+
+
+def tokens_prompt_sistema():
+    """Tokens del SYSTEM_PROMPT (fijo: se calcula una vez, con el tokenizador ya cargado)."""
+    if not _tokenizador._listo:
+        return estimar_tokens(SYSTEM_PROMPT)
+    if "sistema" not in _tokens_fijos:
+        _tokens_fijos["sistema"] = estimar_tokens(SYSTEM_PROMPT)
+    return _tokens_fijos["sistema"]
+
+
+def tokens_historial(history):
+    return sum(estimar_tokens(it.get("content", "")) + 4 for it in history)
+
+
+def programar_compactacion(user_phone, ctx):
+    """Si el historial excede el presupuesto, encarga su compactación en segundo plano."""
+    if len(ctx.get("history", [])) <= HISTORIAL_RECIENTES:
+        return
+    if tokens_historial(ctx["history"]) <= HISTORIAL_PRESUPUESTO_TOKENS:
+        return
+    with _resumiendo_lock:
+        if user_phone in _resumiendo:
+            return
+        _resumiendo.add(user_phone)
+    peticion = _peticion_actual.get()
+    if peticion is None:
+        _pool_resumenes.submit(_compactar_historial, user_phone)
+    else:
+        # Después del guardado de la petición: así lee el historial con el turno recién agregado.
+        peticion.etapas.lanzar("compactacion", _compactar_historial, user_phone,
+                               depende=("guardado",), pool=_pool_resumenes)
+
+
+def _compactar_historial(user_phone):
+    try:
+        ctx = cargar_contexto(user_phone) or {}
+        antiguos = ctx.get("history", [])[:-HISTORIAL_RECIENTES]
+        if not antiguos:
+            return
+        resumen = resumir_conversacion(ctx.get("resumen", ""), antiguos)
+        if not resumen:
+            return
+        # El LLM corrió sin el lock; ahora, con el lock, aplicamos el resumen solo si esos
+        # mensajes siguen al principio del historial (si no, se reintenta en el próximo turno).
+        with _BloqueoTelefono(user_phone):
+            ctx = cargar_contexto(user_phone) or {}
+            history = ctx.get("history", [])
+            if history[:len(antiguos)] != antiguos:
+                return
+            ctx["resumen"] = resumen
+            guardar_contexto(user_phone, ctx)
+            _backend.ltrim(HIST_PREFIX + user_phone, len(antiguos), -1)
+        print(f"[INFO] Historial de {user_phone} compactado: {len(antiguos)} mensajes → resumen "
+              f"de {estimar_tokens(resumen)} tokens.")
+    except Exception as e:
+        print(f"[WARN] No se pudo compactar el historial de {user_phone}:", e)
+    finally:
+        with _resumiendo_lock:
+            _resumiendo.discard(user_phone)
+
+
+def resumir_conversacion(resumen_previo, mensajes):
+    """Condensa el resumen previo + mensajes antiguos en un resumen breve (LLM barato)."""
+    transcript = "\n".join(
+        f"{'Usuario' if it.get('role') == 'user' else 'Asistente'}: {it.get('content', '')}"
+        for it in mensajes
+    )
+    with _breakers["openai"].proteger():
+        respuesta = _crear_resumen(resumen_previo, transcript)
+    if getattr(respuesta, "usage", None) is not None:
+        _metricas.contar("llm_tokens_total", respuesta.usage.prompt_tokens or 0, uso="resumen", tipo="entrada")
+        _metricas.contar("llm_tokens_total", respuesta.usage.completion_tokens or 0, uso="resumen", tipo="salida")
+    return (respuesta.choices[0].message.content or "").strip()
+
+
+def _crear_resumen(resumen_previo, transcript):
+    return openai_client.chat.completions.create(
+        model=MODELO_RESUMEN,
+        messages=[
+            {"role": "system", "content": (
+                "Resume esta conversación de WhatsApp entre un prospecto y el asistente de un "
+                "dojo de artes marciales, en español y en máximo 6 viñetas breves. Conserva los "
+                "datos del prospecto (nombre, edad, disciplina, turno, día, dudas, objeciones), "
+                "lo que ya se le respondió y lo que quedó pendiente. No inventes nada.")},
+            {"role": "user", "content": (
+                (f"RESUMEN PREVIO:\n{resumen_previo}\n\n" if resumen_previo else "") +
+                f"MENSAJES A INCORPORAR:\n{transcript}")},
+        ],
+        temperature=0,
+    )
 
 
 def construir_bloque_winter_camp(hoy):
@@ -906,6 +4192,9 @@ def build_agent_input(user_phone: str, user_msg: str, history: list, perfil: dic
         if partes:
             perfil_texto = "PERFIL_DEL_PROSPECTO:\n" + "\n".join(partes) + "\n\n"
 
+    if perfil and perfil.get("resumen"):
+        perfil_texto += f"RESUMEN_CONVERSACION_ANTERIOR:\n{perfil['resumen']}\n\n"
+
     if historial_texto:
         return (
             f"TELÉFONO_USUARIO: {user_phone}\n"
@@ -922,23 +4211,238 @@ def build_agent_input(user_phone: str, user_msg: str, history: list, perfil: dic
     )
 
 
+# ---------------------------------------------
+# ✅ Cola de trabajo del webhook (acuse inmediato + workers en segundo plano)
+# ---------------------------------------------
+# Procesar un mensaje (transcripción, agente, Sheets, envíos) tarda 10–30 s y Meta reintenta
+# la entrega si el webhook no responde rápido. Con COLA_WEBHOOK=1 el webhook solo encola el
+# payload en el backend (lista Redis, o la memoria local si no hay REDIS_URL) y responde al
+# instante; un pool de workers corre el pipeline. Los workers viven como hilos dentro del
+# proceso web y/o como procesos aparte (`python app.py worker`, requiere Redis para compartir cola).
+# El proceso worker es OPCIONAL: solo tiene sentido con COLA_WEBHOOK=1; en ese caso agregar al
+# Procfile la línea `worker: python app.py worker` (y COLA_WORKERS_EN_WEB=0 si solo él procesa).
+#
+# Entrega al menos una vez: cada worker MUEVE el payload (BLMOVE) a su propia lista de "en
+# proceso" y lo quita (LREM) recién cuando terminó. Si el proceso muere a mitad (crash, SIGTERM
+# fuera de plazo, deploy) el payload queda ahí. Cada proceso con workers se anota en el hash
+# `cola:procesos` (proceso → nº de hilos) y mantiene un latido (`cola:vivo:<proceso>`) desde un
+# hilo propio, así un worker ocupado minutos con un mensaje no deja de latir. Ese mismo hilo,
+# una vez por COLA_VIVO_TTL, devuelve a la cabeza de la cola las listas en proceso de los
+# procesos anotados sin latido (sin SCAN: solo el hash y un GET por proceso). Reprocesar es
+# seguro: la idempotencia por wamid descarta lo que ya se atendió.
+COLA_WEBHOOK = os.getenv("COLA_WEBHOOK", "0") == "1"
+COLA_CLAVE = "cola:webhook"
+COLA_PROCESANDO_PREFIX = "cola:procesando:"                            # + <proceso>:<hilo>
+COLA_VIVO_PREFIX = "cola:vivo:"                                        # + <proceso>, con TTL
+COLA_PROCESOS = "cola:procesos"                                        # hash proceso → nº de hilos
+COLA_VIVO_TTL = 30
+COLA_WORKERS = int(os.getenv("COLA_WORKERS", "4"))                     # hilos por proceso
+COLA_WORKERS_EN_WEB = os.getenv("COLA_WORKERS_EN_WEB", "1") == "1"     # 0 = solo procesos worker
+COLA_ESPERA_BLPOP = 5                                                  # seg. por ciclo de blmove
+
+_cola_lock = threading.Lock()
+_cola_hilos = []
+_cola_latido = []
+_apagando = threading.Event()
+
+
+def encolar_payload(data):
+    """Encola el payload crudo del webhook (con la hora de llegada) para los workers."""
+    _asegurar_workers_cola()
+    sobre = json.dumps({"recibido": time.time(), "data": data}, ensure_ascii=False)
+    _backend.rpush(COLA_CLAVE, sobre)
+    _metricas.contar("cola_encolados_total")
+
+
+def _worker_cola(indice=0):
+    """Bucle de un worker: mueve payloads de la cola a su lista en proceso, corre el pipeline
+    completo y recién entonces los quita de ahí."""
+    procesando = f"{COLA_PROCESANDO_PREFIX}{_metricas_id}:{indice}"
+    while not _apagando.is_set():  # al apagar, lo que quede en la cola es para otro proceso
+        try:
+            item = _backend.blmove(COLA_CLAVE, procesando, COLA_ESPERA_BLPOP, "LEFT", "RIGHT")
+        except Exception as e:
+            print("[ERROR] Worker de cola: no se pudo leer la cola:", e)
+            time.sleep(COLA_ESPERA_BLPOP)
+            continue
+        if not item:
+            continue
+        inicio = time.time()
+        try:
+            sobre = json.loads(item)
+            _metricas.observar("cola_espera_segundos", inicio - sobre.get("recibido", inicio))
+            with medir("cola_proceso_segundos"):
+                procesar_payload(sobre.get("data") or {})
+        except Exception as e:
+            print("[ERROR] Worker de cola: payload inválido:", e)
+            _metricas.contar("errores_total", etapa="cola")
+        try:
+            _backend.lrem(procesando, 1, item)
+        except Exception as e:
+            # Queda en la lista en proceso: se reprocesará (y la dedup por wamid lo descartará).
+            print("[WARN] Worker de cola: no se pudo confirmar el payload:", e)
+        _metricas.contar("cola_procesados_total")
+
+
+def _latir_cola(hilos):
+    """Hilo de latido del proceso: renueva `cola:vivo:<proceso>` cada COLA_VIVO_TTL/3 s
+    (aunque todos los workers estén ocupados) y recupera huérfanos una vez por COLA_VIVO_TTL."""
+    proxima_recuperacion = 0.0
+    while not _apagando.is_set():
+        try:
+            _backend.setex(COLA_VIVO_PREFIX + _metricas_id, COLA_VIVO_TTL, "1")
+            _backend.hset(COLA_PROCESOS, _metricas_id, hilos)
+            if time.monotonic() >= proxima_recuperacion:
+                proxima_recuperacion = time.monotonic() + COLA_VIVO_TTL
+                _recuperar_cola_huerfana()
+        except Exception as e:
+            print("[WARN] Cola del webhook: no se pudo renovar el latido:", e)
+        _apagando.wait(COLA_VIVO_TTL / 3)
+
+
+def _recuperar_cola_huerfana():
+    """Devuelve a la cabeza de la cola los payloads en proceso de procesos sin latido."""
+    for proceso, hilos in _backend.hgetall(COLA_PROCESOS).items():
+        if proceso == _metricas_id or _backend.get(COLA_VIVO_PREFIX + proceso):
+            continue
+        recuperados = 0
+        for indice in range(int(hilos)):
+            clave = f"{COLA_PROCESANDO_PREFIX}{proceso}:{indice}"
+            while _backend.lmove(clave, COLA_CLAVE, "RIGHT", "LEFT") is not None:
+                recuperados += 1
+        _backend.hdel(COLA_PROCESOS, proceso)
+        if recuperados:
+            print(f"[WARN] Cola del webhook: {recuperados} payloads de {proceso} (sin latido) vuelven a la cola.")
+            _metricas.contar("cola_recuperados_total", recuperados)
+
+
+def _asegurar_workers_cola(forzar=False):
+    """Arranca (una sola vez por proceso) los hilos worker de la cola."""
+    if not (COLA_WORKERS_EN_WEB or forzar):
+        return
+    with _cola_lock:
+        if _cola_hilos:
+            return
+        hilos = max(1, COLA_WORKERS)
+        latido = threading.Thread(target=_latir_cola, args=(hilos,), name="cola-latido", daemon=True)
+        latido.start()
+        _cola_latido[:] = [latido]
+        for i in range(hilos):
+            hilo = threading.Thread(target=_worker_cola, args=(i,), name=f"cola-worker-{i}", daemon=True)
+            hilo.start()
+            _cola_hilos.append(hilo)
+    print(f"[INFO] Cola del webhook: {len(_cola_hilos)} workers iniciados.")
+
+
+def estado_cola():
+    """Métricas de la cola: profundidad actual, contadores y latencias de espera/proceso."""
+    try:
+        profundidad = _backend.llen(COLA_CLAVE)
+    except Exception:
+        profundidad = None
+    return {"activa": COLA_WEBHOOK, "profundidad": profundidad, "workers_locales": len(_cola_hilos),
+            "encolados": _metricas.valor("cola_encolados_total"),
+            "procesados": _metricas.valor("cola_procesados_total"),
+            "errores": _metricas.valor("errores_total", etapa="cola")}
+
+
 # ---------------------------------------------
 # Webhooks
 # ---------------------------------------------
 DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
 
+# /debug/contexto recorre las claves con SCAN (nunca KEYS, que bloquea Redis) por páginas:
+# cada página se lee con un MGET de payloads + un pipeline de perfiles/historiales y se
+# emite como NDJSON (una línea por usuario) sin juntar todo en memoria. Una respuesta
+# recorre a lo sumo `limite` claves; la última línea trae el cursor para continuar.
+DEBUG_PAGINA = 200
+DEBUG_LIMITE = 5000
+CAMPOS_DEBUG = ("perfil", "payload", "historial")
+
+
 @app.route("/debug/contexto", methods=["GET"])
 def debug_contexto():
+    """Vuelca los contextos en NDJSON.
+
+    Parámetros: cursor (0 = desde el principio), pagina, limite, campos (proyección,
+    p. ej. campos=perfil; por defecto perfil,payload,historial) y desde/hasta (filtro
+    por last_seen en epoch). Última línea: {"cursor": ...}; cursor 0 = recorrido completo.
+    """
     token = request.args.get("token", "")
     if not DEBUG_TOKEN or token != DEBUG_TOKEN:
         return {"error": "unauthorized"}, 401
-    data = {}
-    for key in _backend.keys(CTX_PREFIX + "*"):
-        phone = key[len(CTX_PREFIX):]
-        ctx = cargar_contexto(phone)
-        if ctx is not None:
-            data[phone] = ctx
-    return {"contexto_usuarios": data}, 200
+    try:
+        cursor = int(request.args.get("cursor", 0))
+        pagina = max(1, min(int(request.args.get("pagina", DEBUG_PAGINA)), 1000))
+        limite = max(1, int(request.args.get("limite", DEBUG_LIMITE)))
+        desde = float(request.args["desde"]) if request.args.get("desde") else None
+        hasta = float(request.args["hasta"]) if request.args.get("hasta") else None
+    except ValueError:
+        return {"error": "cursor, pagina, limite, desde y hasta deben ser numéricos"}, 400
+    campos = [c.strip() for c in request.args.get("campos", ",".join(CAMPOS_DEBUG)).split(",")]
+    if not campos or any(c not in CAMPOS_DEBUG for c in campos):
+        return {"error": f"campos válidos: {', '.join(CAMPOS_DEBUG)}"}, 400
+    return Response(_volcar_contextos(cursor, pagina, limite, campos, desde, hasta),
+                    mimetype="application/x-ndjson")
+
+
+def _volcar_contextos(cursor, pagina, limite, campos, desde, hasta):
+    recorridas = devueltos = 0
+    try:
+        while True:
+            cursor, claves = _backend.scan(cursor, match=CTX_PREFIX + "*", count=pagina)
+            recorridas += len(claves)
+            for registro in _leer_pagina_debug(claves, campos):
+                last_seen = registro.pop("_last_seen")
+                if (desde is not None or hasta is not None) and last_seen is None:
+                    continue
+                if desde is not None and last_seen < desde or hasta is not None and last_seen > hasta:
+                    continue
+                devueltos += 1
+                yield json.dumps(registro, ensure_ascii=False) + "\n"
+            if not cursor or recorridas >= limite:
+                break
+    except Exception as e:
+        # Con el stream ya empezado no se puede cambiar el status: se informa en la última línea.
+        yield json.dumps({"error": str(e), "cursor": cursor}) + "\n"
+        return
+    yield json.dumps({"cursor": cursor, "recorridas": recorridas, "devueltos": devueltos}) + "\n"
+
+
+def _leer_pagina_debug(claves, campos):
+    """Una página de claves `ctx:` → registros proyectados, con un único pipeline (solo lectura:
+    los contextos antiguos se muestran tal cual, sin migrarlos)."""
+    if not claves:
+        return
+    phones = [k[len(CTX_PREFIX):] for k in claves]
+    pipe = _backend.pipeline(transaction=False)
+    pipe.mget(claves)
+    for phone in phones:
+        pipe.hgetall(PERFIL_PREFIX + phone)
+    if "historial" in campos:
+        for phone in phones:
+            pipe.lrange(HIST_PREFIX + phone, 0, -1)
+    resultado = pipe.execute()
+    crudos, perfiles = resultado[0], resultado[1:1 + len(phones)]
+    historiales = resultado[1 + len(phones):] or [None] * len(phones)
+    for phone, raw, perfil, historial in zip(phones, crudos, perfiles, historiales):
+        if raw is None:
+            continue  # expiró entre el SCAN y el MGET
+        try:
+            payload = decodificar(raw)
+        except (ValueError, TypeError):
+            payload = {}
+        perfil = _perfil_desde_hash(perfil or _perfil_para_hash(payload))
+        registro = {"phone": phone, "_last_seen": perfil.get("last_seen")}
+        if "perfil" in campos:
+            registro["perfil"] = perfil
+        if "payload" in campos:
+            registro["payload"] = {k: v for k, v in payload.items()
+                                   if k not in CAMPOS_PERFIL and k != "history"}
+        if "historial" in campos:
+            registro["history"] = (_decodificar_historial(historial) if historial
+                                   else payload.get("history", []))
+        yield registro
 
 
 @app.route("/webhook", methods=["GET"])
@@ -952,156 +4456,756 @@ def verify():
     return "Error de verificación", 403
 
 
-@app.route("/webhook", methods=["POST"])
-def webhook():
-    """Manejo de mensajes entrantes de WhatsApp"""
-    data = request.get_json()
+def iterar_mensajes(data):
+    """Recorre TODO el payload de Meta y entrega cada mensaje, en orden.
+
+    En ráfagas Meta agrupa varios mensajes, cambios y entradas en un mismo POST; antes solo
+    se leía el índice [0] de cada nivel y el resto se perdía en silencio. Es un generador:
+    no copia el payload y tolera niveles ausentes o mal formados.
+    """
+    for entry in data.get("entry") or []:
+        if not isinstance(entry, dict):
+            continue
+        for change in entry.get("changes") or []:
+            if not isinstance(change, dict):
+                continue
+            for message in (change.get("value") or {}).get("messages") or []:
+                if isinstance(message, dict):
+                    yield message
+
+
+# Mensajes de teléfonos distintos se atienden en paralelo (un POST con N mensajes cuesta
+# ~ una latencia de agente); los de un mismo teléfono, en orden y uno tras otro, aunque
+# lleguen en POSTs distintos, gracias al buzón por teléfono (ver _BuzonesPorTelefono).
+MENSAJES_PARALELOS = int(os.getenv("MENSAJES_PARALELOS", "8"))
+_pool_mensajes = ThreadPoolExecutor(max_workers=MENSAJES_PARALELOS, thread_name_prefix="mensaje")
+
+
+class _BuzonesPorTelefono:
+    """Un buzón FIFO por teléfono (modelo actor) sobre un pool compartido.
+
+    Cada teléfono tiene a lo sumo UNA tarea drenando su buzón en el pool, así que sus
+    mensajes se procesan en orden y nunca en paralelo entre sí; teléfonos distintos sí
+    corren en paralelo. El buzón desaparece en cuanto queda vacío.
+    """
+    def __init__(self, pool):
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._buzones = {}  # phone -> deque[(fn, args, Future)]; existe mientras hay quien drene
+
+    def enviar(self, phone, fn, *args):
+        futuro = Future()
+        with self._lock:
+            buzon = self._buzones.get(phone)
+            if buzon is None:
+                self._buzones[phone] = deque([(fn, args, futuro)])
+                self._pool.submit(self._drenar, phone)
+            else:
+                buzon.append((fn, args, futuro))
+        return futuro
+
+    def _drenar(self, phone):
+        while True:
+            with self._lock:
+                buzon = self._buzones[phone]
+                if not buzon:
+                    del self._buzones[phone]
+                    return
+                fn, args, futuro = buzon.popleft()
+            try:
+                futuro.set_result(fn(*args))
+            except Exception as e:
+                futuro.set_exception(e)
+
+    def pendientes(self):
+        with self._lock:
+            return sum(len(b) for b in self._buzones.values())
+
+    def activos(self):
+        """Teléfonos con un mensaje en curso o esperando (el buzón vive hasta vaciarse)."""
+        with self._lock:
+            return len(self._buzones)
+
+
+_buzones = _BuzonesPorTelefono(_pool_mensajes)
+
+
+def procesar_payload(data):
+    """Despacha todos los mensajes de un POST de Meta: paralelo entre teléfonos, en orden por teléfono.
+
+    Se ejecuta inline desde el webhook o, con COLA_WEBHOOK activa, desde los workers
+    de la cola. Espera a que terminen sus mensajes. Nunca lanza excepción: cualquier
+    error se registra y se descarta.
+    """
+    futuros = [_buzones.enviar(message.get("from", ""), procesar_mensaje, message)
+               for message in iterar_mensajes(data)]
+    for futuro in futuros:
+        futuro.exception()  # procesar_mensaje ya registra sus errores; solo esperamos
+    return "ok", 200
+
+
+def procesar_mensaje(message):
+    """Pipeline de UN mensaje entrante: bienvenida, menú directo o agente IA."""
+    peticion = _ContextoPeticion(message.get("from", ""))
+    token = _peticion_actual.set(peticion)
+    fallo = False
     try:
-        entry = data.get("entry", [])[0]
-        changes = entry.get("changes", [])[0]
-        value = changes.get("value", {})
-
-        if "messages" in value:
-            # Ignorar mensajes provenientes de grupos
-            if "-" in value["messages"][0].get("from", ""):
-                print("[INFO] Mensaje ignorado: proviene de un grupo de WhatsApp.")
-                return "ok", 200
-
-            message = value["messages"][0]
-            user_phone = message["from"]
-            message_id = message.get("id")
-
-            # Mostrar "escribiendo…" (y marcar como leído) cuanto antes — también cubre
-            # el tiempo que tarda la transcripción de una nota de voz.
-            send_typing_indicator(message_id)
-
-            # Extraer el texto del usuario según el tipo de mensaje:
-            #  - "text": mensaje escrito normal.
-            #  - "interactive": el usuario tocó una opción del menú (lista o botón).
-            #  - "audio": nota de voz → se descarga y transcribe con Whisper.
-            #  - otros (imagen, documento, sticker…): respuesta amable, no se ignoran en silencio.
-            msg_type = message.get("type", "text")
-            if msg_type == "text":
-                user_msg = message["text"]["body"]
-            elif msg_type == "interactive":
-                interactive = message.get("interactive", {})
-                if interactive.get("type") == "list_reply":
-                    user_msg = interactive.get("list_reply", {}).get("id", "")
-                elif interactive.get("type") == "button_reply":
-                    user_msg = interactive.get("button_reply", {}).get("id", "")
-                else:
-                    user_msg = ""
-            elif msg_type == "audio":
-                user_msg = transcribir_audio_whatsapp(message.get("audio", {}).get("id"))
+        # Ignorar mensajes provenientes de grupos
+        if "-" in message.get("from", ""):
+            print("[INFO] Mensaje ignorado: proviene de un grupo de WhatsApp.")
+            return
+
+        user_phone = message["from"]
+        message_id = message.get("id")
+
+        # Reentregas de Meta: descartarlas antes de cualquier trabajo caro.
+        with peticion.etapas.etapa("dedup"):
+            repetido = es_mensaje_repetido(message_id)
+        if repetido:
+            print(f"[INFO] Mensaje {message_id} ya procesado (reentrega); se ignora.")
+            return
+        peticion.wamid = message_id
+
+        # Mostrar "escribiendo…" (y marcar como leído) cuanto antes — también cubre
+        # el tiempo que tarda la transcripción de una nota de voz. Corre en el pool de etapas:
+        # el primer intento HTTP no bloquea el camino crítico.
+        peticion.etapas.lanzar("indicador", send_typing_indicator, message_id)
+
+        # Extraer el texto del usuario según el tipo de mensaje:
+        #  - "text": mensaje escrito normal.
+        #  - "interactive": el usuario tocó una opción del menú (lista o botón).
+        #  - "audio": nota de voz → se descarga y transcribe con Whisper, en paralelo con
+        #    el lock y la carga del contexto.
+        #  - otros (imagen, documento, sticker…): respuesta amable, no se ignoran en silencio.
+        msg_type = message.get("type", "text")
+        transcripcion = user_msg = None
+        if msg_type == "audio":
+            transcripcion = peticion.etapas.lanzar("transcripcion", transcribir_audio_whatsapp,
+                                                   message.get("audio", {}).get("id"))
+        elif msg_type in ("text", "interactive"):
+            user_msg = _texto_del_mensaje(message)
+            if not user_msg:
+                return
+        else:
+            _responder_no_soportado(user_phone)
+            return
+
+        # El contexto se carga y se escribe con el lock tomado (leer-modificar-escribir).
+        with contextlib.ExitStack() as pila:
+            with peticion.etapas.etapa("bloqueo"):
+                pila.enter_context(_BloqueoTelefono(user_phone))
+            pila.enter_context(peticion)
+            if transcripcion is not None:
+                user_msg = transcripcion.result()
                 if not user_msg:
-                    send_message(
-                        "🎙️ Recibí tu audio pero no logré entenderlo bien. "
-                        "¿Me lo puedes escribir en un mensajito? 😊",
-                        user_phone,
-                    )
-                    return "ok", 200
+                    _responder_audio_fallido(user_phone)
+                    return
                 print(f"[INFO] Nota de voz transcrita de {user_phone}: {user_msg}")
-            else:
-                # Imagen, documento, sticker, ubicación, etc.: aún no los procesamos.
-                send_message(
-                    "Por ahora puedo leer *texto* y escuchar *notas de voz* 🎙️. "
-                    "Cuéntame por aquí en qué te puedo ayudar 😊",
-                    user_phone,
-                )
-                return "ok", 200
+            atender_mensaje(user_phone, user_msg)
 
-            if not user_msg:
-                return "ok", 200
-
-            ahora = time.time()
-
-            print(f"[INFO] Mensaje recibido: {user_msg} de {user_phone}")
-
-            # --- BIENVENIDA PARA USUARIOS NUEVOS ---
-            # El saludo inicial es determinístico (gratis e instantáneo). A partir de la
-            # siguiente respuesta, el agente conduce el embudo de calificación. Sembramos la
-            # bienvenida en el historial para que el agente sepa que ya saludó y pidió el nombre.
-            es_nuevo = not ya_bienvenido(user_phone) and cargar_contexto(user_phone) is None
-            if es_nuevo:
-                marcar_bienvenido(user_phone)
-                registrar_interesado(user_phone, f"[NUEVO USUARIO] {user_msg}")
-                bienvenida = construir_bienvenida()
-                guardar_contexto(user_phone, {
-                    "last_seen": ahora, "timestamp": ahora,
-                    "history": [{"role": "assistant", "content": bienvenida}], "tema": "nuevo",
-                })
-                send_message(bienvenida, user_phone)
-                return "ok", 200
-
-            # Nota: a los usuarios que regresan tras un silencio largo los atiende
-            # directamente el agente IA (saluda, responde su mensaje e invita a la
-            # clase de prueba), evitando un segundo mensaje canned duplicado.
-
-            # --- ROUTER DE OPCIONES DIRECTAS (número 1-7) ---
-            if user_msg.strip() in respuestas_directas:
-                key = user_msg.strip()
-                ctx = cargar_contexto(user_phone) or {}
-                ctx.setdefault("history", [])
-                ctx.update({"tema": key, "timestamp": ahora, "last_seen": ahora})
-                guardar_contexto(user_phone, ctx)
-                # Respuestas partidas en mensajes cortos; el saludo va solo en el primero.
-                for i, chunk in enumerate(respuestas_directas[key]):
-                    texto = agregar_saludo(chunk, user_phone) if i == 0 else chunk
-                    send_message(texto, user_phone)
-                send_list_menu(user_phone)
-                return "ok", 200
-
-            # ---TODO LO DEMÁS VA AL AGENTE IA con historial y perfil del prospecto ---
-            ctx = get_or_init_user_context(user_phone, ahora)
-            append_to_history(ctx, "user", user_msg)
-            # Persistir el mensaje del usuario ANTES de correr el agente: la tool
-            # guardar_datos_prospecto lee y escribe este mismo contexto en Redis.
-            guardar_contexto(user_phone, ctx)
+    except BloqueoNoObtenido as e:
+        fallo = True
+        _reencolar_sin_bloqueo(message, e)
+    except Exception as e:
+        print("Error:", e)
+        _metricas.contar("errores_total", etapa="mensaje")
+        fallo = True
+    finally:
+        if peticion.wamid:  # no se confirmó en el guardado (error o salida temprana)
+            cerrar_wamid(peticion.wamid, ok=not fallo)
+        _peticion_actual.reset(token)
+        _metricas.observar("redis_viajes_por_mensaje", peticion.viajes)
+        peticion.etapas.cerrar()
 
-            agent_input = build_agent_input(user_phone, user_msg, ctx["history"], perfil=ctx)
-            result = Runner.run_sync(kudo_agent, agent_input)
-            texto = getattr(result, "final_output", None) or getattr(result, "output", None) or str(result)
-
-            # El agente puede pedir que mostremos el menú interactivo terminando con [[MENU]].
-            mostrar_menu = "[[MENU]]" in texto
-            texto = texto.replace("[[MENU]]", "").strip()
-
-            # Recargar: durante su ejecución el agente pudo guardar datos del prospecto
-            # (nombre/disciplina/turno/día) en el contexto; recargamos para no pisarlos.
-            ctx = cargar_contexto(user_phone) or ctx
-            append_to_history(ctx, "assistant", texto)
-            ctx["tema"] = "libre"
-            ctx["timestamp"] = ahora
-            ctx["last_seen"] = ahora
-            guardar_contexto(user_phone, ctx)
 
-            registrar_interesado(
-                user_phone,
-                user_msg,
-                nombre=ctx.get("nombre", ""),
-                disciplina=ctx.get("disciplina_raw", ""),
-                turno=ctx.get("turno_raw", ""),
-            )
-            send_message(texto, user_phone)
-            if mostrar_menu:
-                send_list_menu(user_phone)
+def _reencolar_sin_bloqueo(message, error, asincrono=False):
+    """Vuelve a intentar más tarde un mensaje que no obtuvo el lock de su teléfono (hasta
+    LOCK_TEL_REENCOLAR veces). El wamid ya se liberó, así que el reintento pasa la dedup."""
+    intentos = message.get("_intentos_bloqueo", 0) + 1
+    if intentos > LOCK_TEL_REENCOLAR:
+        print(f"[ERROR] {error}; mensaje {message.get('id')} descartado tras {intentos - 1} reintentos.")
+        _metricas.contar("errores_total", etapa="bloqueo")
+        return
+    print(f"[WARN] {error}; se reintenta en {LOCK_TEL_REENCOLAR_ESPERA}s ({intentos}/{LOCK_TEL_REENCOLAR}).")
+    _metricas.contar("bloqueo_reencolados_total")
+    reintento = {**message, "_intentos_bloqueo": intentos}
+    phone = message.get("from", "")
+    if COLA_WEBHOOK:  # la cola sobrevive a un reinicio del proceso
+        _reintentos.programar(LOCK_TEL_REENCOLAR_ESPERA, encolar_payload,
+                              {"entry": [{"changes": [{"value": {"messages": [reintento]}}]}]})
+    elif asincrono:
+        asyncio.get_running_loop().call_later(
+            LOCK_TEL_REENCOLAR_ESPERA, lambda: _en_segundo_plano(
+                _en_orden(phone, procesar_mensaje_async, reintento), "Reintento sin lock"))
+    else:
+        _reintentos.programar(LOCK_TEL_REENCOLAR_ESPERA, _buzones.enviar, phone, procesar_mensaje, reintento)
+
+
+def _texto_del_mensaje(message):
+    """Texto de un mensaje "text" o "interactive" (id de la opción tocada en lista o botón)."""
+    if message.get("type", "text") == "text":
+        return message["text"]["body"]
+    interactive = message.get("interactive", {})
+    if interactive.get("type") == "list_reply":
+        return interactive.get("list_reply", {}).get("id", "")
+    if interactive.get("type") == "button_reply":
+        return interactive.get("button_reply", {}).get("id", "")
+    return ""
+
+
+def _responder_audio_fallido(user_phone):
+    send_message(
+        "🎙️ Recibí tu audio pero no logré entenderlo bien. "
+        "¿Me lo puedes escribir en un mensajito? 😊",
+        user_phone,
+    )
+    _metricas.contar("rutas_total", ruta="audio_fallido")
 
+
+def _responder_no_soportado(user_phone):
+    # Imagen, documento, sticker, ubicación, etc.: aún no los procesamos.
+    send_message(
+        "Por ahora puedo leer *texto* y escuchar *notas de voz* 🎙️. "
+        "Cuéntame por aquí en qué te puedo ayudar 😊",
+        user_phone,
+    )
+    _metricas.contar("rutas_total", ruta="no_soportado")
+
+
+# ---------------------------------------------
+# ✅ Pipeline asíncrono (servidor ASGI, ver asgi_app)
+# ---------------------------------------------
+# Mismo pipeline que procesar_mensaje, pero cada espera de red es un await en un único loop
+# de asyncio en vez de un hilo bloqueado: Redis (redis.asyncio), Graph (httpx), Whisper y el
+# agente (AsyncOpenAI / Runner.run). Así un proceso sostiene cientos de conversaciones a la
+# vez con un puñado de hilos. Lo que no espera red (router, bienvenida, historial en la
+# petición) se comparte tal cual con la versión síncrona. En una nota de voz, la descarga y
+# la transcripción corren EN PARALELO con el lock del teléfono y la carga del contexto.
+# Los envíos salen por el planificador de envíos (send_message no espera a Graph) y las
+# filas de Sheets por el outbox, dentro del pipeline de guardado de la petición.
+_turnos = {}      # teléfono → [asyncio.Lock, mensajes en curso o esperando]: orden por teléfono
+_tareas = set()   # tareas "dispara y olvida" (indicador de escritura): referencia fuerte
+
+
+async def procesar_payload_async(data):
+    """procesar_payload en el loop: concurrente entre teléfonos, en orden por teléfono."""
+    await asyncio.gather(*(_en_orden(message.get("from", ""), procesar_mensaje_async, message)
+                           for message in iterar_mensajes(data)))
+    return "ok", 200
+
+
+async def _en_orden(phone, fn, *args):
+    turno = _turnos.setdefault(phone, [asyncio.Lock(), 0])
+    turno[1] += 1
+    try:
+        async with turno[0]:
+            return await fn(*args)
+    finally:
+        turno[1] -= 1
+        if turno[1] == 0:
+            del _turnos[phone]
+
+
+def _en_segundo_plano(corutina, descripcion):
+    tarea = asyncio.ensure_future(corutina)
+    _tareas.add(tarea)
+
+    def terminada(t):
+        _tareas.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            print(f"[WARN] {descripcion}: {t.exception()}")
+    tarea.add_done_callback(terminada)
+    return tarea
+
+
+async def procesar_mensaje_async(message):
+    """procesar_mensaje para el loop de asyncio. Nunca lanza excepción."""
+    peticion = _ContextoPeticion(message.get("from", ""))
+    token = _peticion_actual.set(peticion)
+    fallo = False
+    try:
+        if "-" in message.get("from", ""):
+            print("[INFO] Mensaje ignorado: proviene de un grupo de WhatsApp.")
+            return
+
+        user_phone = message["from"]
+        message_id = message.get("id")
+        with peticion.etapas.etapa("dedup"):
+            repetido = await es_mensaje_repetido_async(message_id)
+        if repetido:
+            print(f"[INFO] Mensaje {message_id} ya procesado (reentrega); se ignora.")
+            return
+        peticion.wamid = message_id
+        peticion.etapas.seguir("indicador", _en_segundo_plano(send_typing_indicator_async(message_id),
+                                                              "Indicador de escritura"))
+
+        msg_type = message.get("type", "text")
+        if msg_type not in ("text", "interactive", "audio"):
+            _responder_no_soportado(user_phone)
+            return
+
+        async with contextlib.AsyncExitStack() as pila:
+            async def entrar():
+                with peticion.etapas.etapa("bloqueo"):
+                    await pila.enter_async_context(_BloqueoTelefono(user_phone))
+                await pila.enter_async_context(peticion)
+
+            async def transcribir():
+                with peticion.etapas.etapa("transcripcion"):
+                    return await transcribir_audio_async(message.get("audio", {}).get("id"))
+
+            if msg_type == "audio":
+                # return_exceptions: gather espera a las DOS antes de seguir. Sin él, un error
+                # de una dejaría a la otra corriendo y el lock podría entrar en `pila` después
+                # de cerrada (tomado y renovándose hasta el fin del proceso).
+                user_msg, entrada = await asyncio.gather(transcribir(), entrar(), return_exceptions=True)
+                for error in (entrada, user_msg):
+                    if isinstance(error, BaseException):
+                        raise error
+                if not user_msg:
+                    _responder_audio_fallido(user_phone)
+                    return
+                print(f"[INFO] Nota de voz transcrita de {user_phone}: {user_msg}")
+            else:
+                user_msg = _texto_del_mensaje(message)
+                if not user_msg:
+                    return
+                await entrar()
+            await atender_mensaje_async(user_phone, user_msg)
+
+    except BloqueoNoObtenido as e:
+        fallo = True
+        _reencolar_sin_bloqueo(message, e, asincrono=True)
     except Exception as e:
         print("Error:", e)
+        _metricas.contar("errores_total", etapa="mensaje")
+        fallo = True
+    finally:
+        if peticion.wamid:  # no se confirmó en el guardado (error o salida temprana)
+            await cerrar_wamid_async(peticion.wamid, ok=not fallo)
+        _metricas.observar("redis_viajes_por_mensaje", peticion.viajes)
+        peticion.etapas.cerrar()
+
+
+def atender_mensaje(user_phone, user_msg):
+    """Parte con estado del pipeline (contexto, bienvenida, menú, agente) de un mensaje ya
+    extraído. Corre con el bloqueo del teléfono tomado: nadie más toca su contexto."""
+    ahora = time.time()
+    bienvenida = _parece_nuevo(user_phone) and reclamar_bienvenida(user_phone, user_msg, ahora)
+    if _atender_sin_agente(user_phone, user_msg, ahora, bienvenida):
+        return
+
+    # ---TODO LO DEMÁS VA AL AGENTE IA con historial y perfil del prospecto ---
+    ctx, agent_input = _preparar_turno_agente(user_phone, user_msg, ahora)
+    try:
+        texto, mostrar_menu = correr_agente(agent_input, user_phone)
+    except Exception as e:
+        _responder_agente_caido(user_phone, e)
+        return
+    _cerrar_turno_agente(user_phone, user_msg, ctx, ahora, texto, mostrar_menu)
+
+
+async def atender_mensaje_async(user_phone, user_msg):
+    """atender_mensaje para el pipeline asíncrono: solo el agente espera (await)."""
+    ahora = time.time()
+    bienvenida = _parece_nuevo(user_phone) and await reclamar_bienvenida_async(user_phone, user_msg, ahora)
+    if _atender_sin_agente(user_phone, user_msg, ahora, bienvenida):
+        return
+    ctx, agent_input = _preparar_turno_agente(user_phone, user_msg, ahora)
+    try:
+        texto, mostrar_menu = await correr_agente_async(agent_input, user_phone)
+    except Exception as e:
+        _responder_agente_caido(user_phone, e)
+        return
+    _cerrar_turno_agente(user_phone, user_msg, ctx, ahora, texto, mostrar_menu)
+
+
+def _atender_sin_agente(user_phone, user_msg, ahora, bienvenida=None):
+    """Bienvenida y router de opciones directas (sin LLM). True si el mensaje ya quedó
+    atendido; todo se sirve desde la petición en curso, sin esperas de red. `bienvenida`:
+    el texto si este mensaje ganó reclamar_bienvenida (ya registrada en el backend)."""
+    print(f"[INFO] Mensaje recibido: {user_msg} de {user_phone}")
+
+    # --- BIENVENIDA PARA USUARIOS NUEVOS ---
+    # El saludo inicial es determinístico (gratis e instantáneo). A partir de la
+    # siguiente respuesta, el agente conduce el embudo de calificación. La bienvenida quedó
+    # sembrada en el historial para que el agente sepa que ya saludó y pidió el nombre.
+    if bienvenida:
+        send_message(bienvenida, user_phone)
+        _metricas.contar("rutas_total", ruta="bienvenida")
+        return True
+
+    # Nota: a los usuarios que regresan tras un silencio largo los atiende
+    # directamente el agente IA (saluda, responde su mensaje e invita a la
+    # clase de prueba), evitando un segundo mensaje canned duplicado.
+
+    # --- ROUTER DE OPCIONES DIRECTAS (número 1-7 o texto libre reconocido sin LLM) ---
+    # Con una pregunta del embudo pendiente solo cuentan los números del menú: el texto libre
+    # es la respuesta del usuario y la interpreta el agente.
+    ctx = cargar_contexto(user_phone) or {}
+    key = user_msg.strip() if user_msg.strip() in respuestas_directas else None
+    if key is None and not embudo_en_curso(ctx):
+        key = clasificar_intencion(user_msg)
+    if key:
+        directa = key == user_msg.strip()
+        if not directa:
+            print(f"[INFO] Router de intenciones: '{user_msg}' → opción {key} (sin agente)")
+        _metricas.contar("rutas_total", ruta="directa" if directa else "intencion")
+        ctx.setdefault("history", [])
+        ctx.update({"tema": key, "timestamp": ahora, "last_seen": ahora})
+        guardar_contexto(user_phone, ctx)
+        # Respuestas partidas en mensajes cortos; el saludo va solo en el primero.
+        for i, chunk in enumerate(respuestas_directas[key]):
+            texto = agregar_saludo(chunk, user_phone) if i == 0 else chunk
+            send_message(texto, user_phone)
+        send_list_menu(user_phone)
+        return True
+    return False
+
+
+def _preparar_turno_agente(user_phone, user_msg, ahora):
+    """Antes del agente: mensaje del usuario al historial y prompt. Devuelve (ctx, agent_input)."""
+    ctx = get_or_init_user_context(user_phone, ahora)
+    mensaje_usuario = append_to_history(ctx, "user", user_msg)
+    # Guardar el mensaje del usuario ANTES de correr el agente: las tools leen el contexto
+    # (p. ej. el historial reciente para el aviso al staff) de la petición en curso.
+    guardar_contexto(user_phone, ctx, nuevos=[mensaje_usuario])
+
+    agent_input = build_agent_input(user_phone, user_msg, ctx["history"], perfil=ctx)
+    print(f"[INFO] Prompt estimado para {user_phone}: {tokens_prompt_sistema() + estimar_tokens(agent_input)} "
+          f"tokens (historial {tokens_historial(ctx['history'])}).")
+    _metricas.contar("rutas_total", ruta="agente")
+    return ctx, agent_input
+
+
+def correr_agente(agent_input, user_phone):
+    """Corre el agente (streaming o no) tras el circuito de OpenAI → (texto, mostrar_menu)."""
+    if STREAMING_RESPUESTAS:
+        # Los fragmentos ya se enviaron mientras el agente generaba; aquí llega el texto completo.
+        with _etapa("agente"), medir("agente_segundos", modo="streaming"), _breakers["openai"].proteger():
+            return correr_agente_en_streaming(agent_input, user_phone)
+    with _etapa("agente"), medir("agente_segundos", modo="sync"), _breakers["openai"].proteger():
+        result = Runner.run_sync(kudo_agent.obtener(), agent_input)
+    return _salida_agente(result)
+
+
+async def correr_agente_async(agent_input, user_phone):
+    if STREAMING_RESPUESTAS:
+        with _etapa("agente"), medir("agente_segundos", modo="streaming"), _breakers["openai"].proteger():
+            return await agente_en_streaming(agent_input, user_phone)
+    with _etapa("agente"), medir("agente_segundos", modo="async"), _breakers["openai"].proteger():
+        result = await Runner.run(kudo_agent.obtener(), agent_input)
+    return _salida_agente(result)
+
+
+def _salida_agente(result):
+    contar_tokens_agente(result)
+    texto = getattr(result, "final_output", None) or getattr(result, "output", None) or str(result)
+    # El agente puede pedir que mostremos el menú interactivo terminando con [[MENU]].
+    return texto.replace(MARCA_MENU, "").strip(), MARCA_MENU in texto
+
+
+def _responder_agente_caido(user_phone, error):
+    # OpenAI caído (o circuito abierto): respuesta de cortesía + menú, que se sirve sin LLM.
+    print(f"[ERROR] El agente no respondió a {user_phone}: {error}")
+    _metricas.contar("rutas_total", ruta="agente_caido")
+    if isinstance(error, AgenteInterrumpido):
+        # El usuario ya leyó parte de la respuesta: que el próximo turno del agente la vea.
+        ctx = cargar_contexto(user_phone) or {"history": []}
+        ctx.setdefault("history", [])
+        guardar_contexto(user_phone, ctx, nuevos=[append_to_history(ctx, "assistant", error.parcial)])
+    send_message(RESPUESTA_AGENTE_CAIDO, user_phone)
+    send_list_menu(user_phone)
+
+
+def _cerrar_turno_agente(user_phone, user_msg, ctx, ahora, texto, mostrar_menu):
+    """Después del agente: respuesta al historial, registro en Sheets y envío."""
+    # Recargar (desde memoria): durante su ejecución el agente pudo guardar datos del
+    # prospecto (nombre/disciplina/turno/día) en el contexto; recargamos para no pisarlos.
+    ctx = cargar_contexto(user_phone) or ctx
+    mensaje_bot = append_to_history(ctx, "assistant", texto)
+    ctx["tema"] = "libre"
+    ctx["timestamp"] = ahora
+    ctx["last_seen"] = ahora
+    guardar_contexto(user_phone, ctx, nuevos=[mensaje_bot])
+    programar_compactacion(user_phone, ctx)
+
+    registrar_interesado(
+        user_phone,
+        user_msg,
+        nombre=ctx.get("nombre", ""),
+        disciplina=ctx.get("disciplina_raw", ""),
+        turno=ctx.get("turno_raw", ""),
+    )
+    if not STREAMING_RESPUESTAS:
+        send_message(texto, user_phone)
+    if mostrar_menu:
+        send_list_menu(user_phone)
+
+
+@app.route("/webhook", methods=["POST"])
+def webhook():
+    """Manejo de mensajes entrantes de WhatsApp.
+
+    Con COLA_WEBHOOK activa solo valida y encola el payload, y responde en milisegundos
+    (Meta reintenta la entrega si tardamos); los workers de la cola corren el pipeline.
+    """
+    _asegurar_publicador_metricas()
+    with medir("parse_payload_segundos"):
+        data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return "ok", 200
+    if COLA_WEBHOOK:
+        encolar_payload(data)
+        return "ok", 200
+    return procesar_payload(data)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Métricas de todos los procesos vivos en formato de exposición de Prometheus."""
+    autorizacion = request.headers.get("Authorization", "")
+    bearer = autorizacion[len("Bearer "):] if autorizacion.startswith("Bearer ") else ""
+    if METRICAS_TOKEN and METRICAS_TOKEN not in (request.args.get("token", ""), bearer):
+        return {"error": "unauthorized"}, 401
+    _actualizar_gauges_proceso()
+    snapshots = [_snapshot_proceso()]
+    if REDIS_URL:
+        try:
+            vencidos = []
+            for proceso, raw in _backend.hgetall(METRICAS_HASH).items():
+                if proceso == _metricas_id:
+                    continue  # el propio proceso ya va con su snapshot al día
+                snap = json.loads(raw)
+                if time.time() - snap.get("t", 0) > METRICAS_VENCEN:
+                    vencidos.append(proceso)
+                else:
+                    snapshots.append(snap)
+            if vencidos:
+                _backend.hdel(METRICAS_HASH, *vencidos)
+        except Exception as e:
+            print("[WARN] /metrics: Redis no disponible; solo las métricas de este proceso:", e)
+    # Gauges globales (uno por despliegue, no por proceso): se leen al momento del scrape.
+    globales = [["cola_profundidad", [], estado_cola()["profundidad"] or 0]]
+    for hoja, n in estado_outbox()["profundidad"].items():
+        globales.append(["outbox_profundidad", [["hoja", hoja]], n or 0])
+    snapshots.append({"g": globales})
+    return Response(exportar_metricas(snapshots), mimetype="text/plain; version=0.0.4")
+
+
+def _actualizar_gauges_proceso():
+    _metricas.fijar("procesos", 1)
+    _metricas.fijar("buzones_pendientes", _buzones.pendientes())
+    _metricas.fijar("cola_workers", len(_cola_hilos))
+    _metricas.fijar("dedup_lru_tamano", len(_wamids_vistos))
+    _metricas.fijar("reintentos_programados", _reintentos.pendientes())
+    _metricas.fijar("envios_pendientes", _envios.pendientes())
+    _metricas.fijar("conversaciones_async", len(_turnos))
+    if not REDIS_URL:
+        for nombre, valor in _backend.estado().items():
+            _metricas.fijar(f"memoria_local_{nombre}", valor)
+
+
+@app.route("/debug/cola", methods=["GET"])
+def debug_cola():
+    token = request.args.get("token", "")
+    if not DEBUG_TOKEN or token != DEBUG_TOKEN:
+        return {"error": "unauthorized"}, 401
+    return {**estado_cola(), "dedup": estado_dedup(), "outbox_sheets": estado_outbox(),
+            "envios": _envios.estado()}, 200
+
+
+@app.route("/debug/etapas", methods=["GET"])
+def debug_etapas():
+    """Líneas de tiempo de los últimos mensajes (más reciente primero); ?phone= filtra."""
+    token = request.args.get("token", "")
+    if not DEBUG_TOKEN or token != DEBUG_TOKEN:
+        return {"error": "unauthorized"}, 401
+    phone = request.args.get("phone")
+    return {"mensajes": [grafo.linea_de_tiempo() for grafo in reversed(_lineas_de_tiempo)
+                         if not phone or grafo.phone == phone]}, 200
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """Liveness: el proceso responde (no toca Redis, Google ni OpenAI)."""
+    return {"status": "ok"}, 200
+
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """Readiness: 200 cuando Redis, OpenAI y el agente están listos; si no, 503 y se
+    relanza el calentamiento de lo que falte."""
+    listo, estado = componentes_listos()
+    if not listo:
+        iniciar_calentamiento()
+    return {"listo": listo, "componentes": estado}, 200 if listo else 503
 
-    return "ok", 200
 
 @app.route("/testsheet")
 def test_sheet():
     try:
-        interesados_sheet.append_row(["TEST", "Prueba manual", time.strftime("%Y-%m-%d %H:%M:%S")])
+        _hoja_sheets("Interesados").append_row(["TEST", "Prueba manual", time.strftime("%Y-%m-%d %H:%M:%S")])
         return "Escritura exitosa", 200
     except Exception as e:
         print("[ERROR]", e)
         return str(e), 500
 
+
+# ---------------------------------------------
+# ✅ Entrada ASGI (SERVIDOR_ASGI=1 en gunicorn.conf.py: workers uvicorn)
+# ---------------------------------------------
+# POST /webhook corre nativo en el loop (procesar_payload_async); el resto de las rutas
+# (verificación GET, métricas, debug, salud) son las mismas de Flask, servidas a través de
+# asgiref. lifespan: calentar al arrancar y drenar al apagar.
+_adaptador_wsgi = []
+
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _ciclo_de_vida(receive, send)
+    elif scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == "/webhook":
+        await _webhook_asgi(receive, send)
+    else:
+        if not _adaptador_wsgi:
+            from asgiref.wsgi import WsgiToAsgi
+            _adaptador_wsgi.append(WsgiToAsgi(app))
+        await _adaptador_wsgi[0](scope, receive, send)
+
+
+async def _ciclo_de_vida(receive, send):
+    while True:
+        evento = await receive()
+        if evento["type"] == "lifespan.startup":
+            iniciar_calentamiento()
+            await send({"type": "lifespan.startup.complete"})
+        elif evento["type"] == "lifespan.shutdown":
+            # drenar() espera bloqueando: en un hilo, para que el loop termine lo que tiene en curso.
+            await asyncio.to_thread(drenar)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def _webhook_asgi(receive, send):
+    """webhook() para el loop: mismo contrato (siempre 200 "ok")."""
+    _asegurar_publicador_metricas()
+    cuerpo = b""
+    while True:
+        evento = await receive()
+        cuerpo += evento.get("body", b"")
+        if not evento.get("more_body"):
+            break
+    with medir("parse_payload_segundos"):
+        try:
+            data = json.loads(cuerpo)
+        except ValueError:
+            data = None
+    if isinstance(data, dict):
+        if COLA_WEBHOOK:
+            await asyncio.to_thread(encolar_payload, data)
+        else:
+            await procesar_payload_async(data)
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"text/html; charset=utf-8")]})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+# ---------------------------------------------
+# ✅ Servidor de producción: fork y apagado ordenado (ver gunicorn.conf.py)
+# ---------------------------------------------
+# gunicorn importa app.py UNA vez en el proceso maestro (preload_app) y luego hace fork de
+# los workers. Lo que el hijo hereda y no puede compartir — sockets (Session de Graph,
+# Redis, OpenAI, gspread), hilos de fondo (que no sobreviven al fork), pools de hilos y
+# locks que otro hilo podía tener tomados — se rehace en el hijo con os.register_at_fork.
+# Al apagar (SIGTERM), drenar() deja de tomar trabajo nuevo de la cola y espera a que
+# terminen los mensajes en curso, los envíos pendientes y un último vaciado del outbox.
+DRENAR_TIMEOUT = float(os.getenv("DRENAR_TIMEOUT", "20"))
+
+
+def _reiniciar_tras_fork():
+    global _metricas_id, _reintentos, _breakers, _envios, _pool_audio, _pool_resumenes
+    global _pool_mensajes, _pool_etapas, _buzones, _codec_lock, _wamids_lock, _outbox_lock, _outbox_despertar
+    global _resumiendo_lock, _cola_lock, _apagando, _calentamiento_lock
+    _metricas._lock = threading.Lock()
+    _calentamiento_lock = threading.Lock()
+    _metricas_id = _id_proceso()
+    for componente in _componentes.values():
+        componente._lock = threading.Lock()
+        componente._valor, componente._listo, componente._error = None, False, None
+    _graph.reiniciar()
+    _reintentos = _PlanificadorReintentos()
+    _breakers = _crear_breakers()
+    _envios = _PlanificadorEnvios(_graph)
+    _pool_audio = ThreadPoolExecutor(max_workers=AUDIO_PREPROCESO_HILOS, thread_name_prefix="audio")
+    _pool_resumenes = ThreadPoolExecutor(max_workers=2, thread_name_prefix="resumen")
+    _pool_mensajes = ThreadPoolExecutor(max_workers=MENSAJES_PARALELOS, thread_name_prefix="mensaje")
+    _pool_etapas = ThreadPoolExecutor(max_workers=ETAPAS_HILOS, thread_name_prefix="etapa")
+    _lineas_de_tiempo.clear()
+    _buzones = _BuzonesPorTelefono(_pool_mensajes)
+    _codec_lock, _wamids_lock, _outbox_lock = threading.Lock(), threading.Lock(), threading.Lock()
+    _resumiendo_lock, _cola_lock = threading.Lock(), threading.Lock()
+    _outbox_despertar, _apagando = threading.Event(), threading.Event()
+    _resumiendo.clear()
+    _turnos.clear()
+    _tareas.clear()
+    for hilos in (_publicador_metricas, _calentamiento, _outbox_hilo, _cola_hilos, _cola_latido):
+        hilos.clear()
+
+
+os.register_at_fork(after_in_child=_reiniciar_tras_fork)
+
+
+def _esperar(condicion, limite):
+    while not condicion():
+        if time.monotonic() >= limite:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def drenar(timeout=DRENAR_TIMEOUT):
+    """Apagado ordenado del proceso. Devuelve True si todo terminó dentro del plazo."""
+    inicio = time.monotonic()
+    limite = inicio + timeout
+    _apagando.set()
+    print(f"[INFO] Apagado: drenando (máx. {timeout:.0f}s); mensajes en curso: "
+          f"{_buzones.activos() + len(_turnos)}, envíos pendientes: {_envios.pendientes()}.")
+    ok = _esperar(lambda: _buzones.activos() == 0 and not _turnos, limite)
+    ok = _esperar(lambda: _envios.pendientes() == 0, limite) and ok
+    if _outbox_hilo:
+        for hoja in HOJAS_SHEETS:
+            try:
+                vaciar_outbox(hoja)
+            except Exception as e:
+                print(f"[WARN] Apagado: no se pudo vaciar el outbox de {hoja}:", e)
+    if ok:
+        print(f"[INFO] Apagado: drenado en {time.monotonic() - inicio:.1f}s.")
+    else:
+        print(f"[WARN] Apagado: plazo agotado; quedan {_buzones.activos() + len(_turnos)} mensajes en curso y "
+              f"{_envios.pendientes()} envíos.")
+    return ok
+
+
+_metricas.fijar("arranque_segundos", time.perf_counter() - _INICIO_IMPORTACION, componente="importacion")
+print(f"[INFO] Arranque: importación en {time.perf_counter() - _INICIO_IMPORTACION:.2f}s.")
+if CALENTAR_AL_INICIO:
+    iniciar_calentamiento()
+
 # ---------------------------------------------
 # Inicio del servidor Flask
 # ---------------------------------------------
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000)
+    if sys.argv[1:2] == ["worker"]:
+        # Proceso worker dedicado (opcional): solo consume la cola; ver COLA_WEBHOOK.
+        if not COLA_WEBHOOK:
+            print("[WARN] Worker: COLA_WEBHOOK=0 — el webhook procesa inline y la cola no recibirá "
+                  "trabajo; este proceso solo recupera lo que haya quedado pendiente.")
+        # SIGTERM (deploy / reinicio del dyno) → drenar y salir.
+        signal.signal(signal.SIGTERM, lambda *_: _apagando.set())
+        iniciar_calentamiento()  # componentes, flusher del outbox y publicador de métricas
+        _asegurar_workers_cola(forzar=True)
+        while not _apagando.wait(1):
+            pass
+        drenar()
+    else:
+        # Servidor de desarrollo; en producción: gunicorn (ver gunicorn.conf.py y el Procfile).
+        app.run(host="0.0.0.0", port=int(os.getenv("PORT", "8000")))
@@ -0,0 +1,87 @@
+# ---------------------------------------------
+# Benchmark del preprocesamiento de notas de voz (app.preprocesar_audio)
+# ---------------------------------------------
+# Para cada clip reporta tamaño original vs. preprocesado, lo que tarda ffmpeg y el tiempo de
+# subida ahorrado con el ancho de banda indicado; con --whisper además transcribe ambas
+# versiones y mide la latencia real de punta a punta (preproceso + Whisper).
+#
+# Uso:
+#   python bench_audio.py notas/*.ogg                 # clips reales (ogg/opus, m4a, mp3)
+#   python bench_audio.py                             # clips sintéticos estilo WhatsApp
+#   python bench_audio.py notas/*.ogg --mbps 1 --whisper
+#
+# Requiere ffmpeg (FFMPEG_BIN) y las mismas variables de entorno que app.py; mide el
+# preprocesamiento aunque PREPROCESAR_AUDIO esté desactivado.
+import argparse
+import io
+import os
+import subprocess
+import tempfile
+import time
+
+import app
+
+# (segundos de silencio al inicio, segundos de "voz", segundos de silencio al final)
+SINTETICOS = [(0.5, 6, 0.5), (3, 10, 4), (8, 25, 10), (2, 45, 15)]
+
+
+def clip_sintetico(ffmpeg, inicio, voz, fin):
+    """ogg/opus estéreo 48 kHz a 32 kbps (como graba WhatsApp) con silencio en los extremos."""
+    total = inicio + voz + fin
+    # Tono modulado en amplitud (sílabas) + ruido leve; silencio real fuera de [inicio, inicio+voz].
+    expr = (f"if(between(t,{inicio},{inicio + voz}),"
+            f"0.4*sin(2*PI*220*t)*abs(sin(2*PI*3*t))+0.02*(random(0)-0.5),0)")
+    salida = subprocess.run(
+        [ffmpeg, "-hide_banner", "-loglevel", "error", "-f", "lavfi",
+         "-i", f"aevalsrc=exprs='{expr}|{expr}':s=48000:d={total}",
+         "-c:a", "libopus", "-b:a", "32k", "-f", "ogg", "pipe:1"],
+        capture_output=True, check=True)
+    return f"sintético {inicio}+{voz}+{fin}s", salida.stdout
+
+
+def transcribir(datos, ext):
+    inicio = time.perf_counter()
+    app.openai_client.audio.transcriptions.create(model="whisper-1", file=(f"audio.{ext}", io.BytesIO(datos)))
+    return time.perf_counter() - inicio
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark del preprocesamiento de audio.")
+    parser.add_argument("clips", nargs="*", help="archivos de audio (por defecto, sintéticos)")
+    parser.add_argument("--mbps", type=float, default=2.0, help="ancho de banda de subida (Mbit/s)")
+    parser.add_argument("--whisper", action="store_true", help="transcribir de verdad (usa la API)")
+    args = parser.parse_args()
+
+    app.PREPROCESAR_AUDIO = True
+    ffmpeg = app._ruta_ffmpeg()
+    if ffmpeg is None:
+        raise SystemExit(f"ffmpeg no encontrado (FFMPEG_BIN={app.FFMPEG_BIN!r}).")
+    if args.clips:
+        clips = [(os.path.basename(r), open(r, "rb").read()) for r in args.clips]
+    else:
+        clips = [clip_sintetico(ffmpeg, *c) for c in SINTETICOS]
+
+    print(f"{'clip':<26}{'original':>10}{'prepro.':>10}{'red.':>7}{'ffmpeg s':>10}"
+          f"{'subida ahorrada s':>19}{'neto s':>9}" + ("   whisper orig → prepro s" if args.whisper else ""))
+    tot_orig = tot_pre = tot_neto = 0.0
+    for nombre, datos in clips:
+        ext = nombre.rsplit(".", 1)[-1] if "." in nombre and not nombre.startswith("sint") else "ogg"
+        with tempfile.SpooledTemporaryFile() as archivo:
+            archivo.write(datos)
+            archivo.seek(0)
+            inicio = time.perf_counter()
+            salida, ext_salida = app.preprocesar_audio(archivo, ext)
+            t_ffmpeg = time.perf_counter() - inicio
+            procesado = salida.read()
+        ahorro = (len(datos) - len(procesado)) * 8 / (args.mbps * 1e6)
+        neto = ahorro - t_ffmpeg
+        tot_orig, tot_pre, tot_neto = tot_orig + len(datos), tot_pre + len(procesado), tot_neto + neto
+        linea = (f"{nombre[:25]:<26}{len(datos):>10,}{len(procesado):>10,}"
+                 f"{1 - len(procesado) / len(datos):>7.0%}{t_ffmpeg:>10.2f}{ahorro:>19.2f}{neto:>9.2f}")
+        if args.whisper:
+            t_orig = transcribir(datos, ext)
+            t_pre = transcribir(procesado, ext_salida) + t_ffmpeg
+            linea += f"   {t_orig:>6.2f} → {t_pre:.2f}"
+        print(linea)
+    print(f"\nTotal: {tot_orig:,.0f} → {tot_pre:,.0f} bytes ({1 - tot_pre / tot_orig:.0%} menos); "
+          f"tiempo neto ahorrado a {args.mbps} Mbit/s: {tot_neto:.2f} s (sin contar Whisper)")
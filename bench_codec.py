@@ -0,0 +1,137 @@
+# ---------------------------------------------
+# Benchmark del codec de contexto (app.codificar / app.decodificar)
+# ---------------------------------------------
+# Arma contextos realistas (bienvenida, respuestas directas, respuestas del agente y mensajes
+# cortos del usuario) y reporta, por variante de codec, los bytes guardados por contexto
+# (payload + items de la lista de historial, tal como quedan en Redis) y el tiempo de
+# codificar / decodificar un contexto completo.
+#
+# Uso:
+#   python bench_codec.py                  # 200 contextos de 40 mensajes
+#   python bench_codec.py --contextos 1000 --mensajes 20
+#
+# Requiere las mismas variables de entorno que app.py (se importa el módulo). msgpack y
+# zstandard son opcionales (CODEC_SERIALIZADOR / CODEC_COMPRESOR): las variantes que los
+# necesitan se omiten si no están instalados.
+import argparse
+import base64
+import json
+import random
+import time
+import zlib
+
+import app
+
+MENSAJES_USUARIO = [
+    "hola", "cuánto cuesta?", "Juan", "me interesa bjj", "en la noche", "el sábado puedo",
+    "mi hijo tiene 8 años", "ok gracias", "dónde están?", "a qué hora es kudo?", "1", "2",
+]
+RESPUESTAS_AGENTE = [
+    "¡Genial, {n}! 🥋 El *Brazilian Jiu-Jitsu* es ideal para empezar. ¿Prefieres el turno de la "
+    "mañana o de la noche? Tu *primera clase es GRATIS*, sin compromiso 😊",
+    "¡Perfecto, {n}! Te espero el sábado en el dojo. Recuerda traer ropa cómoda y agua 💧. "
+    "Si necesitas algo más, escríbeme por aquí 😊",
+    "Entrenamos *Kudo*, *Brazilian Jiu-Jitsu* y *Defensa Personal*. La mensualidad es de "
+    "Bs. *250/mes* por persona (3 clases por semana). ¿Te coordino tu clase de prueba? 🥋",
+]
+
+
+def contexto_sintetico(rnd, mensajes):
+    nombre = rnd.choice(["Ana", "Luis", "María José", "Carlos"])
+    historial = [{"role": "assistant", "content": app.construir_bienvenida()}]
+    while len(historial) < mensajes:
+        historial.append({"role": "user", "content": rnd.choice(MENSAJES_USUARIO)})
+        if rnd.random() < 0.4:
+            chunks = rnd.choice(list(app.respuestas_directas.values()))
+            historial.append({"role": "assistant", "content": "\n\n".join(chunks)})
+        else:
+            historial.append({"role": "assistant", "content": rnd.choice(RESPUESTAS_AGENTE).format(n=nombre)})
+    payload = {"timestamp": time.time(), "etapa_calificacion": 99}
+    return payload, historial[:mensajes]
+
+
+def json_actual(obj):
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def zlib_sin_diccionario(obj):
+    texto = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    valor = "~" + base64.b85encode(zlib.compress(texto.encode("utf-8"), 9)).decode("ascii")
+    return valor if len(valor) < len(texto.encode("utf-8")) else texto
+
+
+def zlib_sin_diccionario_dec(valor):
+    if valor.startswith("~"):
+        return json.loads(zlib.decompress(base64.b85decode(valor[1:])))
+    return json.loads(valor)
+
+
+def variante_app(ser, comp):
+    def preparar():
+        app._codec.clear()
+        app.CODEC_SERIALIZADOR, app.CODEC_COMPRESOR = ser, comp
+        app._resolver_codec()
+    return preparar
+
+
+def disponible(modulo):
+    try:
+        __import__(modulo)
+        return True
+    except ImportError:
+        return False
+
+
+def medir_variante(contextos, codificar, decodificar):
+    inicio = time.perf_counter()
+    codificados = [(codificar(p), [codificar(m) for m in h]) for p, h in contextos]
+    t_cod = (time.perf_counter() - inicio) / len(contextos)
+    inicio = time.perf_counter()
+    for p, h in codificados:
+        assert decodificar(p) is not None
+        for m in h:
+            decodificar(m)
+    t_dec = (time.perf_counter() - inicio) / len(contextos)
+    tam = sum(len(p.encode("utf-8")) + sum(len(m.encode("utf-8")) for m in h)
+              for p, h in codificados) / len(contextos)
+    # Ida y vuelta exacta (solo para las variantes de la app).
+    if decodificar is app.decodificar:
+        for (p, h), (pc, hc) in zip(contextos, codificados):
+            assert app.decodificar(pc) == p and [app.decodificar(m) for m in hc] == h
+    return tam, t_cod * 1e6, t_dec * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark del codec de contexto.")
+    parser.add_argument("--contextos", type=int, default=200)
+    parser.add_argument("--mensajes", type=int, default=app.MAX_TURNOS * 2,
+                        help="mensajes de historial por contexto")
+    args = parser.parse_args()
+    rnd = random.Random(7)
+    contextos = [contexto_sintetico(rnd, args.mensajes) for _ in range(args.contextos)]
+
+    variantes = [
+        ("JSON actual (ensure_ascii=False)", None, json_actual, json.loads),
+        ("JSON compacto", variante_app("json", "ninguno"), app.codificar, app.decodificar),
+        ("zlib sin diccionario", None, zlib_sin_diccionario, zlib_sin_diccionario_dec),
+        ("JSON + zlib + diccionario", variante_app("json", "zlib"), app.codificar, app.decodificar),
+    ]
+    if disponible("zstandard"):
+        variantes.append(("JSON + zstd + diccionario", variante_app("json", "zstd"),
+                          app.codificar, app.decodificar))
+    if disponible("msgpack"):
+        variantes.append(("msgpack + zlib + diccionario", variante_app("msgpack", "zlib"),
+                          app.codificar, app.decodificar))
+        if disponible("zstandard"):
+            variantes.append(("msgpack + zstd + diccionario", variante_app("msgpack", "zstd"),
+                              app.codificar, app.decodificar))
+
+    base = None
+    print(f"{args.contextos} contextos × {args.mensajes} mensajes\n")
+    print(f"{'variante':<34}{'bytes/ctx':>11}{'ratio':>8}{'cod µs/ctx':>13}{'dec µs/ctx':>13}")
+    for titulo, preparar, codificar, decodificar in variantes:
+        if preparar:
+            preparar()
+        tam, t_cod, t_dec = medir_variante(contextos, codificar, decodificar)
+        base = base or tam
+        print(f"{titulo:<34}{tam:>11,.0f}{base / tam:>7.2f}x{t_cod:>13,.0f}{t_dec:>13,.0f}")
@@ -0,0 +1,230 @@
+# ---------------------------------------------
+# Micro-benchmark del fallback en memoria (app._MemoriaLocal)
+# ---------------------------------------------
+# Compara la versión acotada (LRU + heap de vencimientos) con una copia de la anterior:
+# throughput de las operaciones que usa el bot, costo de keys() y, sobre todo, memoria
+# retenida tras un día de claves con TTL corto (dedup de wamids) que nadie vuelve a leer.
+#
+# Uso:
+#   python bench_memoria_local.py                 # tamaños por defecto
+#   python bench_memoria_local.py --claves 50000  # más claves de dedup
+#
+# Requiere las mismas variables de entorno que app.py (se importa el módulo).
+import argparse
+import threading
+import time
+import tracemalloc
+
+import app
+
+
+class MemoriaAnterior:
+    """Copia de app._MemoriaLocal antes de acotarla (sin pipeline ni locks)."""
+    def __init__(self):
+        self._store = {}  # key -> (expira_epoch | None, valor)
+        self._hay_datos = threading.Condition()  # despierta a los blpop en espera
+        self._locks = {}  # nombre -> threading.Lock (ver lock())
+
+    def get(self, key):
+        item = self._store.get(key)
+        if not item:
+            return None
+        expira, valor = item
+        if expira is not None and time.time() > expira:
+            self._store.pop(key, None)
+            return None
+        return valor
+
+    def mget(self, keys):
+        return [self.get(k) for k in keys]
+
+    def setex(self, key, ttl, valor):
+        self._store[key] = (time.time() + ttl, valor)
+
+    def set(self, key, valor, nx=False, ex=None):
+        with self._hay_datos:  # nx debe ser atómico frente a otros hilos
+            if nx and self.get(key) is not None:
+                return None
+            self._store[key] = (time.time() + ex if ex else None, valor)
+            return True
+
+    def delete(self, key):
+        self._store.pop(key, None)
+
+    def keys(self, pattern):
+        prefijo = pattern[:-1] if pattern.endswith("*") else pattern
+        return [k for k in list(self._store) if k.startswith(prefijo) and self.get(k) is not None]
+
+    # SCAN: el cursor es la posición en el orden de inserción; como en Redis, una clave
+    # creada o borrada durante el recorrido puede aparecer o no, pero nunca se bloquea.
+    def scan(self, cursor=0, match=None, count=10):
+        claves = list(self._store)[cursor:cursor + count]
+        siguiente = cursor + count if cursor + count < len(self._store) else 0
+        prefijo = match[:-1] if match and match.endswith("*") else match
+        return siguiente, [k for k in claves
+                           if (not match or k.startswith(prefijo)) and self.get(k) is not None]
+
+    def scan_iter(self, match=None, count=10):
+        cursor = 0
+        while True:
+            cursor, claves = self.scan(cursor, match=match, count=count)
+            yield from claves
+            if not cursor:
+                return
+
+    # Listas (cola de trabajo del webhook): rpush / blpop / llen como en redis-py.
+    def rpush(self, key, *valores):
+        with self._hay_datos:
+            lista = self.get(key)
+            if lista is None:
+                lista = []
+                self._store[key] = (None, lista)
+            lista.extend(valores)
+            self._hay_datos.notify_all()
+            return len(lista)
+
+    def blpop(self, keys, timeout=0):
+        limite = time.time() + timeout if timeout else None
+        with self._hay_datos:
+            while True:
+                for key in keys:
+                    lista = self.get(key)
+                    if lista:
+                        return key, lista.pop(0)
+                restante = None if limite is None else limite - time.time()
+                if restante is not None and restante <= 0:
+                    return None
+                self._hay_datos.wait(restante)
+
+    def llen(self, key):
+        return len(self.get(key) or [])
+
+    def lrange(self, key, inicio, fin):
+        lista = self.get(key) or []
+        return list(lista[inicio:(fin + 1) or None])
+
+    def ltrim(self, key, inicio, fin):
+        with self._hay_datos:
+            lista = self.get(key)
+            if lista is not None:
+                lista[:] = lista[inicio:(fin + 1) or None]
+
+    # Hashes (perfil del prospecto): hset / hget / hgetall, y expire para cualquier clave.
+    def hset(self, key, campo=None, valor=None, mapping=None):
+        with self._hay_datos:
+            item = self._store.get(key)
+            if not item or self.get(key) is None:
+                item = (None, {})
+            expira, h = item
+            nuevos = dict(mapping or {})
+            if campo is not None:
+                nuevos[campo] = valor
+            agregados = sum(1 for c in nuevos if c not in h)
+            h.update({c: str(v) for c, v in nuevos.items()})
+            self._store[key] = (expira, h)
+            return agregados
+
+    def hget(self, key, campo):
+        return (self.get(key) or {}).get(campo)
+
+    def hgetall(self, key):
+        return dict(self.get(key) or {})
+
+    def expire(self, key, ttl):
+        with self._hay_datos:
+            valor = self.get(key)
+            if valor is None:
+                return False
+            self._store[key] = (time.time() + ttl, valor)
+            return True
+
+
+def _cronometrar(fn, repeticiones):
+    inicio = time.perf_counter()
+    fn(repeticiones)
+    return repeticiones / (time.perf_counter() - inicio)
+
+
+def get_setex(m, n):
+    for i in range(n):
+        m.setex(f"ctx:{i % 1000}", 3600, "x" * 200)
+        m.get(f"ctx:{(i * 7) % 1000}")
+
+
+def turno(m, n):
+    # Lo que escribe un mensaje: payload, perfil, historial acotado y TTLs.
+    for i in range(n):
+        phone = str(i % 500)
+        m.setex("ctx:" + phone, 3600, '{"timestamp": 1}')
+        m.hset("perfil:" + phone, mapping={"nombre": "Ana", "last_seen": "1"})
+        m.rpush("hist:" + phone, '{"role": "user", "content": "hola"}')
+        m.ltrim("hist:" + phone, -40, -1)
+        m.expire("perfil:" + phone, 3600)
+        m.expire("hist:" + phone, 3600)
+        m.hgetall("perfil:" + phone)
+        m.lrange("hist:" + phone, 0, -1)
+
+
+def dedup(m, n, ttl):
+    for i in range(n):
+        m.set(f"wamid:{i}", "1", nx=True, ex=ttl)
+
+
+def retenido(clase, n):
+    """Claves y KiB retenidos tras n wamids con TTL de 1 s, ya vencidos, + n escrituras más."""
+    tracemalloc.start()
+    m = clase()
+    dedup(m, n, 1)
+    time.sleep(1.1)
+    for i in range(n):
+        m.setex(f"ctx:{i % 100}", 3600, "x")
+    tamano = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return len(m._store), tamano / 1024
+
+
+def concurrente(m, n, hilos=4):
+    def trabajo():
+        for i in range(n // hilos):
+            m.set(f"wamid:{threading.get_ident()}:{i}", "1", nx=True, ex=60)
+            m.get(f"ctx:{i % 100}")
+    ts = [threading.Thread(target=trabajo) for _ in range(hilos)]
+    inicio = time.perf_counter()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    return n / (time.perf_counter() - inicio)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de app._MemoriaLocal vs. la versión anterior.")
+    parser.add_argument("--ops", type=int, default=100000, help="operaciones por prueba de throughput")
+    parser.add_argument("--claves", type=int, default=20000, help="wamids para la prueba de memoria")
+    args = parser.parse_args()
+    clases = (("anterior", MemoriaAnterior), ("acotada", app._MemoriaLocal))
+
+    print(f"{'prueba':<34}" + "".join(f"{nombre:>14}" for nombre, _ in clases))
+    filas = [
+        ("get+setex (op/s)", lambda c: _cronometrar(lambda n: get_setex(c(), n), args.ops)),
+        ("turno de mensaje (turnos/s)", lambda c: _cronometrar(lambda n: turno(c(), n), args.ops // 8)),
+        ("set nx ex (dedup, op/s)", lambda c: _cronometrar(lambda n: dedup(c(), n, 60), args.ops)),
+        ("4 hilos set nx + get (op/s)", lambda c: concurrente(c(), args.ops)),
+    ]
+    for titulo, medir_clase in filas:
+        print(f"{titulo:<34}" + "".join(f"{medir_clase(c):>14,.0f}" for _, c in clases))
+
+    def tiempo_keys(c):
+        m = c()
+        for i in range(args.claves):
+            m.setex(f"ctx:{i}", 3600 if i % 2 else 0.001, "x")
+        time.sleep(0.01)
+        inicio = time.perf_counter()
+        m.keys("ctx:*")
+        return (time.perf_counter() - inicio) * 1000
+    print(f"{'keys(ctx:*) ' + str(args.claves) + ' claves (ms)':<34}"
+          + "".join(f"{tiempo_keys(c):>14.2f}" for _, c in clases))
+
+    resultados = [retenido(c, args.claves) for _, c in clases]
+    print(f"{'claves retenidas tras vencer':<34}" + "".join(f"{r[0]:>14,}" for r in resultados))
+    print(f"{'memoria retenida (KiB)':<34}" + "".join(f"{r[1]:>14,.0f}" for r in resultados))
@@ -0,0 +1,187 @@
+# ---------------------------------------------
+# Prueba de carga del webhook: servidor de desarrollo (python app.py) vs. gunicorn (gthread
+# y, con SERVIDOR_ASGI=1, uvicorn + pipeline asíncrono)
+# ---------------------------------------------
+# Simula `--usuarios` prospectos escribiendo a la vez (`--mensajes` cada uno, uno tras otro,
+# como en WhatsApp) y reporta el throughput (mensajes/s) y la latencia del POST /webhook
+# (p50 / p95 / máx.), que incluye procesar el mensaje si COLA_WEBHOOK=0.
+#
+# Uso:
+#   python bench_servidor.py                      # levanta ambos servidores en modo simulado
+#   python bench_servidor.py --usuarios 64 --agente 2 --workers 4
+#   python bench_servidor.py --usuarios 300 --workers 1   # cientos de conversaciones por proceso
+#   python bench_servidor.py --url https://mi-app.herokuapp.com/webhook   # servidor ya corriendo
+#
+# En modo simulado los servidores corren este mismo módulo con BENCH_SIMULADO=1: el agente
+# es un sleep de `--agente` segundos y Graph / Google Sheets responden al instante, así que
+# se mide solo el servidor (no OpenAI ni Meta). Contra una URL real cada mensaje va al
+# agente de verdad: usar pocos usuarios.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import requests
+
+if os.getenv("BENCH_SIMULADO") == "1":
+    import asyncio
+
+    import agents
+    import httpx
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    class _Respuesta:
+        status_code = 200
+        text = '{"messages": [{"id": "wamid.bench"}]}'
+        headers = {}
+
+        def json(self):
+            return json.loads(self.text)
+
+        def close(self):
+            pass
+
+    class _Hoja:
+        def __init__(self, titulo):
+            self.title = titulo
+
+        def append_row(self, *args, **kwargs):
+            pass
+
+        def append_rows(self, *args, **kwargs):
+            pass
+
+    class _Planilla:
+        def worksheets(self):
+            return [_Hoja("Interesados"), _Hoja("SolicitudesHumano")]
+
+    class _Resultado:
+        final_output = "¡Genial! Te espero en el dojo 🥋"
+        raw_responses = []
+
+    def _agente_simulado(agent, agent_input, **kwargs):
+        time.sleep(float(os.getenv("BENCH_AGENTE_S", "1")))
+        return _Resultado()
+
+    async def _agente_simulado_async(agent, agent_input, **kwargs):
+        await asyncio.sleep(float(os.getenv("BENCH_AGENTE_S", "1")))
+        return _Resultado()
+
+    async def _graph_async_simulado(self, peticion, **kwargs):
+        return httpx.Response(200, json={"messages": [{"id": "wamid.bench"}]}, request=peticion)
+
+    requests.Session.request = lambda self, metodo, url, **kwargs: _Respuesta()
+    httpx.AsyncClient.send = _graph_async_simulado
+    Credentials.from_service_account_info = staticmethod(lambda *a, **k: None)
+    gspread.authorize = lambda creds: type("Cliente", (), {"open_by_key": lambda self, k: _Planilla()})()
+    agents.Runner.run_sync = staticmethod(_agente_simulado)
+    agents.Runner.run = staticmethod(_agente_simulado_async)
+    from app import app, asgi_app  # noqa: E402,F401  (gunicorn: bench_servidor:app / :asgi_app)
+
+
+def _payload(phone, texto):
+    mensaje = {"from": phone, "id": f"wamid.{uuid.uuid4().hex}", "type": "text", "text": {"body": texto}}
+    return {"entry": [{"changes": [{"value": {"messages": [mensaje]}}]}]}
+
+
+def cargar(url, usuarios, mensajes):
+    """Devuelve (segundos totales, latencias por POST, errores)."""
+    latencias, errores = [], []
+    lock = threading.Lock()
+    textos = ["hola", "quiero entrenar algo para mi hijo, qué me recomiendas?",
+              "y para adultos principiantes que nunca entrenaron?", "genial, gracias"]
+
+    def usuario(i):
+        sesion = requests.Session()
+        phone = f"5917{i:07d}"
+        for n in range(mensajes):
+            inicio = time.perf_counter()
+            try:
+                resp = sesion.post(url, json=_payload(phone, textos[n % len(textos)]), timeout=300)
+                ok = resp.status_code == 200
+            except requests.RequestException as e:
+                ok, resp = False, e
+            with lock:
+                latencias.append(time.perf_counter() - inicio)
+                if not ok:
+                    errores.append(str(getattr(resp, "status_code", resp)))
+
+    hilos = [threading.Thread(target=usuario, args=(i,)) for i in range(usuarios)]
+    inicio = time.perf_counter()
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    return time.perf_counter() - inicio, latencias, errores
+
+
+def reportar(titulo, total, latencias, errores):
+    latencias = sorted(latencias)
+    p95 = latencias[min(len(latencias) - 1, int(0.95 * len(latencias)))]
+    print(f"{titulo:<28}{len(latencias) / total:>9.1f}{statistics.median(latencias):>9.2f}"
+          f"{p95:>9.2f}{latencias[-1]:>9.2f}{total:>10.1f}{len(errores):>8}")
+    return len(latencias) / total
+
+
+def levantar(comando, puerto, env):
+    proceso = subprocess.Popen(comando, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    limite = time.monotonic() + 60
+    while time.monotonic() < limite:
+        try:
+            if requests.get(f"http://127.0.0.1:{puerto}/readyz", timeout=1).status_code == 200:
+                return proceso
+        except requests.RequestException:
+            pass
+        time.sleep(0.3)
+    proceso.kill()
+    raise SystemExit(f"El servidor {' '.join(comando)} no quedó listo en 60 s.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prueba de carga del webhook.")
+    parser.add_argument("--url", help="webhook de un servidor ya levantado (sin modo simulado)")
+    parser.add_argument("--usuarios", type=int, default=32, help="usuarios concurrentes")
+    parser.add_argument("--mensajes", type=int, default=3, help="mensajes por usuario")
+    parser.add_argument("--agente", type=float, default=1.0, help="segundos del agente simulado")
+    parser.add_argument("--workers", type=int, default=4, help="procesos gunicorn (WEB_CONCURRENCY)")
+    parser.add_argument("--servir", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.servir:  # servidor de desarrollo simulado (lo lanza el propio benchmark)
+        app.run(host="127.0.0.1", port=int(os.environ["PORT"]))
+        sys.exit(0)
+
+    print(f"{args.usuarios} usuarios × {args.mensajes} mensajes\n")
+    print(f"{'servidor':<28}{'msg/s':>9}{'p50 s':>9}{'p95 s':>9}{'máx s':>9}{'total s':>10}{'errores':>8}")
+    if args.url:
+        reportar(args.url[:27], *cargar(args.url, args.usuarios, args.mensajes))
+        sys.exit(0)
+
+    env = {**os.environ, "BENCH_SIMULADO": "1", "BENCH_AGENTE_S": str(args.agente),
+           "GOOGLE_CREDENTIALS_JSON": os.getenv("GOOGLE_CREDENTIALS_JSON", "{}"),
+           "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", "sk-bench"),
+           "WEB_CONCURRENCY": str(args.workers)}
+    env.pop("REDIS_URL", None)  # cada proceso con su memoria local: usuarios distintos, sin cruces
+    resultados = {}
+    gunicorn = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py"]
+    for titulo, puerto, comando, extra in [
+        ("python app.py (Flask dev)", 8101, [sys.executable, __file__, "--servir"], {}),
+        (f"gunicorn {args.workers}×gthread", 8102, gunicorn + ["bench_servidor:app"], {}),
+        (f"gunicorn {args.workers}×uvicorn (async)", 8103, gunicorn + ["bench_servidor:asgi_app"],
+         {"SERVIDOR_ASGI": "1"}),
+    ]:
+        proceso = levantar(comando, puerto, {**env, **extra, "PORT": str(puerto)})
+        try:
+            resultados[titulo] = reportar(
+                titulo, *cargar(f"http://127.0.0.1:{puerto}/webhook", args.usuarios, args.mensajes))
+        finally:
+            proceso.terminate()
+            proceso.wait(30)
+    base, hilos, asincrono = resultados.values()
+    print(f"\nThroughput gunicorn / dev server: {hilos / base:.1f}x; async / dev server: {asincrono / base:.1f}x")
@@ -0,0 +1,137 @@
+# ---------------------------------------------
+# Evaluación offline del router de intenciones (app.clasificar_intencion)
+# ---------------------------------------------
+# Mide, sobre mensajes etiquetados a mano, cuántos se resolverían SIN llamar al agente
+# (hit rate), cuántos de esos irían a la opción correcta (precisión), cuántos se desviarían
+# por error, la latencia del clasificador y la latencia de agente ahorrada.
+#
+# Uso:
+#   python evaluar_router.py                          # casos etiquetados de abajo
+#   python evaluar_router.py --csv interesados.csv    # + hit rate sobre mensajes reales (col. 2)
+#   python evaluar_router.py --latencia-agente 7.5    # latencia media de Runner.run_sync (s)
+#
+# Requiere las mismas variables de entorno que app.py (se importa el módulo).
+import argparse
+import csv
+import statistics
+import time
+
+import app
+
+# (mensaje, opción esperada | None = debe ir al agente)
+CASOS = [
+    ("cuánto cuesta", "2"),
+    ("Cuanto cuesta la mensualidad?", "2"),
+    ("precios", "2"),
+    ("cuánto cobran?", "2"),
+    ("holaaa buenas tardes, precios?", "2"),
+    ("mensualidad", "2"),
+    ("horarios", "1"),
+    ("horaios", "1"),
+    ("a que hora son las clases", "1"),
+    ("qué días hay clases?", "1"),
+    ("horario niños", "1"),
+    ("dónde están?", "5"),
+    ("donde queda el dojo", "5"),
+    ("ubicación", "5"),
+    ("ubicasion", "5"),
+    ("dirección porfa", "5"),
+    ("mándame el mapa", "5"),
+    ("que es el kudo?", "6"),
+    ("qué es kudo", "6"),
+    ("filosofía del kudo", "6"),
+    ("venden guantes?", "7"),
+    ("guantillas de mma", "7"),
+    ("quiero comprar guantes", "7"),
+    ("quiero inscribirme", "4"),
+    ("quisiera inscribirme", "4"),
+    ("cómo me inscribo? inscripción", "4"),
+    ("como empiezo", "4"),
+    ("qué disciplinas tienen", "3"),
+    ("que clases ofrecen", "3"),
+    # Deben ir al agente: embudo, nombres, mensajes largos o ambiguos.
+    ("hola", None),
+    ("buenos días", None),
+    ("Juan", None),
+    ("María José", None),
+    ("el sábado", None),
+    ("puedo el martes a las 7?", None),
+    ("noche", None),
+    ("quiero hablar con alguien", None),
+    ("horarios y precios", None),
+    ("1, 3, 4", None),
+    ("cuanto cuesta el bjj para mi hijo de 8 años y a que hora", None),
+    ("mi hijo tiene 5 años, puede entrar?", None),
+    ("gracias!", None),
+    ("ok", None),
+    ("hay winter camp?", None),
+    ("quién es el profesor de jiu jitsu", None),
+    # Intención del menú + dato del embudo (día, turno, nombre, disciplina): el agente responde
+    # Y registra el dato; el router se lo saltearía.
+    ("quiero inscribirme el martes en la noche", None),
+    ("me llamo Juan y quiero precios", None),
+    ("horario de la tarde para bjj", None),
+    ("horarios de bjj", None),
+    ("precio del bjj", None),
+    ("a que hora es kick boxing", None),
+]
+
+
+def _percentil(valores, p):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(round(p * (len(valores) - 1))))]
+
+
+def evaluar(casos, latencia_agente, repeticiones=200):
+    enrutados = correctos = desviados = 0
+    tiempos = []
+    for texto, esperado in casos:
+        inicio = time.perf_counter()
+        for _ in range(repeticiones):
+            clave = app.clasificar_intencion(texto)
+        tiempos.append((time.perf_counter() - inicio) / repeticiones * 1e6)
+        if clave is not None:
+            enrutados += 1
+            if clave == esperado:
+                correctos += 1
+            else:
+                desviados += 1
+                print(f"  ✗ {texto!r}: esperado {esperado}, router {clave}")
+        elif esperado is not None:
+            print(f"  · {texto!r}: esperado {esperado}, va al agente "
+                  f"({app._indice_intenciones.clasificar(texto)[2]})")
+    total = len(casos)
+    esperados = sum(1 for _, e in casos if e is not None)
+    print(f"\nCasos: {total} ({esperados} con opción directa esperada)")
+    print(f"Hit rate (sin agente):  {enrutados}/{total} = {enrutados / total:.0%}")
+    print(f"Recall opciones:        {correctos}/{esperados} = {correctos / max(esperados, 1):.0%}")
+    print(f"Precisión:              {correctos}/{enrutados} = {correctos / max(enrutados, 1):.0%}")
+    print(f"Desvíos (errores):      {desviados}")
+    print(f"Latencia clasificador:  p50 {statistics.median(tiempos):.1f} µs · "
+          f"p99 {_percentil(tiempos, 0.99):.1f} µs")
+    print(f"Latencia de agente ahorrada: {correctos * latencia_agente:.1f} s "
+          f"({latencia_agente:.1f} s × {correctos} mensajes)")
+
+
+def hit_rate_csv(ruta, latencia_agente):
+    with open(ruta, newline="", encoding="utf-8") as f:
+        mensajes = [fila[1] for fila in csv.reader(f) if len(fila) > 1 and fila[1]
+                    and not fila[1].startswith("[")]  # excluye marcas internas ([NUEVO USUARIO]…)
+    if not mensajes:
+        print(f"\n{ruta}: sin mensajes")
+        return
+    enrutados = sum(1 for m in mensajes if app.clasificar_intencion(m) is not None)
+    print(f"\n{ruta}: {enrutados}/{len(mensajes)} mensajes reales resueltos sin agente "
+          f"({enrutados / len(mensajes):.0%}) ≈ {enrutados * latencia_agente:.1f} s de agente ahorrados")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evalúa el router de intenciones sin LLM.")
+    parser.add_argument("--latencia-agente", type=float, default=6.0,
+                        help="segundos medios de Runner.run_sync por mensaje")
+    parser.add_argument("--csv", action="append", default=[],
+                        help="CSV con mensajes reales en la 2.ª columna (p. ej. interesados.csv)")
+    args = parser.parse_args()
+    evaluar(CASOS, args.latencia_agente)
+    for ruta in args.csv:
+        hit_rate_csv(ruta, args.latencia_agente)
@@ -0,0 +1,65 @@
+# ---------------------------------------------
+# Configuración de gunicorn (servidor de producción del webhook)
+# ---------------------------------------------
+# Procfile: `web: gunicorn` (gunicorn lee este archivo solo; la app sale de wsgi_app).
+#
+# El trabajo por mensaje es casi todo espera de red (agente 10–30 s, Whisper, Graph, Sheets),
+# así que se usan workers "gthread": varios procesos × muchos hilos. Cada proceso atiende
+# `threads` requests a la vez y además procesa mensajes en su pool (MENSAJES_PARALELOS).
+# Con SERVIDOR_ASGI=1 cada proceso corre en cambio un loop de uvicorn con app.asgi_app:
+# el pipeline asíncrono espera la red sin ocupar un hilo por mensaje.
+#
+# Variables de entorno:
+#   PORT               puerto (Heroku lo define; por defecto 8000)
+#   SERVIDOR_ASGI      1 = workers uvicorn + app:asgi_app (por defecto 0: gthread + app:app)
+#   WEB_CONCURRENCY    nº de procesos (por defecto 2 × CPUs + 1, máx. 8). Sin REDIS_URL se
+#                      fuerza 1: la memoria local no se comparte entre procesos.
+#   GUNICORN_THREADS   hilos por proceso (por defecto 16)
+#   GRACEFUL_TIMEOUT   seg. para terminar lo pendiente tras SIGTERM (Heroku mata a los 30 s)
+import multiprocessing
+import os
+
+# El maestro importa app.py una sola vez (preload) y cada worker calienta SUS conexiones
+# después del fork (ver post_fork y app._reiniciar_tras_fork).
+os.environ.setdefault("CALENTAR_AL_INICIO", "0")
+preload_app = True
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+if os.getenv("SERVIDOR_ASGI", "0") == "1":
+    wsgi_app = "app:asgi_app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    wsgi_app = "app:app"
+    worker_class = "gthread"
+    threads = int(os.getenv("GUNICORN_THREADS", "16"))
+if not os.getenv("REDIS_URL"):
+    # Heroku define WEB_CONCURRENCY en cada dyno: sin Redis se ignora (dedup, locks, buzones y
+    # contexto viven en la memoria de UN proceso).
+    workers = 1
+    if int(os.getenv("WEB_CONCURRENCY") or "1") > 1:
+        print(f"[WARN] gunicorn: WEB_CONCURRENCY={os.getenv('WEB_CONCURRENCY')} ignorado sin "
+              "REDIS_URL; se usa 1 proceso.")
+elif os.getenv("WEB_CONCURRENCY"):
+    workers = int(os.getenv("WEB_CONCURRENCY"))
+else:
+    workers = min(multiprocessing.cpu_count() * 2 + 1, 8)
+
+# gthread vigila el latido del proceso, no la duración de cada request: un agente lento no
+# dispara el timeout; un proceso colgado sí.
+timeout = 60
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "25"))
+keepalive = 5
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info")
+
+
+def post_fork(server, worker):
+    import app
+    app.iniciar_calentamiento()
+
+
+def worker_exit(server, worker):
+    # gunicorn ya dejó de aceptar conexiones y terminó los requests en curso; queda el
+    # trabajo en segundo plano (cola, buzones, envíos, outbox).
+    import app
+    app.drenar(max(1.0, graceful_timeout - 5))